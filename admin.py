@@ -3,23 +3,250 @@
 
 from datastore import OAuth
 from googleapiclient import errors
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google_directory_service import GoogleDirectoryService
+import httplib2
 import logging
+from lru_cache import LruCache
+from oauth2client.appengine import CredentialsModel
 from oauth2client.appengine import OAuth2Decorator
+from oauth2client.appengine import StorageByKeyName
+from oauth2client.client import AccessTokenRefreshError
+import threading
+import time
+import webapp2
 
-# TODO(eholder): Add tests for this. Probably should test that we only
-# request the scopes we need and that the decorator is called with the
-# id and secret as intended.
 USER = 'https://www.googleapis.com/auth/admin.directory.user'
 GROUP = 'https://www.googleapis.com/auth/admin.directory.group.readonly'
 MEMBER = 'https://www.googleapis.com/auth/admin.directory.group.member.readonly'
 SCOPES = [USER, GROUP, MEMBER]
 
-OAUTH_DECORATOR = OAuth2Decorator(
-    client_id=OAuth.GetOrInsertDefault().client_id,
-    client_secret=OAuth.GetOrInsertDefault().client_secret,
-    scope=SCOPES)
+OAUTH_CALLBACK_PATH = '/oauth2callback'
+# Seconds before an instance checks the datastore for a new client id and
+# secret. The instance handling the setup page picks them up straight away.
+OAUTH_CONFIG_TTL = 600
+
+
+class LazyOAuth2Decorator(object):
+
+  """An OAuth2Decorator which is only built when it is first used.
+
+  Building the decorator needs the client id and secret from the datastore,
+  and every handler module decorates its handlers when imported. Deferring
+  the datastore read until a handler needs OAuth keeps it out of instance
+  start up, so that pages without OAuth like the landing page are not slowed
+  down by it.
+
+  The decorator is cached per instance. It is rebuilt when Reset is called or
+  when the stored client id and secret are found to have changed. Each request
+  keeps using the decorator it started with, since that holds its credentials.
+  """
+
+  # pylint: disable=invalid-name
+
+  def __init__(self, scope, callback_path=OAUTH_CALLBACK_PATH):
+    """Store the decorator's settings without building it.
+
+    Args:
+      scope: A list of the OAuth scopes to request.
+      callback_path: The path handling the redirect back from OAuth.
+    """
+    self.scope = scope
+    self.callback_path = callback_path
+    self._decorator = None
+    self._client_config = None
+    self._checked_time = 0
+    self._lock = threading.Lock()
+    self._local = threading.local()
+
+  def _IsStale(self, now):
+    """Check whether the decorator needs to be built or checked again."""
+    return (self._decorator is None or
+            now - self._checked_time > OAUTH_CONFIG_TTL)
+
+  def _GetDecorator(self):
+    """Get the OAuth2Decorator, building it if needed.
+
+    Returns:
+      The OAuth2Decorator using the stored client id and secret.
+    """
+    now = time.time()
+    if self._IsStale(now):
+      with self._lock:
+        if self._IsStale(now):
+          entity = OAuth.GetOrInsertDefault()
+          client_config = (entity.client_id, entity.client_secret)
+          if client_config != self._client_config:
+            self._decorator = OAuth2Decorator(
+                client_id=entity.client_id,
+                client_secret=entity.client_secret,
+                scope=self.scope,
+                callback_path=self.callback_path)
+            self._client_config = client_config
+          self._checked_time = now
+    return self._decorator
+
+  def Load(self):
+    """Build the decorator now rather than on first use, e.g. on warmup."""
+    self._GetDecorator()
+
+  def Reset(self):
+    """Rebuild the decorator on its next use, e.g. after setup changes it."""
+    with self._lock:
+      self._decorator = None
+      self._client_config = None
+
+  def oauth_required(self, method):
+    """Require OAuth for a request handler method.
+
+    Args:
+      method: The request handler method to decorate.
+
+    Returns:
+      The decorated method.
+    """
+    def check_oauth(request_handler, *args, **kwargs):
+      """Apply the decorator in use for this request to the method."""
+      decorator = self._GetDecorator()
+      self._local.decorator = decorator
+      try:
+        return decorator.oauth_required(method)(request_handler, *args,
+                                                **kwargs)
+      finally:
+        self._local.decorator = None
+
+    return check_oauth
+
+  def http(self, *args, **kwargs):
+    """Get an http object authorized with the current request's credentials.
+
+    Args:
+      args: Parameters passed on to the decorator's http.
+      kwargs: Parameters passed on to the decorator's http.
+
+    Returns:
+      An authorized httplib2.Http object.
+    """
+    decorator = getattr(self._local, 'decorator', None)
+    if decorator is None:
+      decorator = self._GetDecorator()
+    return decorator.http(*args, **kwargs)
+
+  def callback_handler(self):
+    """Get a request handler for the redirect back from OAuth.
+
+    Returns:
+      A request handler class which hands the request to the decorator's own
+      callback handler.
+    """
+    lazy_decorator = self
+
+    class OAuth2CallbackHandler(webapp2.RequestHandler):
+
+      """Handle the redirect back from OAuth once the decorator is built."""
+
+      # pylint: disable=too-few-public-methods
+
+      def get(self):
+        """Hand the request to the decorator's callback handler."""
+        # pylint: disable=protected-access
+        decorator = lazy_decorator._GetDecorator()
+        handler = decorator.callback_handler()(self.request, self.response)
+        return handler.get()
+
+    return OAuth2CallbackHandler
+
+
+OAUTH_DECORATOR = LazyOAuth2Decorator(scope=SCOPES)
+
+
+class StoredCredentials(object):
+
+  """Stand in for the OAuth decorator outside of a user's request.
+
+  The decorator stores each user's credentials in the datastore, so work a
+  user started in the background, such as a task, can call APIs on their
+  behalf with these.
+  """
+
+  # pylint: disable=too-few-public-methods
+
+  def __init__(self, user_id):
+    """Store which user's credentials to use.
+
+    Args:
+      user_id: The id of the user, as given by users.User.user_id().
+    """
+    self.user_id = user_id
+
+  def http(self):
+    """Get an http object authorized with the user's stored credentials.
+
+    Returns:
+      An authorized httplib2.Http object.
+
+    Raises:
+      AccessTokenRefreshError: The user has no valid stored credentials.
+    """
+    storage = StorageByKeyName(CredentialsModel, self.user_id, 'credentials')
+    credentials = storage.get()
+    if credentials is None or credentials.invalid:
+      raise AccessTokenRefreshError(
+          'No valid credentials are stored for user %s.' % self.user_id)
+    return credentials.authorize(httplib2.Http())
+
+
+# Whether users are domain admins is cached so that admin pages do not wait on
+# the directory API. Entries are dropped when a makeAdmin notification for the
+# user arrives, but the in-process cache of other instances can only expire,
+# so it is kept shorter than the memcache one.
+IS_ADMIN_CACHE_SIZE = 1000
+IS_ADMIN_LOCAL_TTL = 60
+IS_ADMIN_MEMCACHE_TTL = 300
+IS_ADMIN_MEMCACHE_PREFIX = 'is_admin:'
+
+_IS_ADMIN_CACHE = LruCache(IS_ADMIN_CACHE_SIZE, ttl=IS_ADMIN_LOCAL_TTL)
+
+
+def _IsDomainAdmin(email):
+  """Check whether a user is a domain admin, using the cache if possible.
+
+  Both admins and non-admins are cached. Errors asking the directory API are
+  not, so they are retried on the next request.
+
+  Args:
+    email: The email of the user to check.
+
+  Returns:
+    True if the user is a domain admin.
+
+  Raises:
+    errors.HttpError: The directory API could not be asked.
+  """
+  is_admin_user = _IS_ADMIN_CACHE.Get(email)
+  if is_admin_user is not None:
+    return is_admin_user
+
+  memcache_key = IS_ADMIN_MEMCACHE_PREFIX + email
+  is_admin_user = memcache.get(memcache_key)
+  if is_admin_user is None:
+    directory_service = GoogleDirectoryService(OAUTH_DECORATOR)
+    is_admin_user = bool(directory_service.IsAdminUser(email))
+    memcache.set(memcache_key, is_admin_user, time=IS_ADMIN_MEMCACHE_TTL)
+  _IS_ADMIN_CACHE.Set(email, is_admin_user)
+  return is_admin_user
+
+
+def InvalidateIsAdmin(email):
+  """Forget whether a user is a domain admin, e.g. after it changed.
+
+  Args:
+    email: The email of the user.
+  """
+  _IS_ADMIN_CACHE.Delete(email)
+  memcache.delete(IS_ADMIN_MEMCACHE_PREFIX + email)
+
 
 def AbortIfUserIsNotLoggedIn(self, user):
   """Check if the user is logged in and abort if not.
@@ -80,8 +307,7 @@ def RequireAppOrDomainAdmin(func):
 
     is_admin_user = False
     try:
-      directory_service = GoogleDirectoryService(OAUTH_DECORATOR)
-      is_admin_user = directory_service.IsAdminUser(identifier)
+      is_admin_user = _IsDomainAdmin(identifier)
     except errors.HttpError:
       logging.error('Exception when asking dasher for this user.')
       self.abort(403)
@@ -0,0 +1,155 @@
+"""Test admin module functionality."""
+from mock import MagicMock
+from mock import patch
+import sys
+
+from datastore import OAuth
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from oauth2client.client import AccessTokenRefreshError
+
+import unittest
+import webapp2
+
+# Need to mock the XSRF token so that templates can be rendered without a
+# signed in user. http://stackoverflow.com/a/7667621/2830207
+def MockToken():
+  """Mock token generator that returns empty."""
+  return ''
+
+MOCK_XSRF = MagicMock()
+MOCK_XSRF.XSRFToken = MockToken
+sys.modules['xsrf'] = MOCK_XSRF
+
+import admin
+
+
+FAKE_EMAIL = 'fake_admin@example.com'
+FAKE_CLIENT_ID = 'fake client id'
+FAKE_CLIENT_SECRET = 'fake client secret'  # noqa
+FAKE_HTTP = 'fake authorized http'
+
+
+class AdminTest(unittest.TestCase):
+
+  """Test admin module functionality."""
+
+  def setUp(self):
+    """Setup the testbed and start each test with empty caches."""
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    # pylint: disable=protected-access
+    admin._IS_ADMIN_CACHE.Clear()
+
+  def tearDown(self):
+    """Deactivate the testbed."""
+    self.testbed.deactivate()
+
+  @patch('admin.OAuth2Decorator')
+  def testDecoratorIsBuiltOnFirstUse(self, mock_decorator_class):
+    """Test the decorator only reads the datastore when first used."""
+    OAuth.Insert(FAKE_CLIENT_ID, FAKE_CLIENT_SECRET)
+    lazy_decorator = admin.LazyOAuth2Decorator(scope=admin.SCOPES)
+    mock_decorator_class.assert_not_called()
+
+    mock_decorator_class.return_value.http.return_value = FAKE_HTTP
+    self.assertEqual(lazy_decorator.http(), FAKE_HTTP)
+    self.assertEqual(lazy_decorator.http(), FAKE_HTTP)
+
+    mock_decorator_class.assert_called_once_with(
+        client_id=FAKE_CLIENT_ID, client_secret=FAKE_CLIENT_SECRET,
+        scope=admin.SCOPES, callback_path=admin.OAUTH_CALLBACK_PATH)
+
+  @patch('admin.OAuth2Decorator')
+  def testResetRebuildsDecorator(self, mock_decorator_class):
+    """Test the decorator picks up a new client id and secret after reset."""
+    OAuth.Insert(FAKE_CLIENT_ID, FAKE_CLIENT_SECRET)
+    lazy_decorator = admin.LazyOAuth2Decorator(scope=admin.SCOPES)
+    lazy_decorator.http()
+
+    OAuth.Update('new id', 'new secret')
+    lazy_decorator.http()
+    self.assertEqual(mock_decorator_class.call_count, 1)
+
+    lazy_decorator.Reset()
+    lazy_decorator.http()
+    self.assertEqual(mock_decorator_class.call_count, 2)
+    self.assertEqual(mock_decorator_class.call_args[1]['client_id'], 'new id')
+
+  @patch('admin.OAuth2Decorator')
+  def testOAuthRequiredKeepsDecoratorForRequest(self, mock_decorator_class):
+    """Test a request keeps its decorator even if it is reset meanwhile."""
+    first_decorator = MagicMock()
+    second_decorator = MagicMock()
+    mock_decorator_class.side_effect = [first_decorator, second_decorator]
+    first_decorator.oauth_required.side_effect = lambda method: method
+    lazy_decorator = admin.LazyOAuth2Decorator(scope=admin.SCOPES)
+
+    def Handle(request_handler):
+      """Mock a handler which resets the decorator part way through."""
+      # pylint: disable=unused-argument
+      lazy_decorator.Reset()
+      return lazy_decorator.http()
+
+    first_decorator.http.return_value = FAKE_HTTP
+    self.assertEqual(lazy_decorator.oauth_required(Handle)(MagicMock()),
+                     FAKE_HTTP)
+    lazy_decorator.http()
+    second_decorator.http.assert_called_once_with()
+
+  def testCallbackPathIsKnownBeforeUse(self):
+    """Test routes for the callback can be made without building anything."""
+    lazy_decorator = admin.LazyOAuth2Decorator(scope=admin.SCOPES)
+    self.assertEqual(lazy_decorator.callback_path, admin.OAUTH_CALLBACK_PATH)
+    self.assertTrue(issubclass(lazy_decorator.callback_handler(),
+                               webapp2.RequestHandler))
+
+  def testStoredCredentialsMissing(self):
+    """Test there is no http object for users without stored credentials."""
+    stored_credentials = admin.StoredCredentials('1234')
+    self.assertRaises(AccessTokenRefreshError, stored_credentials.http)
+
+  @patch('admin.StorageByKeyName')
+  def testStoredCredentials(self, mock_storage_class):
+    """Test the user's stored credentials authorize the http object."""
+    credentials = mock_storage_class.return_value.get.return_value
+    credentials.invalid = False
+    credentials.authorize.return_value = FAKE_HTTP
+
+    self.assertEqual(admin.StoredCredentials('1234').http(), FAKE_HTTP)
+    mock_storage_class.assert_called_once_with(admin.CredentialsModel, '1234',
+                                               'credentials')
+
+  @patch('admin.GoogleDirectoryService')
+  def testIsDomainAdminIsCached(self, mock_directory_service):
+    """Test the directory is asked once and non-admins are cached too."""
+    # pylint: disable=protected-access
+    mock_directory_service.return_value.IsAdminUser.return_value = False
+
+    self.assertFalse(admin._IsDomainAdmin(FAKE_EMAIL))
+    self.assertFalse(admin._IsDomainAdmin(FAKE_EMAIL))
+    admin._IS_ADMIN_CACHE.Clear()
+    self.assertFalse(admin._IsDomainAdmin(FAKE_EMAIL))
+
+    mock_directory_service.return_value.IsAdminUser.assert_called_once_with(
+        FAKE_EMAIL)
+
+  @patch('admin.GoogleDirectoryService')
+  def testInvalidateIsAdmin(self, mock_directory_service):
+    """Test invalidating a user makes the directory be asked again."""
+    # pylint: disable=protected-access
+    is_admin_user = mock_directory_service.return_value.IsAdminUser
+    is_admin_user.return_value = False
+    self.assertFalse(admin._IsDomainAdmin(FAKE_EMAIL))
+
+    is_admin_user.return_value = True
+    admin.InvalidateIsAdmin(FAKE_EMAIL)
+    self.assertTrue(admin._IsDomainAdmin(FAKE_EMAIL))
+    self.assertEqual(is_admin_user.call_count, 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,6 +2,7 @@
 
 from config import PATHS
 from google.appengine.api import app_identity
+from google.appengine.api import memcache
 from google.appengine.ext import vendor
 import jinja2
 import os
@@ -10,14 +11,66 @@ import xsrf
 
 ROOT = os.path.dirname(__file__)
 
-JINJA_ENVIRONMENT = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(ROOT),
-    extensions=['jinja2.ext.autoescape',
-                'jinja2.ext.i18n'],
-    autoescape=True)
+# Templates compiled to python modules by './setup.sh templates' at deploy.
+COMPILED_TEMPLATES_DIR = os.path.join(ROOT, 'compiled_templates')
+# Compiled templates kept in memory, which is more than there are templates.
+TEMPLATE_CACHE_SIZE = 100
+TEMPLATE_BYTECODE_PREFIX = 'jinja2/bytecode/'
 
 
-JINJA_ENVIRONMENT.globals['xsrf_token'] = xsrf.XSRFToken()
+def _IsProduction():
+  """Check whether the app is running on App Engine itself."""
+  return os.environ.get('SERVER_SOFTWARE', '').startswith('Google App Engine')
+
+
+def _MakeJinjaEnvironment():
+  """Make the Jinja environment for rendering templates.
+
+  In production, templates cannot change without a deploy, so they are not
+  checked for changes. They are loaded from the modules compiled at deploy
+  if there are any, and otherwise compiled once per app version with the
+  bytecode shared between instances through memcache. The development
+  server reloads templates as they are edited.
+
+  Returns:
+    A jinja2.Environment.
+  """
+  file_system_loader = jinja2.FileSystemLoader(ROOT)
+  options = {
+      'extensions': ['jinja2.ext.autoescape', 'jinja2.ext.i18n'],
+      'autoescape': True,
+      'cache_size': TEMPLATE_CACHE_SIZE,
+  }
+  if not _IsProduction():
+    return jinja2.Environment(loader=file_system_loader, **options)
+
+  loader = file_system_loader
+  if os.path.isdir(COMPILED_TEMPLATES_DIR):
+    loader = jinja2.ChoiceLoader([jinja2.ModuleLoader(COMPILED_TEMPLATES_DIR),
+                                  file_system_loader])
+  return jinja2.Environment(
+      loader=loader, auto_reload=False,
+      bytecode_cache=jinja2.MemcachedBytecodeCache(
+          memcache, prefix=TEMPLATE_BYTECODE_PREFIX),
+      **options)
+
+
+def CompileTemplates(target):
+  """Compile every template under templates/ into python modules.
+
+  Args:
+    target: The directory to write the modules to.
+  """
+  JINJA_ENVIRONMENT.compile_templates(
+      target, zip=None, ignore_errors=False,
+      filter_func=lambda name: name.startswith('templates/'))
+
+
+JINJA_ENVIRONMENT = _MakeJinjaEnvironment()
+
+
+# Called while rendering, as the token is different for each user.
+JINJA_ENVIRONMENT.globals['xsrf_token'] = xsrf.XSRFToken
 HOST = str(app_identity.get_default_version_hostname())
 JINJA_ENVIRONMENT.globals['BASE_URL'] = ('https://' + HOST)
 JINJA_ENVIRONMENT.globals['EMAIL_VALIDATION_PATTERN'] = r'[^@]+@[^@]+.[^@]+'
@@ -0,0 +1,84 @@
+"""Test appengine config module functionality."""
+from mock import MagicMock
+from mock import patch
+import sys
+
+import jinja2
+import os
+import unittest
+
+# Need to mock the XSRF token so that templates can be rendered without a
+# signed in user. http://stackoverflow.com/a/7667621/2830207
+def MockToken():
+  """Mock token generator that returns empty."""
+  return ''
+
+MOCK_XSRF = MagicMock()
+MOCK_XSRF.XSRFToken = MockToken
+sys.modules['xsrf'] = MOCK_XSRF
+
+import appengine_config
+
+
+PRODUCTION_ENVIRON = {'SERVER_SOFTWARE': 'Google App Engine/1.9.30'}
+DEVELOPMENT_ENVIRON = {'SERVER_SOFTWARE': 'Development/2.0'}
+
+
+class AppengineConfigTest(unittest.TestCase):
+
+  """Test appengine config module functionality."""
+
+  # pylint: disable=protected-access
+
+  @patch.dict(os.environ, DEVELOPMENT_ENVIRON)
+  def testDevelopmentEnvironmentReloadsTemplates(self):
+    """Test templates are reloaded and not shared during development."""
+    environment = appengine_config._MakeJinjaEnvironment()
+
+    self.assertTrue(environment.auto_reload)
+    self.assertIsNone(environment.bytecode_cache)
+    self.assertTrue(isinstance(environment.loader, jinja2.FileSystemLoader))
+
+  @patch('appengine_config.os.path.isdir')
+  @patch.dict(os.environ, PRODUCTION_ENVIRON)
+  def testProductionEnvironmentCachesTemplates(self, mock_isdir):
+    """Test templates are cached and not checked for changes in production."""
+    mock_isdir.return_value = False
+    environment = appengine_config._MakeJinjaEnvironment()
+
+    self.assertFalse(environment.auto_reload)
+    self.assertTrue(isinstance(environment.bytecode_cache,
+                               jinja2.MemcachedBytecodeCache))
+    self.assertEqual(environment.cache.capacity,
+                     appengine_config.TEMPLATE_CACHE_SIZE)
+    self.assertTrue(isinstance(environment.loader, jinja2.FileSystemLoader))
+
+  @patch('appengine_config.os.path.isdir')
+  @patch.dict(os.environ, PRODUCTION_ENVIRON)
+  def testProductionEnvironmentPrefersCompiledTemplates(self, mock_isdir):
+    """Test templates compiled at deploy are used ahead of their sources."""
+    mock_isdir.return_value = True
+    environment = appengine_config._MakeJinjaEnvironment()
+
+    mock_isdir.assert_called_once_with(appengine_config.COMPILED_TEMPLATES_DIR)
+    self.assertTrue(isinstance(environment.loader, jinja2.ChoiceLoader))
+    module_loader, file_system_loader = environment.loader.loaders
+    self.assertTrue(isinstance(module_loader, jinja2.ModuleLoader))
+    self.assertTrue(isinstance(file_system_loader, jinja2.FileSystemLoader))
+
+  @patch('appengine_config.JINJA_ENVIRONMENT.compile_templates')
+  def testCompileTemplatesOnlyCompilesTemplatesDirectory(self,
+                                                        mock_compile_templates):
+    """Test only the templates directory is compiled, as plain modules."""
+    appengine_config.CompileTemplates('fake target')
+
+    args, kwargs = mock_compile_templates.call_args
+    self.assertEqual(args, ('fake target',))
+    self.assertIsNone(kwargs['zip'])
+    self.assertFalse(kwargs['ignore_errors'])
+    self.assertTrue(kwargs['filter_func']('templates/user.html'))
+    self.assertFalse(kwargs['filter_func']('lib/some_package/page.html'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,35 @@
+"""Compile every template into a python module ahead of deploying.
+
+Production instances load templates from these modules rather than parsing
+and compiling the template sources themselves. The modules are only good
+for the templates they were compiled from, so they are rebuilt from scratch
+on every deploy.
+
+Usage: python compile_templates.py
+"""
+
+import os
+import shutil
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+  """Replace the compiled templates with freshly compiled ones."""
+  from google.appengine.ext import testbed
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_app_identity_stub()
+  bed.init_memcache_stub()
+
+  import appengine_config
+  target = appengine_config.COMPILED_TEMPLATES_DIR
+  if os.path.isdir(target):
+    shutil.rmtree(target)
+  appengine_config.CompileTemplates(target)
+  print 'Compiled %d templates into %s' % (len(os.listdir(target)), target)
+
+
+if __name__ == '__main__':
+  main()
@@ -5,12 +5,21 @@ PATHS = {
     'user_page_path': '/user',
 
     'user_add_path': '/user/add',
+    'user_add_job_path': '/user/addJob',
+    'user_add_job_status_path': '/user/addJob/status',
     'user_delete_path': '/user/delete',
     'user_details_path': '/user/details',
     'user_get_invite_code_path': '/user/getInviteCode',
     'user_get_new_key_pair_path': '/user/getNewKeyPair',
+    'user_reconcile_path': '/user/reconcile',
+    'user_reconcile_job_path': '/user/reconcileJob',
+    'user_reconcile_job_status_path': '/user/reconcileJob/status',
     'user_toggle_revoked_path': '/user/toggleRevoked',
 
+    'cron_user_refill_key_pair_pool': '/cron/user/refillkeypairs',
+    'cron_user_add_users_chunk': '/cron/user/adduserschunk',
+    'cron_user_reconcile_users': '/cron/user/reconcileusers',
+
     'setup_oauth_path': '/setup',
 
     'proxy_server_add': '/proxyserver/add',
@@ -19,6 +28,7 @@ PATHS = {
     'proxy_server_list': '/proxyserver/list',
 
     'cron_proxy_server_distribute_key': '/cron/proxyserver/distributekey',
+    'cron_proxy_server_rebuild_key_bundle': '/cron/proxyserver/rebuildkeys',
 
     'receive_push_notifications': '/receive',
     'sync_top_level_path': '/sync',
@@ -27,6 +37,18 @@ PATHS = {
     'watch_for_user_deletion': '/sync/delete',
     'unsubscribe_from_notifications': '/sync/unsubscribe',
 
+    'cron_sync_store_notifications': '/cron/sync/storenotifications',
+
     'logout': '/logout',
+
+    'warmup': '/_ah/warmup',
 }
 
+# Number of pre-generated key pairs kept ready for new users and rotations.
+KEY_PAIR_POOL_SIZE = 100
+
+# Type of key pair given to new users and rotations, either 'ssh-rsa' or
+# 'ssh-ed25519'. Ed25519 keys are far faster to generate and far smaller, but
+# need proxy servers and clients which accept them. Existing users keep their
+# key type until their key is rotated, so the types can be mixed.
+USER_KEY_TYPE = 'ssh-rsa'
@@ -4,12 +4,48 @@ TODO(henry): Refactor the common methods (get, insert, delete) into base class.
 """
 
 import base64
+import datetime
 import hashlib
-
+import itertools
+import json
+import logging
+import os
+import time
+
+from config import PATHS
+from config import USER_KEY_TYPE
 from Crypto.PublicKey import RSA
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
+import ssh_ed25519
+
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None
+
+
+def _CanUseProcesses():
+  """Check whether worker processes can be started here.
+
+  The App Engine sandbox, including the development server, does not allow
+  starting processes, but scripts and tests run outside of it may.
+  """
+  server_software = os.environ.get('SERVER_SOFTWARE', '')
+  return multiprocessing is not None and not (
+      server_software.startswith('Google App Engine') or
+      server_software.startswith('Development'))
+
+
+def _GenerateKeyPairInProcess(_):
+  """Generate a key pair in a worker process.
+
+  This lives at the module level so that worker processes can find it.
+  """
+  return User._GenerateKeyPair()  # pylint: disable=protected-access
 
 
 class BaseModel(ndb.Model):
@@ -104,11 +140,43 @@ class User(BaseModel):
 
   """Datastore service to handle dasher users."""
 
+  KEY_TYPE_RSA = 'ssh-rsa'
+  KEY_TYPE_ED25519 = ssh_ed25519.KEY_TYPE
+  # Users removed together when reconciling with the directory.
+  REMOVE_BATCH_SIZE = 500
+  # Users written in one transaction along with a shard of the key change log,
+  # which stays within the limit of 25 entity groups per transaction.
+  WRITE_BATCH_SIZE = 24
+
   email = ndb.StringProperty()
   name = ndb.StringProperty()
   private_key = ndb.TextProperty()
-  public_key = ndb.TextProperty()
+  # Indexed so that the key bundle can be built with a projection query.
+  public_key = ndb.StringProperty()
+  # Users keep the type of key they were given, so types can be mixed.
+  key_type = ndb.StringProperty(default=KEY_TYPE_RSA)
   is_key_revoked = ndb.BooleanProperty()
+  # Digest of the directory fields last reconciled, see MakeFingerprint.
+  directory_fingerprint = ndb.StringProperty(indexed=False)
+  # Whether the user was added from the directory rather than by hand. Users
+  # added before this was recorded have None and count as directory users,
+  # since the directory was the only way to add many users.
+  from_directory = ndb.BooleanProperty(indexed=False)
+  # Ip address of the proxy server the user's latest invite code points at,
+  # or None if the code predates its key pair or was never recorded.
+  invite_code_host = ndb.StringProperty(indexed=False)
+
+  @staticmethod
+  def GetKeyForEmail(email):
+    """Get the datastore key of the user with the given email.
+
+    Args:
+      email: The primary email address of the user.
+
+    Returns:
+      An ndb.Key for the user, whether or not the user exists.
+    """
+    return ndb.Key(User, hashlib.sha256(email).hexdigest())
 
   @staticmethod
   def _CreateUser(directory_user, key_pair):
@@ -116,39 +184,173 @@ class User(BaseModel):
 
     Args:
       directory_user: A dictionary of the dasher user.
-      key_pair: A dictionary with private_key and public_key in b64 value.
+      key_pair: A dictionary with private_key, public_key and key_type.
 
     Returns:
       user_entity: An appengine datastore entity of the user.
     """
     email = directory_user['primaryEmail']
-    user_key = ndb.Key(User, hashlib.sha256(email).hexdigest())
+    user_key = User.GetKeyForEmail(email)
     user_entity = User(key=user_key,
                        email=directory_user['primaryEmail'],
                        name=directory_user['name']['fullName'],
                        public_key=key_pair['public_key'],
                        private_key=key_pair['private_key'],
+                       key_type=key_pair.get('key_type', User.KEY_TYPE_RSA),
                        is_key_revoked=False)
     return user_entity
 
+  @staticmethod
+  def _WriteUsers(writes):
+    """Write users along with their key changes, then push the changes out.
+
+    Users whose key changes are written in the same transaction as the log
+    entries for those changes, so that a change is never made without being
+    logged or logged without being made. The entries go to the shard of the
+    log for the user's email rather than the log itself, so users in
+    different shards never contend, and each transaction holds up to
+    WRITE_BATCH_SIZE users of a single shard. Users whose key does not change
+    are written in bulk.
+
+    Args:
+      writes: A list of (key, user, changes) tuples in order, where user is
+          the User entity to put or None to delete the user with that key,
+          and changes is a list of the (action, email, public_key, key_type)
+          tuples it makes.
+    """
+    unlogged = [(key, user) for key, user, changes in writes if not changes]
+    ndb.put_multi([user for _, user in unlogged if user is not None])
+    ndb.delete_multi([key for key, user in unlogged if user is None])
+
+    @ndb.transactional(xg=True)
+    def _WriteBatch(shard_key, batch):
+      """Write a batch of users and log their key changes atomically."""
+      ndb.put_multi([user for _, user, _ in batch if user is not None])
+      ndb.delete_multi([key for key, user, _ in batch if user is None])
+      KeyChangeLog.Append(shard_key, [change for _, _, changes in batch
+                                      for change in changes])
+
+    writes_by_shard = {}
+    for write in writes:
+      if write[2]:
+        shard_key = KeyChangeLog.GetShardKey(write[2][0][1])
+        writes_by_shard.setdefault(shard_key, []).append(write)
+    for shard_key, shard_writes in writes_by_shard.iteritems():
+      for start in range(0, len(shard_writes), User.WRITE_BATCH_SIZE):
+        _WriteBatch(shard_key,
+                    shard_writes[start:start + User.WRITE_BATCH_SIZE])
+    if writes_by_shard:
+      KeyChangeLog.ScheduleDistribution()
+
   @staticmethod
   def _GenerateKeyPair():
-    """Generate a private and public key pair in base64.
+    """Generate a private and public key pair of the configured type.
+
+    RSA keys are stored as base64 of their PEM encoding. Ed25519 keys are
+    much faster to generate and much smaller. Their private key is stored as
+    base64 of an OpenSSH private key file and their public key is the key
+    blob which follows the type in an authorized_keys line.
 
     Returns:
-      key_pair: A dictionary with private_key and public_key in b64 value.
+      key_pair: A dictionary with private_key, public_key and key_type.
     """
+    if USER_KEY_TYPE == User.KEY_TYPE_ED25519:
+      private_key, public_key = ssh_ed25519.GenerateKeyPair()
+      return {
+          'private_key': base64.urlsafe_b64encode(private_key),
+          'public_key': public_key,
+          'key_type': User.KEY_TYPE_ED25519,
+      }
+
     rsa_key = RSA.generate(2048)
     private_key = base64.urlsafe_b64encode(rsa_key.exportKey())
     public_key = base64.urlsafe_b64encode(rsa_key.publickey().exportKey())
 
     key_pair = {
         'private_key': private_key,
-        'public_key': public_key
+        'public_key': public_key,
+        'key_type': User.KEY_TYPE_RSA,
     }
 
     return key_pair
 
+  @staticmethod
+  def _GenerateKeyPairsInProcesses(count):
+    """Generate key pairs in parallel across all of the available cores.
+
+    Args:
+      count: The number of key pairs to generate.
+
+    Returns:
+      key_pairs: A list of count dictionaries with private_key, public_key and
+          key_type, or None if worker processes cannot be used here.
+    """
+    if not _CanUseProcesses():
+      return None
+    try:
+      process_pool = multiprocessing.Pool()
+    except (ImportError, NotImplementedError, OSError) as error:
+      logging.info('Unable to start worker processes: %s', error)
+      return None
+    try:
+      return process_pool.map(_GenerateKeyPairInProcess, range(count))
+    finally:
+      process_pool.close()
+      process_pool.join()
+
+  @staticmethod
+  def _GenerateKeyPairsWithTasks(count):
+    """Generate key pairs in parallel across tasks as well as inline.
+
+    Where worker processes are not allowed, the work is fanned out to tasks
+    which add key pairs to the pool, while this request keeps generating key
+    pairs itself and claiming any the tasks have already finished.
+
+    Args:
+      count: The number of key pairs to generate.
+
+    Returns:
+      key_pairs: A list of count dictionaries with private_key, public_key and
+          key_type.
+    """
+    KeyPair.ScheduleGeneration(count)
+    key_pairs = []
+    while len(key_pairs) < count:
+      key_pairs += KeyPair.Claim(count - len(key_pairs))
+      if len(key_pairs) < count:
+        key_pairs.append(User._GenerateKeyPair())
+    return key_pairs
+
+  @staticmethod
+  def _GetKeyPairs(count):
+    """Get new key pairs, from the pool where possible.
+
+    Key pairs are claimed from the pre-generated pool, and any shortfall is
+    generated in parallel so that users are never left without a key. The
+    pool is scheduled to be refilled either way.
+
+    Args:
+      count: The number of key pairs needed.
+
+    Returns:
+      key_pairs: A list of count dictionaries with private_key, public_key and
+          key_type.
+    """
+    key_pairs = KeyPair.Claim(count)
+    missing = count - len(key_pairs)
+    if missing:
+      logging.warning('Key pair pool ran out, generating %d key pairs.',
+                      missing)
+    if missing == 1:
+      key_pairs.append(User._GenerateKeyPair())
+    elif missing > 1:
+      generated = User._GenerateKeyPairsInProcesses(missing)
+      if generated is None:
+        generated = User._GenerateKeyPairsWithTasks(missing)
+      key_pairs += generated
+    KeyPair.ScheduleRefill()
+    return key_pairs
+
   @staticmethod
   def UpdateKeyPair(key):
     """Update an existing appengine datastore user entity with a new key pair.
@@ -157,9 +359,27 @@ class User(BaseModel):
       key: A user's key in order to find the user's datastore entity.
     """
     user = User.GetByKey(key)
-    key_pair = User._GenerateKeyPair()
+    key_pair = User._GetKeyPairs(1)[0]
     user.public_key = key_pair['public_key']
     user.private_key = key_pair['private_key']
+    user.key_type = key_pair.get('key_type', User.KEY_TYPE_RSA)
+    # Invite codes carry the private key, so earlier ones no longer work.
+    user.invite_code_host = None
+    changes = []
+    if not user.is_key_revoked:
+      changes.append(KeyChange.FromUser(KeyChange.ADD, user))
+    User._WriteUsers([(user.key, user, changes)])
+
+  @staticmethod
+  def SetInviteCodeHost(entity_key, host):
+    """Record the proxy server which the user's latest invite code points at.
+
+    Args:
+      entity_key: A user's key in order to find the user's datastore entity.
+      host: The ip address of the proxy server in the invite code.
+    """
+    user = User.GetByKey(entity_key)
+    user.invite_code_host = host
     user.put()
 
   @staticmethod
@@ -171,31 +391,668 @@ class User(BaseModel):
     """
     user = User.GetByKey(entity_key)
     user.is_key_revoked = not user.is_key_revoked
-    user.put()
+    action = KeyChange.REMOVE if user.is_key_revoked else KeyChange.ADD
+    User._WriteUsers([(user.key, user, [KeyChange.FromUser(action, user)])])
 
   @staticmethod
-  def InsertUser(directory_user, key_pair):
+  def InsertUser(directory_user, key_pair, from_directory=True):
     """Insert a user into datastore.
 
     Args:
       directory_user: A dictionary of the dasher user.
-      key_pair: A dictionary with private_key and public_key in b64 value.
+      key_pair: A dictionary with private_key, public_key and key_type.
+      from_directory: Whether the user comes from the directory, as opposed
+          to being entered by hand.
     """
     user = User._CreateUser(directory_user, key_pair)
-    user.put()
+    user.from_directory = from_directory
+    User._WriteUsers([(user.key, user,
+                       [KeyChange.FromUser(KeyChange.ADD, user)])])
 
   @staticmethod
-  def InsertUsers(directory_users):
+  def InsertUsers(directory_users, from_directory=True):
     """Insert users into datastore.
 
     Args:
       directory_users: A list of dasher users.
+      from_directory: Whether the users come from the directory, as opposed
+          to being entered by hand.
+    """
+    key_pairs = User._GetKeyPairs(len(directory_users))
+    writes = []
+    for directory_user, key_pair in zip(directory_users, key_pairs):
+      user_entity = User._CreateUser(directory_user, key_pair)
+      user_entity.from_directory = from_directory
+      writes.append((user_entity.key, user_entity,
+                     [KeyChange.FromUser(KeyChange.ADD, user_entity)]))
+    User._WriteUsers(writes)
+
+  @staticmethod
+  def MakeFingerprint(directory_user):
+    """Make a digest of the directory fields which reconciliation compares.
+
+    Args:
+      directory_user: A dictionary of the dasher user, with at least the
+          fields in RECONCILE_USER_FIELDS.
+
+    Returns:
+      A hex string which changes whenever any of the fields change.
+    """
+    fields = [
+        directory_user['primaryEmail'],
+        directory_user.get('name', {}).get('fullName', ''),
+        str(directory_user.get('suspended', False)),
+        directory_user.get('etag', ''),
+    ]
+    return hashlib.sha1(u'\n'.join(fields).encode('utf-8')).hexdigest()
+
+  @staticmethod
+  def ReconcileBatch(directory_users, add_new):
+    """Bring the users in the datastore in line with a batch of the directory.
+
+    Users whose fingerprint is unchanged are not written at all. Changed
+    users get their name updated, and suspended users get their key revoked.
+    Unsuspending a user does not restore its key, since it may have been
+    revoked by hand. Existing users keep their keys either way.
+
+    Args:
+      directory_users: A list of dasher users with at least the fields in
+          RECONCILE_USER_FIELDS.
+      add_new: Whether to add directory users which are not in the datastore.
+
+    Returns:
+      A tuple of the list of keys of the directory users, and a dictionary of
+      the number of users 'added', 'updated' and 'unchanged'.
+    """
+    keys = [User.GetKeyForEmail(directory_user['primaryEmail'])
+            for directory_user in directory_users]
+    counts = {'added': 0, 'updated': 0, 'unchanged': 0}
+    writes = []
+    new_directory_users = []
+    for directory_user, user in zip(directory_users, ndb.get_multi(keys)):
+      fingerprint = User.MakeFingerprint(directory_user)
+      if user is None:
+        if add_new and not directory_user.get('suspended', False):
+          new_directory_users.append((directory_user, fingerprint))
+        continue
+      if user.directory_fingerprint == fingerprint:
+        counts['unchanged'] += 1
+        continue
+      user.name = directory_user.get('name', {}).get('fullName', user.name)
+      changes = []
+      if directory_user.get('suspended', False) and not user.is_key_revoked:
+        user.is_key_revoked = True
+        changes.append(KeyChange.FromUser(KeyChange.REMOVE, user))
+      user.directory_fingerprint = fingerprint
+      writes.append((user.key, user, changes))
+    counts['updated'] = len(writes)
+
+    if new_directory_users:
+      key_pairs = User._GetKeyPairs(len(new_directory_users))
+      for (directory_user, fingerprint), key_pair in zip(new_directory_users,
+                                                         key_pairs):
+        user = User._CreateUser(directory_user, key_pair)
+        user.directory_fingerprint = fingerprint
+        user.from_directory = True
+        writes.append((user.key, user,
+                       [KeyChange.FromUser(KeyChange.ADD, user)]))
+    counts['added'] = len(new_directory_users)
+
+    User._WriteUsers(writes)
+    return keys, counts
+
+  @staticmethod
+  def RemoveUnlistedDirectoryUsers(listed_keys):
+    """Remove every user from the directory whose key is not given.
+
+    Only users which came from the directory are removed. Users added by hand
+    are kept whether or not they are in the directory listing.
+
+    Args:
+      listed_keys: A set of the keys of the users in the directory listing.
+
+    Returns:
+      The number of users removed.
+    """
+    unlisted_keys = [key for key in User.query().iter(keys_only=True)
+                     if key not in listed_keys]
+    removed = 0
+    for start in range(0, len(unlisted_keys), User.REMOVE_BATCH_SIZE):
+      batch_keys = unlisted_keys[start:start + User.REMOVE_BATCH_SIZE]
+      writes = []
+      for key, user in zip(batch_keys, ndb.get_multi(batch_keys)):
+        if user is None or user.from_directory is False:
+          continue
+        changes = []
+        if not user.is_key_revoked:
+          changes.append(KeyChange.FromUser(KeyChange.REMOVE, user))
+        writes.append((key, None, changes))
+      User._WriteUsers(writes)
+      removed += len(writes)
+    return removed
+
+  @staticmethod
+  def ApplyNotifications(notifications):
+    """Apply directory notifications about users to the matching users.
+
+    Deleted users are removed, updates change the name of existing users, and
+    undeleted users are added back with new keys if a delete of theirs was
+    applied before. Users not in the datastore are left alone otherwise, as
+    are renamed users, since their notification only has the new email.
+    Applying a notification again has no further effect.
+
+    Notifications which changed a user are marked as applied, and deletes
+    record the name of the deleted user. The notifications are stored before
+    the users are written, so that if writing the users fails part way the
+    notifications applied are not lost when they are applied again. A
+    notification already stored as applied stays applied.
+
+    Args:
+      notifications: A list of Notification entities, in the order they were
+          sent.
     """
-    user_entities = []
-    for directory_user in directory_users:
-      key_pair = User._GenerateKeyPair()
-      user_entities.append(User._CreateUser(directory_user, key_pair))
-    ndb.put_multi(user_entities)
+    keys = []
+    for notification in notifications:
+      key = User.GetKeyForEmail(notification.email)
+      if key not in keys:
+        keys.append(key)
+    original_users = dict(zip(keys, ndb.get_multi(keys)))
+    users = dict(original_users)
+    changed_keys = []
+    deleted_names = {}
+
+    for notification in notifications:
+      key = User.GetKeyForEmail(notification.email)
+      user = users[key]
+      if notification.state == 'delete' and user is not None:
+        users[key] = None
+        notification.name = user.name
+        deleted_names[notification.uuid] = user.name
+      elif (notification.state == 'update' and user is not None and
+            notification.name and notification.name != user.name):
+        user.name = notification.name
+      elif notification.state == 'undelete' and user is None:
+        if notification.uuid in deleted_names:
+          name = deleted_names[notification.uuid]
+        else:
+          name = Notification.GetDeletedName(notification.uuid)
+        if name is None:
+          continue
+        users[key] = User(key=key, email=notification.email,
+                          name=notification.name or name,
+                          is_key_revoked=False, from_directory=True)
+      else:
+        continue
+      notification.applied = True
+      if key not in changed_keys:
+        changed_keys.append(key)
+
+    added_users = [users[key] for key in changed_keys
+                   if users[key] is not None and
+                   users[key] is not original_users[key]]
+    if added_users:
+      key_pairs = User._GetKeyPairs(len(added_users))
+      for user, key_pair in zip(added_users, key_pairs):
+        user.public_key = key_pair['public_key']
+        user.private_key = key_pair['private_key']
+        user.key_type = key_pair.get('key_type', User.KEY_TYPE_RSA)
+
+    stored_notifications = ndb.get_multi(
+        [notification.key for notification in notifications
+         if notification.key is not None])
+    applied_names = dict((stored.key, stored.name)
+                         for stored in stored_notifications
+                         if stored is not None and stored.applied)
+    for notification in notifications:
+      if notification.key in applied_names and not notification.applied:
+        notification.applied = True
+        notification.name = applied_names[notification.key]
+    ndb.put_multi(notifications)
+
+    # Users deleted and added back in the same batch are overwritten instead.
+    writes = []
+    for key in changed_keys:
+      original_user = original_users[key]
+      user = users[key]
+      changes = []
+      if (original_user is not None and user is not original_user and
+          not original_user.is_key_revoked):
+        changes.append(KeyChange.FromUser(KeyChange.REMOVE, original_user))
+      if user is not None and user is not original_user:
+        changes.append(KeyChange.FromUser(KeyChange.ADD, user))
+      writes.append((key, user, changes))
+    User._WriteUsers(writes)
+
+  @classmethod
+  def DeleteByKey(cls, url_key):
+    """Delete a user from the datastore and log the removal of its key.
+
+    Args:
+      cls is an object that holds the sub-class itself, not an instance
+      of the sub-class.
+      url_key: The url encoded key for a user in the datastore.
+    """
+    user = User.GetByKey(url_key)
+    if user is None:
+      return
+    changes = []
+    if not user.is_key_revoked:
+      changes.append(KeyChange.FromUser(KeyChange.REMOVE, user))
+    User._WriteUsers([(user.key, None, changes)])
+
+
+class KeyPair(BaseModel):
+
+  """Store a pre-generated key pair waiting to be given to a user.
+
+  Generating a key pair is CPU bound and slow, so a stock of them is kept
+  ready by a background refill and claimed by user creation and rotation.
+  Each key pair is its own entity group so that concurrent claims of
+  different key pairs never contend.
+  """
+
+  REFILL_QUEUE = 'key-pair-pool'
+  REFILL_DELAY = 5
+  GENERATION_QUEUE = 'key-pair-generation'
+  # Key pairs generated by each task when generation is fanned out.
+  GENERATION_TASK_SIZE = 5
+  # Tasks which can be added to a queue in a single call.
+  TASK_BATCH_SIZE = 100
+  # Claims are batched into cross-group transactions, which span at most 25.
+  CLAIM_BATCH_SIZE = 25
+  PUT_BATCH_SIZE = 10
+  # Seconds a single refill keeps generating before handing over to the next.
+  REFILL_TIME_LIMIT = 300
+
+  private_key = ndb.TextProperty()
+  public_key = ndb.TextProperty()
+  # Indexed so that only key pairs of the configured type are claimed.
+  key_type = ndb.StringProperty(default=User.KEY_TYPE_RSA)
+
+  @staticmethod
+  def _QueryConfiguredType():
+    """Query the key pairs of the type new users are given."""
+    return KeyPair.query(KeyPair.key_type == USER_KEY_TYPE)
+
+  @staticmethod
+  def Claim(count):
+    """Take up to count key pairs of the configured type out of the pool.
+
+    Each key pair is deleted in the same transaction that reads it, so a key
+    pair is never handed to two users even if claims race. Key pairs left
+    over from before the configured type changed are never claimed.
+
+    Args:
+      count: The number of key pairs wanted.
+
+    Returns:
+      key_pairs: A list of at most count dictionaries with private_key,
+          public_key and key_type.
+    """
+    @ndb.transactional(xg=True)
+    def _ClaimBatch(batch_keys):
+      """Claim the key pairs in a batch which are still in the pool."""
+      entities = [entity for entity in ndb.get_multi(batch_keys)
+                  if entity is not None]
+      ndb.delete_multi([entity.key for entity in entities])
+      return entities
+
+    key_pairs = []
+    while len(key_pairs) < count:
+      keys = KeyPair._QueryConfiguredType().fetch(count - len(key_pairs),
+                                                  keys_only=True)
+      claimed = []
+      for start in range(0, len(keys), KeyPair.CLAIM_BATCH_SIZE):
+        claimed += _ClaimBatch(keys[start:start + KeyPair.CLAIM_BATCH_SIZE])
+      # Stop once the pool is empty, or the query only found key pairs which
+      # were already claimed but are still in the index.
+      if not claimed:
+        break
+      for entity in claimed:
+        key_pairs.append({
+            'private_key': entity.private_key,
+            'public_key': entity.public_key,
+            'key_type': entity.key_type,
+        })
+    return key_pairs
+
+  @staticmethod
+  def ScheduleRefill():
+    """Schedule a refill of the pool shortly.
+
+    All claims within the same REFILL_DELAY second window share one named
+    task, so a burst of claims results in a single refill.
+    """
+    window = int(time.time() / KeyPair.REFILL_DELAY)
+    try:
+      taskqueue.add(queue_name=KeyPair.REFILL_QUEUE,
+                    name='refill-key-pairs-%d' % window,
+                    url=PATHS['cron_user_refill_key_pair_pool'],
+                    method='GET',
+                    countdown=KeyPair.REFILL_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      logging.debug('Key pair refill already scheduled for this window.')
+
+  @staticmethod
+  def ScheduleGeneration(count):
+    """Fan the generation of key pairs for the pool out across tasks.
+
+    Args:
+      count: The number of key pairs to generate.
+    """
+    tasks = []
+    for start in range(0, count, KeyPair.GENERATION_TASK_SIZE):
+      task_size = min(KeyPair.GENERATION_TASK_SIZE, count - start)
+      tasks.append(taskqueue.Task(url=PATHS['cron_user_refill_key_pair_pool'],
+                                  method='GET',
+                                  params={'count': task_size}))
+    queue = taskqueue.Queue(KeyPair.GENERATION_QUEUE)
+    for start in range(0, len(tasks), KeyPair.TASK_BATCH_SIZE):
+      queue.add(tasks[start:start + KeyPair.TASK_BATCH_SIZE])
+
+  @staticmethod
+  def _AddGenerated(count):
+    """Generate key pairs and add them to the pool.
+
+    Args:
+      count: The number of key pairs to generate.
+    """
+    # pylint: disable=protected-access
+    key_pairs = User._GenerateKeyPairsInProcesses(count)
+    if key_pairs is None:
+      key_pairs = [User._GenerateKeyPair() for _ in range(count)]
+    ndb.put_multi([KeyPair(private_key=key_pair['private_key'],
+                           public_key=key_pair['public_key'],
+                           key_type=key_pair.get('key_type',
+                                                 User.KEY_TYPE_RSA))
+                   for key_pair in key_pairs])
+
+  @staticmethod
+  def Generate(count):
+    """Add a number of new key pairs to the pool regardless of its stock.
+
+    Args:
+      count: The number of key pairs to add.
+    """
+    for start in range(0, count, KeyPair.PUT_BATCH_SIZE):
+      KeyPair._AddGenerated(min(KeyPair.PUT_BATCH_SIZE, count - start))
+
+  @staticmethod
+  def Refill(stock):
+    """Generate key pairs until the pool holds the stock of the configured type.
+
+    Key pairs are stored PUT_BATCH_SIZE at a time so that they become
+    claimable while the rest are generated. If the stock is not reached
+    within REFILL_TIME_LIMIT another refill is scheduled to carry on.
+
+    Args:
+      stock: The number of key pairs the pool should hold.
+
+    Returns:
+      The number of key pairs added to the pool.
+    """
+    stop_time = time.time() + KeyPair.REFILL_TIME_LIMIT
+    missing = stock - KeyPair._QueryConfiguredType().count()
+    added = 0
+    while added < missing:
+      if time.time() > stop_time:
+        KeyPair.ScheduleRefill()
+        break
+      batch_size = min(KeyPair.PUT_BATCH_SIZE, missing - added)
+      KeyPair._AddGenerated(batch_size)
+      added += batch_size
+    return added
+
+
+class AddUsersChunk(BaseModel):
+
+  """Store a chunk of the directory users selected for a bulk add.
+
+  Chunks are children of their AddUsersJob, with ids counting up from 1.
+  """
+
+  directory_users = ndb.JsonProperty(compressed=True)
+  num_users = ndb.IntegerProperty(indexed=False)
+  is_done = ndb.BooleanProperty(default=False, indexed=False)
+
+
+class AddUsersJob(BaseModel):
+
+  """Track the progress of adding a selection of users in the background.
+
+  The selection is split into chunks of CHUNK_SIZE users, which are stored
+  along with the job so that the work survives instance restarts. Each chunk
+  is added by its own task and marked done in the same transaction which
+  updates the job's progress, so a retried task never counts a chunk twice.
+  Users which already exist are skipped, so a task retried after adding its
+  users does not give them new keys.
+  """
+
+  QUEUE = 'add-users'
+  CHUNK_SIZE = 50
+  # Tasks which can be added to a queue in a single call.
+  TASK_BATCH_SIZE = 100
+  STATUS_RUNNING = 'running'
+  STATUS_DONE = 'done'
+
+  num_users = ndb.IntegerProperty(indexed=False)
+  num_chunks = ndb.IntegerProperty(indexed=False)
+  added_users = ndb.IntegerProperty(default=0, indexed=False)
+  done_chunks = ndb.IntegerProperty(default=0, indexed=False)
+  created = ndb.DateTimeProperty(auto_now_add=True)
+  updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+  @property
+  def status(self):
+    """Get whether the job is still running or done."""
+    if self.done_chunks >= self.num_chunks:
+      return AddUsersJob.STATUS_DONE
+    return AddUsersJob.STATUS_RUNNING
+
+  def ToDict(self):
+    """Get the progress of the job as a json serializable dictionary."""
+    return {
+        'id': self.key.id(),
+        'status': self.status,
+        'num_users': self.num_users,
+        'added_users': self.added_users,
+        'num_chunks': self.num_chunks,
+        'done_chunks': self.done_chunks,
+    }
+
+  @staticmethod
+  def Start(directory_users):
+    """Store the selected users in chunks and queue a task per chunk.
+
+    Args:
+      directory_users: A list of dasher users to add.
+
+    Returns:
+      The new AddUsersJob entity.
+    """
+    job_id = AddUsersJob.allocate_ids(1)[0]
+    job_key = ndb.Key(AddUsersJob, job_id)
+    chunks = []
+    for start in range(0, len(directory_users), AddUsersJob.CHUNK_SIZE):
+      chunk_users = directory_users[start:start + AddUsersJob.CHUNK_SIZE]
+      chunks.append(AddUsersChunk(parent=job_key, id=len(chunks) + 1,
+                                  directory_users=chunk_users,
+                                  num_users=len(chunk_users)))
+    job = AddUsersJob(key=job_key, num_users=len(directory_users),
+                      num_chunks=len(chunks))
+    ndb.put_multi([job] + chunks)
+
+    tasks = [taskqueue.Task(url=PATHS['cron_user_add_users_chunk'],
+                            method='GET',
+                            params={'job': job_id, 'chunk': chunk.key.id()})
+             for chunk in chunks]
+    queue = taskqueue.Queue(AddUsersJob.QUEUE)
+    for start in range(0, len(tasks), AddUsersJob.TASK_BATCH_SIZE):
+      queue.add(tasks[start:start + AddUsersJob.TASK_BATCH_SIZE])
+    return job
+
+  @staticmethod
+  def ProcessChunk(job_id, chunk_id):
+    """Add the users in one chunk of a job and record the progress.
+
+    Args:
+      job_id: The integer id of the AddUsersJob.
+      chunk_id: The integer id of the AddUsersChunk within the job.
+
+    Returns:
+      The number of users added, which is 0 if the chunk was already done.
+    """
+    job_key = ndb.Key(AddUsersJob, job_id)
+    chunk_key = ndb.Key(AddUsersChunk, chunk_id, parent=job_key)
+    chunk = chunk_key.get()
+    if chunk is None or chunk.is_done:
+      return 0
+    existing_users = ndb.get_multi([
+        User.GetKeyForEmail(directory_user['primaryEmail'])
+        for directory_user in chunk.directory_users])
+    new_directory_users = [
+        directory_user for directory_user, user
+        in zip(chunk.directory_users, existing_users) if user is None]
+    if new_directory_users:
+      User.InsertUsers(new_directory_users)
+
+    @ndb.transactional
+    def _MarkDone():
+      """Mark the chunk done and count it towards the job's progress."""
+      job, chunk = ndb.get_multi([job_key, chunk_key])
+      if chunk.is_done:
+        return 0
+      chunk.is_done = True
+      # The users are no longer needed once they are in the datastore.
+      chunk.directory_users = []
+      job.done_chunks += 1
+      job.added_users += chunk.num_users
+      ndb.put_multi([job, chunk])
+      return chunk.num_users
+
+    return _MarkDone()
+
+
+class ReconcileJob(BaseModel):
+
+  """Track a reconciliation of the users in the datastore with the directory.
+
+  The directory is listed one page at a time by a single task, which compares
+  each page with the datastore and writes only the differences. Users which
+  were not listed are only removed once the whole directory was listed.
+  """
+
+  QUEUE = 'reconcile-users'
+  # Directory users compared with the datastore together.
+  BATCH_SIZE = 500
+  STATUS_RUNNING = 'running'
+  STATUS_DONE = 'done'
+  STATUS_FAILED = 'failed'
+
+  # The user whose stored credentials are used to list the directory.
+  user_id = ndb.StringProperty(indexed=False)
+  add_new = ndb.BooleanProperty(default=False, indexed=False)
+  status = ndb.StringProperty(default=STATUS_RUNNING, indexed=False)
+  error = ndb.TextProperty()
+  added_users = ndb.IntegerProperty(default=0, indexed=False)
+  updated_users = ndb.IntegerProperty(default=0, indexed=False)
+  removed_users = ndb.IntegerProperty(default=0, indexed=False)
+  unchanged_users = ndb.IntegerProperty(default=0, indexed=False)
+  # Seconds spent waiting on the directory, on the datastore, and in total.
+  directory_seconds = ndb.FloatProperty(default=0.0, indexed=False)
+  datastore_seconds = ndb.FloatProperty(default=0.0, indexed=False)
+  total_seconds = ndb.FloatProperty(default=0.0, indexed=False)
+  created = ndb.DateTimeProperty(auto_now_add=True)
+  updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+  def ToDict(self):
+    """Get the summary of the job as a json serializable dictionary."""
+    return {
+        'id': self.key.id(),
+        'status': self.status,
+        'error': self.error,
+        'added_users': self.added_users,
+        'updated_users': self.updated_users,
+        'removed_users': self.removed_users,
+        'unchanged_users': self.unchanged_users,
+        'directory_seconds': round(self.directory_seconds, 1),
+        'datastore_seconds': round(self.datastore_seconds, 1),
+        'total_seconds': round(self.total_seconds, 1),
+    }
+
+  @staticmethod
+  def Start(user_id, add_new):
+    """Store a new job and queue the task which runs it.
+
+    Args:
+      user_id: The id of the user starting the job, whose stored credentials
+          are used to list the directory.
+      add_new: Whether to add directory users which are not in the datastore.
+
+    Returns:
+      The new ReconcileJob entity.
+    """
+    job = ReconcileJob(user_id=user_id, add_new=add_new)
+    job.put()
+    taskqueue.add(queue_name=ReconcileJob.QUEUE,
+                  url=PATHS['cron_user_reconcile_users'],
+                  method='GET',
+                  params={'job': job.key.id()})
+    return job
+
+  def Run(self, directory_users):
+    """Reconcile the datastore with the directory and record the summary.
+
+    A retried run starts over, which is cheap since users reconciled by the
+    earlier run are now unchanged.
+
+    Args:
+      directory_users: An iterable of every dasher user in the directory, with
+          at least the fields in RECONCILE_USER_FIELDS.
+    """
+    start_time = time.time()
+    self.status = ReconcileJob.STATUS_RUNNING
+    self.added_users = 0
+    self.updated_users = 0
+    self.removed_users = 0
+    self.unchanged_users = 0
+    self.directory_seconds = 0.0
+    self.datastore_seconds = 0.0
+    listed_keys = set()
+    directory_users = iter(directory_users)
+    while True:
+      batch_start_time = time.time()
+      batch = list(itertools.islice(directory_users, ReconcileJob.BATCH_SIZE))
+      self.directory_seconds += time.time() - batch_start_time
+      if not batch:
+        break
+      batch_start_time = time.time()
+      keys, counts = User.ReconcileBatch(batch, self.add_new)
+      listed_keys.update(keys)
+      self.added_users += counts['added']
+      self.updated_users += counts['updated']
+      self.unchanged_users += counts['unchanged']
+      self.total_seconds = time.time() - start_time
+      self.put()
+      self.datastore_seconds += time.time() - batch_start_time
+
+    batch_start_time = time.time()
+    self.removed_users = User.RemoveUnlistedDirectoryUsers(listed_keys)
+    self.datastore_seconds += time.time() - batch_start_time
+    self.status = ReconcileJob.STATUS_DONE
+    self.total_seconds = time.time() - start_time
+    self.put()
+    logging.info('Reconciled users with the directory: %s', self.ToDict())
+
+  def Fail(self, error):
+    """Record that the job could not be finished.
+
+    Args:
+      error: The exception which stopped the job.
+    """
+    self.status = ReconcileJob.STATUS_FAILED
+    self.error = str(error)
+    self.put()
 
 
 class ProxyServer(BaseModel):
@@ -206,6 +1063,18 @@ class ProxyServer(BaseModel):
   name = ndb.StringProperty()
   ssh_private_key = ndb.TextProperty()
   fingerprint = ndb.StringProperty()
+  # Digest of the last key string this proxy server acknowledged.
+  key_string_digest = ndb.StringProperty(indexed=False)
+  # Sequence number of the last key change this proxy server acknowledged, set
+  # only when it echoes the sequence number back to show it accepts deltas.
+  key_sequence = ndb.IntegerProperty(indexed=False)
+  # Digest of the proxy assignment under which this proxy server got its keys.
+  assignment_digest = ndb.StringProperty(indexed=False)
+  # Outcome of the most recent key distributions to this proxy server.
+  last_success = ndb.DateTimeProperty(indexed=False)
+  last_failure = ndb.DateTimeProperty(indexed=False)
+  last_error = ndb.TextProperty()
+  consecutive_failures = ndb.IntegerProperty(default=0, indexed=False)
 
   @staticmethod
   def Insert(name, ip_address, ssh_private_key, fingerprint):
@@ -236,34 +1105,754 @@ class ProxyServer(BaseModel):
       fingerprint: What to set the proxy server's fingerprint field to.
     """
     entity = ProxyServer.Get(entity_id)
+    if entity.ip_address != ip_address:
+      # A different machine has not yet received any keys.
+      entity.key_string_digest = None
+      entity.key_sequence = None
+      entity.consecutive_failures = 0
     entity.name = name
     entity.ip_address = ip_address
     entity.ssh_private_key = ssh_private_key
     entity.fingerprint = fingerprint
     entity.put()
 
+  @staticmethod
+  def _UpdateDistribution(proxy_server, update):
+    """Record the outcome of a distribution run against a proxy server.
+
+    The entity is read again in a transaction so that an admin's edit made
+    while keys were being distributed is not reverted. Nothing is recorded if
+    the proxy server was deleted or moved to another ip address in the
+    meantime, since the outcome was for a machine it no longer refers to.
+
+    Args:
+      proxy_server: The ProxyServer entity read at the start of the run.
+      update: A function which sets the distribution fields on the entity.
+    """
+    @ndb.transactional
+    def _Update():
+      """Update the distribution fields of the current entity."""
+      entity = proxy_server.key.get()
+      if entity is None or entity.ip_address != proxy_server.ip_address:
+        return
+      update(entity)
+      entity.put()
+
+    _Update()
+
+  @staticmethod
+  def SetDistributedKeys(distributed, assignment_digest):
+    """Record the keys acknowledged by each proxy server.
+
+    Args:
+      distributed: A list of (proxy_server, key_string_digest, key_sequence)
+          tuples for each ProxyServer entity which accepted its keys, along
+          with the digest of the key string it now holds and the sequence
+          number of the last key change it confirmed holding, or None.
+      assignment_digest: The digest of the proxy assignment the keys were
+          chosen under.
+    """
+    now = datetime.datetime.utcnow()
+    for proxy_server, key_string_digest, key_sequence in distributed:
+
+      def _SetDistributed(entity, key_string_digest=key_string_digest,
+                          key_sequence=key_sequence):
+        """Set the keys the proxy server now holds."""
+        entity.key_string_digest = key_string_digest
+        entity.key_sequence = key_sequence
+        entity.assignment_digest = assignment_digest
+        entity.last_success = now
+        entity.consecutive_failures = 0
+
+      ProxyServer._UpdateDistribution(proxy_server, _SetDistributed)
+
+  @staticmethod
+  def SetDistributionFailures(failures):
+    """Record failed key distributions against each proxy server.
+
+    The keys a proxy server holds after a failed push are unknown, so it is
+    sent its full key string next time rather than a delta.
+
+    Args:
+      failures: A list of (proxy_server, error) tuples, where error is a string
+          describing why the keys could not be distributed to it.
+    """
+    now = datetime.datetime.utcnow()
+    for proxy_server, error in failures:
+
+      def _SetFailure(entity, error=error):
+        """Count one more failure against the proxy server."""
+        entity.last_failure = now
+        entity.last_error = error
+        entity.key_sequence = None
+        entity.consecutive_failures = (entity.consecutive_failures or 0) + 1
+
+      ProxyServer._UpdateDistribution(proxy_server, _SetFailure)
+
+
+class KeyChange(BaseModel):
+
+  """Store a single addition or removal of a user's key.
+
+  Key changes are children of the KeyChangeLog entity and their integer id is
+  the sequence number of the change. Adding a key for an email replaces any
+  key already distributed for that email.
+  """
+
+  ADD = 'add'
+  REMOVE = 'remove'
+
+  action = ndb.StringProperty(indexed=False)
+  email = ndb.StringProperty(indexed=False)
+  public_key = ndb.TextProperty()
+  key_type = ndb.StringProperty(default=User.KEY_TYPE_RSA, indexed=False)
+
+  @staticmethod
+  def FromUser(action, user):
+    """Describe a key change for the given user.
+
+    Args:
+      action: Either KeyChange.ADD or KeyChange.REMOVE.
+      user: The User entity whose key was changed.
+
+    Returns:
+      A tuple of (action, email, public_key, key_type).
+    """
+    return (action, user.email, user.public_key, user.key_type)
+
+
+class KeyChangeShard(BaseModel):
+
+  """Hold key changes which are logged but not numbered into the log yet.
+
+  Pending changes are KeyChange children of their shard, with ids counting up
+  from 1 in the order they were appended.
+  """
+
+  last_id = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class KeyBundle(BaseModel):
+
+  """Store one chunk of the materialized key string for the proxy servers.
+
+  The key string is split across NUM_CHUNKS entities so that it stays within
+  the entity size limit, and each user's line always lives in the same chunk.
+  Changes to users' keys are applied to their chunk from the key change log
+  by CatchUp, so that reading the key string never requires a scan of all
+  users. Chunks are only ever created by Rebuild, and changing NUM_CHUNKS
+  requires a rebuild.
+  """
+
+  NUM_CHUNKS = 64
+  CHUNK_BATCH_SIZE = 8
+  USER_BATCH_SIZE = 500
+
+  key_string = ndb.TextProperty(compressed=True, default='')
+
+  @staticmethod
+  def MakeKeyLine(email, public_key, key_type=User.KEY_TYPE_RSA):
+    """Generate the line in open ssh format granting one user access.
+
+    Args:
+      email: The email of the user.
+      public_key: The public key of the user.
+      key_type: The type of the user's key, e.g. ssh-rsa or ssh-ed25519.
+
+    Returns:
+      A single line with the user's key type, public key and email.
+    """
+    space = ' '
+    endline = '\n'
+    return key_type + space + public_key + space + email + endline
+
+  @staticmethod
+  def _GetChunkId(email):
+    """Get the id of the chunk that holds the line for an email."""
+    return int(hashlib.sha256(email).hexdigest()[:8], 16) % KeyBundle.NUM_CHUNKS
+
+  @staticmethod
+  def _GetChunkKeys():
+    """Get the keys of all of the chunks in order."""
+    return [ndb.Key(KeyBundle, chunk_id + 1)
+            for chunk_id in range(KeyBundle.NUM_CHUNKS)]
+
+  @staticmethod
+  def _JoinLines(lines_by_email):
+    """Join key lines into a chunk's key string, ordered by email."""
+    return ''.join(lines_by_email[email] for email in sorted(lines_by_email))
+
+  @staticmethod
+  def _SplitLines(key_string):
+    """Split a chunk's key string into a dictionary of email to key line."""
+    lines_by_email = {}
+    for line in key_string.splitlines(True):
+      lines_by_email[line.rstrip('\n').rsplit(' ', 1)[-1]] = line
+    return lines_by_email
+
+  @staticmethod
+  def IterKeyString():
+    """Iterate over the key string for all users with an active key.
+
+    Chunks are read CHUNK_BATCH_SIZE at a time, so that only a few chunks are
+    held in memory at once. The bundle is rebuilt from the users first if it
+    has never been built.
+
+    Yields:
+      The key string of each chunk in order.
+    """
+    chunk_keys = KeyBundle._GetChunkKeys()
+    for start in range(0, len(chunk_keys), KeyBundle.CHUNK_BATCH_SIZE):
+      batch_keys = chunk_keys[start:start + KeyBundle.CHUNK_BATCH_SIZE]
+      chunks = ndb.get_multi(batch_keys)
+      if None in chunks:
+        KeyBundle.Rebuild()
+        chunks = ndb.get_multi(batch_keys)
+      for chunk in chunks:
+        yield chunk.key_string
+
+  @staticmethod
+  def IterKeyLines():
+    """Iterate over the key line of each user with an active key.
+
+    Yields:
+      A tuple of (email, key_line) for each user in key string order.
+    """
+    for key_string in KeyBundle.IterKeyString():
+      for line in key_string.splitlines(True):
+        yield line.rstrip('\n').rsplit(' ', 1)[-1], line
+
+  @staticmethod
+  def GetKeyString():
+    """Get the key string for all users with an active key.
+
+    Returns:
+      key_string: A string of users with associated key.
+    """
+    return ''.join(KeyBundle.IterKeyString())
+
+  @staticmethod
+  def CatchUp():
+    """Apply the logged key changes which the bundle does not have yet.
+
+    Changes pending in the shards of the log are numbered first. Applying a
+    change again leaves the same line, so the changes since the last catch up
+    can be applied again if two catch ups overlap. The bundle is rebuilt if
+    the changes it is missing were already pruned from the log.
+
+    Returns:
+      A tuple of the bundle generation, which changes whenever the bundle is
+      rebuilt, and the sequence number of the last change the bundle holds.
+    """
+    KeyChangeLog.Sequence()
+    log = KeyChangeLog.GetOrInsertDefault()
+    if log.bundle_sequence >= log.sequence:
+      return log.bundle_generation, log.bundle_sequence
+    key_changes = KeyChangeLog.GetChangesSince(log.bundle_sequence,
+                                               log.sequence)
+    if key_changes is None:
+      logging.warning('Key changes for the bundle were pruned, rebuilding.')
+      return KeyBundle.Rebuild()
+    KeyBundle.ApplyChanges([(key_change.action, key_change.email,
+                             key_change.public_key, key_change.key_type)
+                            for key_change in key_changes])
+    KeyChangeLog.SetBundleSequence(log.bundle_generation, log.sequence)
+    return log.bundle_generation, log.sequence
+
+  @staticmethod
+  def ApplyChanges(changes):
+    """Apply key changes to the chunks which hold the affected lines.
+
+    Chunks which do not exist yet are skipped since the next rebuild will
+    include those changes anyway.
+
+    Args:
+      changes: A list of (action, email, public_key, key_type) tuples in
+          order.
+    """
+    changes_by_chunk = {}
+    for change in changes:
+      chunk_id = KeyBundle._GetChunkId(change[1])
+      changes_by_chunk.setdefault(chunk_id, []).append(change)
+
+    @ndb.transactional
+    def _ApplyToChunk(chunk_key, chunk_changes):
+      """Apply the changes for a single chunk."""
+      chunk = chunk_key.get()
+      if chunk is None:
+        return
+      lines_by_email = KeyBundle._SplitLines(chunk.key_string)
+      for action, email, public_key, key_type in chunk_changes:
+        if action == KeyChange.ADD:
+          lines_by_email[email] = KeyBundle.MakeKeyLine(email, public_key,
+                                                        key_type)
+        else:
+          lines_by_email.pop(email, None)
+      chunk.key_string = KeyBundle._JoinLines(lines_by_email)
+      chunk.put()
+
+    chunk_keys = KeyBundle._GetChunkKeys()
+    for chunk_id, chunk_changes in changes_by_chunk.iteritems():
+      _ApplyToChunk(chunk_keys[chunk_id], chunk_changes)
+
+  @staticmethod
+  def _IterActiveKeys():
+    """Iterate over the public key of every user with an active key.
+
+    Revoked users are filtered out by the datastore and a projection query
+    reads only the email, public key and key type, USER_BATCH_SIZE users at a
+    time, so that private keys never need to be loaded. Users last written
+    before public_key and key_type were indexed are missing from the
+    projection's index. Those are written back once so that later rebuilds
+    find them in the index, each in a transaction which reads it again so
+    that a change made to the user in the meantime is not overwritten.
+
+    Yields:
+      A tuple of (email, public_key, key_type) for each user with an active
+      key.
+    """
+    # pylint: disable=singleton-comparison
+    query = User.query(User.is_key_revoked == False)
+    projection = [User.email, User.public_key, User.key_type]
+    projected_count = 0
+    try:
+      for user in query.iter(projection=projection,
+                             batch_size=KeyBundle.USER_BATCH_SIZE):
+        projected_count += 1
+        yield (user.email, user.public_key, user.key_type)
+    except datastore_errors.NeedIndexError:
+      logging.warning('Index for the key bundle is not ready yet.')
+      projected_count = 0
+
+    if projected_count == query.count():
+      return
+    projected_keys = set()
+    if projected_count:
+      projected_keys = set(
+          user.key for user in query.iter(
+              projection=projection, batch_size=KeyBundle.USER_BATCH_SIZE))
+    missing_keys = [key for key in query.iter(keys_only=True)
+                    if key not in projected_keys]
+
+    @ndb.transactional_tasklet
+    def _RewriteUser(key):
+      """Write a user back as it is now, unless its key has been revoked."""
+      user = yield key.get_async()
+      if user is None or user.is_key_revoked:
+        raise ndb.Return(None)
+      yield user.put_async()
+      raise ndb.Return(user)
+
+    for start in range(0, len(missing_keys), KeyBundle.USER_BATCH_SIZE):
+      batch_keys = missing_keys[start:start + KeyBundle.USER_BATCH_SIZE]
+      futures = [_RewriteUser(key) for key in batch_keys]
+      for future in futures:
+        user = future.get_result()
+        if user is not None:
+          yield (user.email, user.public_key, user.key_type)
+
+  @staticmethod
+  def Rebuild():
+    """Rebuild every chunk from scratch out of the users in the datastore.
+
+    This is the repair path for a bundle which is missing or has drifted from
+    the users. The query for the users may not reflect changes committed just
+    before or during the rebuild, so the bundle is then caught up with all of
+    the changes still held in the key change log.
+
+    Returns:
+      A tuple of the new bundle generation and the sequence number of the
+      last change the bundle holds, as returned by CatchUp.
+    """
+    pruned_sequence = KeyChangeLog.GetOrInsertDefault().pruned_sequence
+    lines_by_chunk = [{} for _ in range(KeyBundle.NUM_CHUNKS)]
+    for email, public_key, key_type in KeyBundle._IterActiveKeys():
+      chunk_id = KeyBundle._GetChunkId(email)
+      lines_by_chunk[chunk_id][email] = KeyBundle.MakeKeyLine(
+          email, public_key, key_type)
+
+    chunks = []
+    for chunk_key, lines_by_email in zip(KeyBundle._GetChunkKeys(),
+                                         lines_by_chunk):
+      chunks.append(KeyBundle(key=chunk_key,
+                              key_string=KeyBundle._JoinLines(lines_by_email)))
+    ndb.put_multi(chunks)
+    KeyChangeLog.ResetBundleSequence(pruned_sequence)
+    return KeyBundle.CatchUp()
+
+
+class KeyChangeLog(BaseModel):
+
+  """Store the sequence of key changes for delta key distribution.
+
+  There is a single log entity which holds the sequence number of the latest
+  change and how far the log has been pruned. Changes up to and including
+  pruned_sequence are no longer available.
+
+  Changes are first appended to one of NUM_SHARDS KeyChangeShard entities,
+  so that writing users does not contend on the single log entity, and are
+  numbered into the log in batches by Sequence before keys are distributed.
+  """
+
+  LOG_ID = 'key_change_log'
+  DISTRIBUTION_QUEUE = 'key-distribution'
+  DISTRIBUTION_DELAY = 5
+  NUM_SHARDS = 16
+  # Pending changes numbered into the log in a single transaction.
+  SEQUENCE_BATCH_SIZE = 200
+
+  sequence = ndb.IntegerProperty(default=0, indexed=False)
+  pruned_sequence = ndb.IntegerProperty(default=0, indexed=False)
+  # Sequence number of the last change applied to the key bundle, and the
+  # number of times the bundle was rebuilt, which is bumped on every rebuild.
+  bundle_sequence = ndb.IntegerProperty(default=0, indexed=False)
+  bundle_generation = ndb.IntegerProperty(default=0, indexed=False)
+
+  @staticmethod
+  def _GetLogKey():
+    """Get the key of the single log entity."""
+    return ndb.Key(KeyChangeLog, KeyChangeLog.LOG_ID)
+
+  @staticmethod
+  def GetOrInsertDefault():
+    """Get the log entity, or an unsaved empty one if none exists yet.
+
+    Returns:
+      The datastore entity for KeyChangeLog.
+    """
+    entity = KeyChangeLog.Get(KeyChangeLog.LOG_ID)
+    if not entity:
+      entity = KeyChangeLog(id=KeyChangeLog.LOG_ID)
+    return entity
+
+  @staticmethod
+  def GetSequence():
+    """Get the sequence number of the latest key change."""
+    return KeyChangeLog.GetOrInsertDefault().sequence
+
+  @staticmethod
+  def GetShardKey(email):
+    """Get the key of the shard which the changes for an email are added to.
+
+    All of the changes for one email go to the same shard, so that they are
+    numbered in the order they were made.
+    """
+    shard_id = (int(hashlib.sha256(email).hexdigest()[:8], 16) %
+                KeyChangeLog.NUM_SHARDS)
+    return ndb.Key(KeyChangeShard, shard_id + 1)
+
+  @staticmethod
+  @ndb.transactional
+  def Append(shard_key, changes):
+    """Append key changes to a shard, to be numbered into the log later.
+
+    Args:
+      shard_key: The key of the shard for the emails of the changes.
+      changes: A list of (action, email, public_key, key_type) tuples to
+          append in order.
+    """
+    if not changes:
+      return
+    shard = shard_key.get() or KeyChangeShard(key=shard_key)
+    entities = [shard]
+    for action, email, public_key, key_type in changes:
+      shard.last_id += 1
+      entities.append(KeyChange(parent=shard_key, id=shard.last_id,
+                                action=action, email=email,
+                                public_key=public_key, key_type=key_type))
+    ndb.put_multi(entities)
+
+  @staticmethod
+  def Sequence():
+    """Number the changes pending in every shard into the log, in order.
+
+    Shards are emptied SEQUENCE_BATCH_SIZE changes at a time, each batch in a
+    transaction across the shard and the log.
+    """
+    @ndb.transactional(xg=True)
+    def _SequenceBatch(shard_key):
+      """Move a batch of changes from a shard to the end of the log."""
+      pending = KeyChange.query(ancestor=shard_key).order(KeyChange.key).fetch(
+          KeyChangeLog.SEQUENCE_BATCH_SIZE)
+      if not pending:
+        return False
+      log = KeyChangeLog.GetOrInsertDefault()
+      entities = [log]
+      for key_change in pending:
+        log.sequence += 1
+        entities.append(KeyChange(parent=log.key, id=log.sequence,
+                                  action=key_change.action,
+                                  email=key_change.email,
+                                  public_key=key_change.public_key,
+                                  key_type=key_change.key_type))
+      ndb.put_multi(entities)
+      ndb.delete_multi([key_change.key for key_change in pending])
+      return len(pending) == KeyChangeLog.SEQUENCE_BATCH_SIZE
+
+    for shard_id in range(KeyChangeLog.NUM_SHARDS):
+      shard_key = ndb.Key(KeyChangeShard, shard_id + 1)
+      if KeyChange.query(ancestor=shard_key).get(keys_only=True) is None:
+        continue
+      while _SequenceBatch(shard_key):
+        pass
+
+  @staticmethod
+  @ndb.transactional
+  def SetBundleSequence(generation, sequence):
+    """Record that the key bundle holds the changes up to a sequence number.
+
+    Nothing is recorded if the bundle was rebuilt since it was caught up,
+    since the rebuild may have replaced the changes applied.
+
+    Args:
+      generation: The bundle generation the changes were applied under.
+      sequence: The sequence number of the last change applied.
+    """
+    log = KeyChangeLog.GetOrInsertDefault()
+    if (log.bundle_generation != generation or
+        sequence <= log.bundle_sequence):
+      return
+    log.bundle_sequence = sequence
+    log.put()
+
+  @staticmethod
+  @ndb.transactional
+  def ResetBundleSequence(sequence):
+    """Record that the key bundle was rebuilt and holds changes up to sequence.
+
+    Args:
+      sequence: The sequence number of the last change the rebuilt bundle is
+          known to hold.
+    """
+    log = KeyChangeLog.GetOrInsertDefault()
+    log.bundle_generation += 1
+    log.bundle_sequence = max(sequence, log.pruned_sequence)
+    log.put()
+
+  @staticmethod
+  def GetBundleGeneration():
+    """Get the number of times the key bundle was rebuilt."""
+    return KeyChangeLog.GetOrInsertDefault().bundle_generation
+
+  @staticmethod
+  def ScheduleDistribution():
+    """Schedule a distribution of keys to the proxy servers shortly.
+
+    All changes within the same DISTRIBUTION_DELAY second window share one
+    named task, so a burst of changes results in a single distribution a few
+    seconds later instead of one per change.
+    """
+    window = int(time.time() / KeyChangeLog.DISTRIBUTION_DELAY)
+    try:
+      taskqueue.add(queue_name=KeyChangeLog.DISTRIBUTION_QUEUE,
+                    name='distribute-keys-%d' % window,
+                    url=PATHS['cron_proxy_server_distribute_key'],
+                    method='GET',
+                    countdown=KeyChangeLog.DISTRIBUTION_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      logging.debug('Key distribution already scheduled for this window.')
+
+  @staticmethod
+  def GetChangesSince(sequence, last_sequence):
+    """Get the key changes after one sequence number up to another.
+
+    Args:
+      sequence: The sequence number of the last change already applied.
+      last_sequence: The sequence number of the last change to include.
+
+    Returns:
+      A list of KeyChange entities in sequence order, or None if some of the
+      requested changes have already been pruned from the log.
+    """
+    log = KeyChangeLog.GetOrInsertDefault()
+    if sequence < log.pruned_sequence:
+      return None
+    log_key = KeyChangeLog._GetLogKey()
+    query = KeyChange.query(
+        KeyChange.key > ndb.Key(KeyChange, sequence, parent=log_key),
+        KeyChange.key <= ndb.Key(KeyChange, last_sequence, parent=log_key),
+        ancestor=log_key).order(KeyChange.key)
+    return query.fetch()
+
+  @staticmethod
+  def Prune(keep):
+    """Delete all but the most recent key changes from the log.
+
+    Changes which the key bundle does not hold yet are never pruned.
+
+    Args:
+      keep: The number of most recent key changes to keep.
+    """
+    @ndb.transactional
+    def _MarkPruned():
+      """Move the pruned sequence forward so readers stop using old changes."""
+      log = KeyChangeLog.Get(KeyChangeLog.LOG_ID)
+      if not log:
+        return None
+      pruned_sequence = min(log.sequence - keep, log.bundle_sequence)
+      if pruned_sequence <= log.pruned_sequence:
+        return None
+      log.pruned_sequence = pruned_sequence
+      log.put()
+      return log.pruned_sequence
+
+    pruned_sequence = _MarkPruned()
+    if pruned_sequence is None:
+      return
+    log_key = KeyChangeLog._GetLogKey()
+    query = KeyChange.query(
+        KeyChange.key <= ndb.Key(KeyChange, pruned_sequence, parent=log_key),
+        ancestor=log_key)
+    ndb.delete_multi(query.fetch(keys_only=True))
+
 
 class Notification(BaseModel):
 
-  """Store data related to notifications."""
+  """Store data related to notifications.
+
+  Push notifications are acknowledged as soon as they are queued in the
+  QUEUE pull queue, and applied to the users and stored afterwards in batches
+  by a task. Each one is keyed by its channel and message number, so a
+  notification delivered more than once is stored as a single entity.
+  """
+
+  QUEUE = 'notifications'
+  STORE_QUEUE = 'notification-storage'
+  STORE_DELAY = 5
+  # Queued notifications leased, applied and stored together.
+  STORE_BATCH_SIZE = 500
+  # Seconds a batch is leased for, after which it can be leased again if it
+  # was not stored.
+  LEASE_SECONDS = 60
 
   state = ndb.StringProperty()
   number = ndb.StringProperty()
   uuid = ndb.StringProperty()
   email = ndb.StringProperty()
+  channel_id = ndb.StringProperty()
+  name = ndb.StringProperty()
+  # Whether the notification changed a user when it was applied.
+  applied = ndb.BooleanProperty(default=False)
 
   @staticmethod
-  def Insert(state, number, uuid, email):
-    """Insert a new Notification entity in the datastore with the given values.
+  def MakeId(channel_id, number):
+    """Make the id of a notification, which is the same for every delivery.
+
+    Args:
+      channel_id: The X-Goog-Channel-ID field of the request.
+      number: The X-Goog-Message-Number field of the request.
+
+    Returns:
+      A string of the id, or None to have one allocated if either is missing.
+    """
+    if not channel_id or not number:
+      return None
+    return '%s:%s' % (channel_id, number)
+
+  @staticmethod
+  def GetDeletedName(uuid):
+    """Get the name of a user whose delete was applied.
+
+    Args:
+      uuid: The directory id of the user.
+
+    Returns:
+      The name the user had when deleted, or None if no delete was applied.
+    """
+    # pylint: disable=singleton-comparison
+    notification = Notification.query(Notification.uuid == uuid,
+                                      Notification.state == 'delete',
+                                      Notification.applied == True).get()
+    if notification is None:
+      return None
+    return notification.name or notification.email
+
+  @staticmethod
+  def Enqueue(state, number, uuid, email, channel_id=None, name=None):
+    """Queue a notification to be stored shortly.
 
     Args:
       state: The X-Goog-Resource-State field of the request.
       number: The X-Goog-Message-Number field of the request.
       uuid: The id field of the request body.
       email: The primaryEmail field of the request body.
+      channel_id: The X-Goog-Channel-ID field of the request.
+      name: The name.fullName field of the request body, if there is one.
     """
-    entity = Notification(state=state, number=number, uuid=uuid, email=email)
-    entity.put()
+    payload = json.dumps({
+        'state': state,
+        'number': number,
+        'uuid': uuid,
+        'email': email,
+        'channel_id': channel_id,
+        'name': name,
+    })
+    taskqueue.Queue(Notification.QUEUE).add(
+        taskqueue.Task(payload=payload, method='PULL'))
+    Notification.ScheduleStore()
+
+  @staticmethod
+  def GetBacklog():
+    """Get the number of notifications queued but not stored yet."""
+    return taskqueue.Queue(Notification.QUEUE).fetch_statistics().tasks
+
+  @staticmethod
+  def ScheduleStore():
+    """Schedule the queued notifications to be stored shortly.
+
+    All notifications within the same STORE_DELAY second window share one
+    named task, so a burst of notifications is stored in a few batches
+    instead of one write each.
+    """
+    window = int(time.time() / Notification.STORE_DELAY)
+    try:
+      taskqueue.add(queue_name=Notification.STORE_QUEUE,
+                    name='store-notifications-%d' % window,
+                    url=PATHS['cron_sync_store_notifications'],
+                    method='GET',
+                    countdown=Notification.STORE_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      logging.debug('Notification storage already scheduled for this window.')
+
+  @staticmethod
+  def _GetNumber(notification):
+    """Get the message number of a notification to sort notifications by."""
+    try:
+      return int(notification.number)
+    except (TypeError, ValueError):
+      return 0
+
+  @staticmethod
+  def ProcessQueued():
+    """Apply one batch of the queued notifications to the users and store it.
+
+    The batch is only removed from the queue once it is applied and stored,
+    so if either fails the batch is leased again after LEASE_SECONDS.
+    Applying a notification again changes nothing, and storing it again
+    overwrites the same entity.
+
+    Returns:
+      The number of notifications processed, which is 0 once the queue is
+      empty.
+    """
+    queue = taskqueue.Queue(Notification.QUEUE)
+    tasks = queue.lease_tasks(Notification.LEASE_SECONDS,
+                              Notification.STORE_BATCH_SIZE)
+    if not tasks:
+      return 0
+    entities = []
+    for task in tasks:
+      values = json.loads(task.payload)
+      channel_id = values.get('channel_id')
+      entities.append(Notification(
+          id=Notification.MakeId(channel_id, values['number']),
+          state=values['state'], number=values['number'],
+          uuid=values['uuid'], email=values['email'], channel_id=channel_id,
+          name=values.get('name')))
+    entities.sort(key=Notification._GetNumber)
+    User.ApplyNotifications(entities)
+    queue.delete_tasks(tasks)
+    return len(tasks)
 
 
 class NotificationChannel(BaseModel):
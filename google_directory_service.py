@@ -4,6 +4,11 @@ from appengine_config import JINJA_ENVIRONMENT
 from config import PATHS
 from datastore import NotificationChannel
 from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+import httplib2
+import logging
+import os
+import threading
 from time import time
 
 
@@ -11,38 +16,119 @@ MY_CUSTOMER_ALIAS = 'my_customer'
 
 NUM_RETRIES = 3
 
+MAX_USERS_PER_PAGE = 500
+
+# The most requests the Directory API accepts in a single batch.
+MAX_BATCH_SIZE = 1000
+
+# The user fields needed to add a user to the datastore.
+ADD_USER_FIELDS = 'primaryEmail,name/fullName'
+
+# The user fields compared when reconciling the datastore with the directory.
+RECONCILE_USER_FIELDS = 'primaryEmail,name/fullName,suspended,etag'
+
 VALID_WATCH_EVENTS = ['add', 'delete', 'makeAdmin', 'undelete', 'update']
 
+# The discovery document bundled with the app by './setup.sh discovery', which
+# saves fetching it every time the service is built.
+DISCOVERY_DOCUMENT_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'discovery',
+    'admin_directory_v1.json')
+
+_SERVICE = None
+_SERVICE_LOCK = threading.Lock()
+
+
+def _BuildService():
+  """Build the directory service from the bundled discovery document.
+
+  The service is not bound to any credentials. If the discovery document was
+  not bundled, it is fetched instead.
+  """
+  if os.path.exists(DISCOVERY_DOCUMENT_PATH):
+    with open(DISCOVERY_DOCUMENT_PATH) as discovery_file:
+      return build_from_document(discovery_file.read(),
+                                 http=httplib2.Http())
+  return build(serviceName='admin', version='directory_v1',
+               http=httplib2.Http())
+
+
+def _GetService():
+  """Get the directory service shared by every request on this instance.
+
+  Building the service parses the whole discovery document, so it is only
+  done once per instance. The service only creates requests, which are
+  executed with each caller's own credentials, so it is safe to share between
+  threads.
+
+  Returns:
+    The directory service resource.
+  """
+  global _SERVICE  # pylint: disable=global-statement
+  if _SERVICE is None:
+    with _SERVICE_LOCK:
+      if _SERVICE is None:
+        _SERVICE = _BuildService()
+  return _SERVICE
+
+
+def LoadService():
+  """Build the shared directory service now, e.g. on warmup."""
+  _GetService()
+
+
 class GoogleDirectoryService(object):
 
   """Interact with Google Directory API."""
 
   def __init__(self, oauth_decorator):
     """Create a service object for admin directory services using oauth."""
-    self.service = build(serviceName='admin', version='directory_v1',
-                         http=oauth_decorator.http())
+    self.service = _GetService()
+    # Requests are executed with the current user's credentials.
+    self.http = oauth_decorator.http()
 
-  def GetUsers(self):
-    """Get the users of a customer account.
+  def ListUsers(self, projection='full', fields=None):
+    """List the users of a customer account one page at a time.
 
-    Returns:
-      users: A list of users.
+    Only one page of users is held in memory at a time, and the next page is
+    not requested until the previous one has been used, so callers can stop
+    early by no longer iterating.
+
+    Args:
+      projection: Either 'full' or 'basic', which leaves out custom schemas.
+      fields: An optional partial response selector for each user, such as
+          'primaryEmail,name/fullName', to fetch only the fields needed.
+
+    Yields:
+      user: A dictionary of a user.
     """
-    users = []
+    list_params = {
+        'customer': MY_CUSTOMER_ALIAS,
+        'maxResults': MAX_USERS_PER_PAGE,
+        'projection': projection,
+        'orderBy': 'email',
+    }
+    if fields is not None:
+      list_params['fields'] = 'nextPageToken,users({0})'.format(fields)
     page_token = ''
     while True:
       users_service = self.service.users()
-      request = users_service.list(customer=MY_CUSTOMER_ALIAS, maxResults=500,
-                                   pageToken=page_token, projection='full',
-                                   orderBy='email')
-      result = request.execute(num_retries=NUM_RETRIES)
-      users += result['users']
+      request = users_service.list(pageToken=page_token, **list_params)
+      result = request.execute(http=self.http, num_retries=NUM_RETRIES)
+      for user in result.get('users', []):
+        yield user
       if 'nextPageToken' in result:
         page_token = result['nextPageToken']
       else:
         break
 
-    return users
+  def GetUsers(self):
+    """Get the users of a customer account.
+
+    Returns:
+      users: A list of users.
+    """
+    return list(self.ListUsers())
 
   def GetUsersByGroupKey(self, group_key):
     """Get the users belonging to a group in a customer account.
@@ -62,7 +148,7 @@ class GoogleDirectoryService(object):
       else:
         request = self.service.members().list(groupKey=group_key,
                                               pageToken=page_token)
-      result = request.execute(num_retries=NUM_RETRIES)
+      result = request.execute(http=self.http, num_retries=NUM_RETRIES)
       members += result['members']
       if 'nextPageToken' in result:
         page_token = result['nextPageToken']
@@ -71,12 +157,44 @@ class GoogleDirectoryService(object):
 
     user = 'USER'
     # Limit to only users, not groups
-    for member in members:
-      if 'type' in member and member['type'] == user and member['id']:
-        users.append(self.GetUser(member['id']))
+    user_keys = [member['id'] for member in members
+                 if 'type' in member and member['type'] == user and
+                 member['id']]
+    for user_key, result in zip(user_keys, self.GetUsersByKeys(user_keys)):
+      if isinstance(result, Exception):
+        logging.warning('Unable to get group member %s: %s', user_key, result)
+      else:
+        users.append(result)
 
     return users
 
+  def GetUsersByKeys(self, user_keys):
+    """Get many users, batching the requests to save round trips.
+
+    Args:
+      user_keys: A list of strings identifying individual users.
+
+    Returns:
+      results: A list with an entry for each user key in the same order,
+          which is either the user or the exception raised getting them.
+    """
+    results = [None] * len(user_keys)
+
+    def _StoreResult(request_id, response, exception):
+      """Store the user or error for one request in the batch."""
+      results[int(request_id)] = response if exception is None else exception
+
+    for start in range(0, len(user_keys), MAX_BATCH_SIZE):
+      batch = self.service.new_batch_http_request(callback=_StoreResult)
+      end = min(start + MAX_BATCH_SIZE, len(user_keys))
+      for index in range(start, end):
+        request = self.service.users().get(userKey=user_keys[index],
+                                           projection='full')
+        batch.add(request, request_id=str(index))
+      batch.execute(http=self.http)
+
+    return results
+
   def GetUser(self, user_key):
     """Get a user based on a user key.
 
@@ -87,7 +205,7 @@ class GoogleDirectoryService(object):
       users: The user if found.
     """
     request = self.service.users().get(userKey=user_key, projection='full')
-    result = request.execute(num_retries=NUM_RETRIES)
+    result = request.execute(http=self.http, num_retries=NUM_RETRIES)
 
     return result
 
@@ -149,7 +267,7 @@ class GoogleDirectoryService(object):
     request = self.service.users().watch(customer=MY_CUSTOMER_ALIAS,
                                          event=event, projection='full',
                                          orderBy='email', body=body)
-    result = request.execute(num_retries=NUM_RETRIES)
+    result = request.execute(http=self.http, num_retries=NUM_RETRIES)
 
     if 'resourceId' in result:
       NotificationChannel.Insert(event=event, channel_id=id_field,
@@ -165,7 +283,7 @@ class GoogleDirectoryService(object):
     body['id'] = notification_channel.channel_id
     body['resourceId'] = notification_channel.resource_id
     request = self.service.channels().stop(body=body)
-    request.execute(num_retries=NUM_RETRIES)
+    request.execute(http=self.http, num_retries=NUM_RETRIES)
 
     NotificationChannel.Delete(notification_channel.key.id)
 
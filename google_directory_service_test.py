@@ -2,12 +2,13 @@
 
 from config import PATHS
 from mock import MagicMock
+from mock import mock_open
 from mock import patch
 import sys
 import unittest
 
-# Need to mock the call to get an XSRF token at function definition time, i.e.
-# when the module is loaded. http://stackoverflow.com/a/7667621/2830207
+# Need to mock the XSRF token so that templates can be rendered without a
+# signed in user. http://stackoverflow.com/a/7667621/2830207
 def MockToken():
   """Mock token generator that returns empty."""
   return ''
@@ -59,27 +60,79 @@ FAKE_PAGE_TOKEN = 'I am a fake page token'
 FAKE_GROUP_KEY = 'my_group@mybusiness.com'
 
 
+def MockGetUsersByKeys(user_keys):
+  """Mock getting users in a batch to return the matching group members."""
+  members = {FAKE_ID_1: FAKE_GROUP_MEMBER_USER_1,
+             FAKE_ID_2: FAKE_GROUP_MEMBER_USER_2}
+  return [members[user_key] for user_key in user_keys]
+
+
 class GoogleDirectoryServiceTest(unittest.TestCase):
 
   """Test google directory service class functionality."""
 
-  @patch('google_directory_service.build')
-  def setUp(self, mock_build):
+  @patch('google_directory_service._GetService')
+  def setUp(self, mock_get_service):
     """Setup test object on which to call methods later on."""
     # pylint: disable=arguments-differ
-    mock_build.return_value = MOCK_SERVICE
+    mock_get_service.return_value = MOCK_SERVICE
     self.directory_service = GoogleDirectoryService(MOCK_OAUTH_DECORATOR)
 
-  @patch('google_directory_service.build')
-  def testInit(self, mock_build):
-    """Test that init passes the correct parameters and creates an object."""
+  @patch('google_directory_service._GetService')
+  def testInit(self, mock_get_service):
+    """Test that init uses the shared service and the user's credentials."""
     fake_service = MagicMock()
-    mock_build.return_value = fake_service
+    mock_get_service.return_value = fake_service
     google_directory_service = GoogleDirectoryService(MOCK_OAUTH_DECORATOR)
-    mock_build.assert_called_once_with(serviceName='admin',
-                                       version='directory_v1',
-                                       http=MOCK_HTTP)
+    mock_get_service.assert_called_once_with()
     self.assertEqual(google_directory_service.service, fake_service)
+    self.assertEqual(google_directory_service.http, MOCK_HTTP)
+
+  @patch('google_directory_service._BuildService')
+  def testGetServiceBuildsOnce(self, mock_build_service):
+    """Test the service is only built once per instance."""
+    # pylint: disable=protected-access
+    mock_build_service.return_value = MOCK_SERVICE
+    with patch('google_directory_service._SERVICE', None):
+      self.assertEqual(google_directory_service._GetService(), MOCK_SERVICE)
+      self.assertEqual(google_directory_service._GetService(), MOCK_SERVICE)
+    mock_build_service.assert_called_once_with()
+
+  @patch('google_directory_service.build')
+  @patch('google_directory_service.build_from_document')
+  @patch('google_directory_service.os.path.exists')
+  def testBuildServiceFromBundledDocument(self, mock_exists,
+                                          mock_build_from_document,
+                                          mock_build):
+    """Test the bundled discovery document is used instead of fetching it."""
+    # pylint: disable=protected-access
+    mock_exists.return_value = True
+    mock_build_from_document.return_value = MOCK_SERVICE
+    fake_document = '{"name": "admin"}'
+    with patch('__builtin__.open', mock_open(read_data=fake_document)):
+      service = google_directory_service._BuildService()
+
+    self.assertEqual(service, MOCK_SERVICE)
+    self.assertEqual(mock_build_from_document.call_args[0][0], fake_document)
+    mock_build.assert_not_called()
+
+  @patch('google_directory_service.build')
+  @patch('google_directory_service.build_from_document')
+  @patch('google_directory_service.os.path.exists')
+  def testBuildServiceWithoutBundledDocument(self, mock_exists,
+                                             mock_build_from_document,
+                                             mock_build):
+    """Test the discovery document is fetched if it was not bundled."""
+    # pylint: disable=protected-access
+    mock_exists.return_value = False
+    mock_build.return_value = MOCK_SERVICE
+
+    service = google_directory_service._BuildService()
+
+    self.assertEqual(service, MOCK_SERVICE)
+    self.assertEqual(mock_build.call_args[1]['serviceName'], 'admin')
+    self.assertEqual(mock_build.call_args[1]['version'], 'directory_v1')
+    mock_build_from_document.assert_not_called()
 
   def testConstantDefinitions(self):
     """Test the constants set in GoogleDirectoryService are as expected."""
@@ -106,7 +159,8 @@ class GoogleDirectoryServiceTest(unittest.TestCase):
     mock_list.assert_called_once_with(customer=MY_CUSTOMER_ALIAS,
                                       maxResults=500, pageToken='',
                                       projection='full', orderBy='email')
-    mock_execute.assert_called_once_with(num_retries=NUM_RETRIES)
+    mock_execute.assert_called_once_with(http=MOCK_HTTP,
+                                         num_retries=NUM_RETRIES)
     self.assertEqual(users_returned, FAKE_USERS)
 
   @patch.object(MOCK_SERVICE.users.list, 'execute')
@@ -149,15 +203,56 @@ class GoogleDirectoryServiceTest(unittest.TestCase):
     mock_list.assert_any_call(customer=MY_CUSTOMER_ALIAS,
                               maxResults=500, pageToken=FAKE_PAGE_TOKEN,
                               projection='full', orderBy='email')
-    mock_execute.assert_any_call(num_retries=NUM_RETRIES)
+    mock_execute.assert_any_call(http=MOCK_HTTP,
+                                 num_retries=NUM_RETRIES)
     self.assertEqual(users_returned, expected_list)
 
-  @patch.object(GoogleDirectoryService, 'GetUser')
+  @patch.object(MOCK_SERVICE.users.list, 'execute')
+  @patch.object(MOCK_SERVICE.users, 'list')
+  @patch.object(MOCK_SERVICE, 'users')
+  def testListUsersWithFields(self, mock_users, mock_list, mock_execute):
+    """Test listing users asks for a partial response of the fields given."""
+    mock_execute.return_value = {'users': FAKE_USERS}
+    mock_list.return_value.execute = mock_execute
+    mock_users.return_value.list = mock_list
+    self.directory_service.users = mock_users
+
+    users_returned = list(self.directory_service.ListUsers(
+        projection='basic', fields='primaryEmail'))
+
+    mock_list.assert_called_once_with(
+        customer=MY_CUSTOMER_ALIAS, maxResults=500, pageToken='',
+        projection='basic', orderBy='email',
+        fields='nextPageToken,users(primaryEmail)')
+    self.assertEqual(users_returned, FAKE_USERS)
+
+  @patch.object(MOCK_SERVICE.users.list, 'execute')
+  @patch.object(MOCK_SERVICE.users, 'list')
+  @patch.object(MOCK_SERVICE, 'users')
+  def testListUsersStopsEarly(self, mock_users, mock_list, mock_execute):
+    """Test no more pages are requested once the caller stops iterating."""
+    mock_execute.return_value = {'users': FAKE_USERS,
+                                 'nextPageToken': FAKE_PAGE_TOKEN}
+    mock_list.return_value.execute = mock_execute
+    mock_users.return_value.list = mock_list
+    self.directory_service.users = mock_users
+
+    for user in self.directory_service.ListUsers():
+      if user == FAKE_USER_2:
+        break
+
+    mock_list.assert_called_once_with(customer=MY_CUSTOMER_ALIAS,
+                                      maxResults=500, pageToken='',
+                                      projection='full', orderBy='email')
+    mock_execute.assert_called_once_with(http=MOCK_HTTP,
+                                         num_retries=NUM_RETRIES)
+
+  @patch.object(GoogleDirectoryService, 'GetUsersByKeys')
   @patch.object(MOCK_SERVICE.members.list, 'execute')
   @patch.object(MOCK_SERVICE.members, 'list')
   @patch.object(MOCK_SERVICE, 'members')
   def testGetUsersByGroupKey(self, mock_members, mock_list, mock_execute,
-                             mock_get_user):
+                             mock_get_users):
     """Test get users by group key handles a valid response correctly."""
     fake_dictionary = {}
     fake_dictionary['members'] = FAKE_GROUP
@@ -167,28 +262,40 @@ class GoogleDirectoryServiceTest(unittest.TestCase):
     self.directory_service.users = mock_members
     expected_list = [FAKE_GROUP_MEMBER_USER_1, FAKE_GROUP_MEMBER_USER_2]
 
-    def SideEffect(user_key):
-      """Mock get user function to return different users after group get."""
-      if user_key == FAKE_ID_1:
-        return FAKE_GROUP_MEMBER_USER_1
-      else:
-        return FAKE_GROUP_MEMBER_USER_2
-
-    mock_get_user.side_effect = SideEffect
+    mock_get_users.side_effect = MockGetUsersByKeys
 
     users_returned = self.directory_service.GetUsersByGroupKey(FAKE_GROUP_KEY)
 
     mock_members.assert_called_once_with()
     mock_list.assert_called_once_with(groupKey=FAKE_GROUP_KEY)
-    mock_execute.assert_called_once_with(num_retries=NUM_RETRIES)
+    mock_execute.assert_called_once_with(http=MOCK_HTTP,
+                                         num_retries=NUM_RETRIES)
+    mock_get_users.assert_called_once_with([FAKE_ID_1, FAKE_ID_2])
     self.assertEqual(users_returned, expected_list)
 
-  @patch.object(GoogleDirectoryService, 'GetUser')
+  @patch.object(GoogleDirectoryService, 'GetUsersByKeys')
+  @patch.object(MOCK_SERVICE.members.list, 'execute')
+  @patch.object(MOCK_SERVICE.members, 'list')
+  @patch.object(MOCK_SERVICE, 'members')
+  def testGetUsersByGroupKeySkipsErrors(self, mock_members, mock_list,
+                                        mock_execute, mock_get_users):
+    """Test a member which cannot be fetched does not fail the whole group."""
+    mock_execute.return_value = {'members': FAKE_GROUP}
+    mock_list.return_value.execute = mock_execute
+    mock_members.return_value.list = mock_list
+    mock_get_users.return_value = [Exception('not found'),
+                                   FAKE_GROUP_MEMBER_USER_2]
+
+    users_returned = self.directory_service.GetUsersByGroupKey(FAKE_GROUP_KEY)
+
+    self.assertEqual(users_returned, [FAKE_GROUP_MEMBER_USER_2])
+
+  @patch.object(GoogleDirectoryService, 'GetUsersByKeys')
   @patch.object(MOCK_SERVICE.members.list, 'execute')
   @patch.object(MOCK_SERVICE.members, 'list')
   @patch.object(MOCK_SERVICE, 'members')
   def testGetUsersByGroupKeyPaged(self, mock_members, mock_list, mock_execute,
-                                  mock_get_user):
+                                  mock_get_users):
     """Test get users by group key handles a long valid response correctly."""
     fake_dictionary_1 = {}
     fake_dictionary_1['members'] = FAKE_GROUP
@@ -214,14 +321,7 @@ class GoogleDirectoryServiceTest(unittest.TestCase):
     mock_members.return_value.list = mock_list
     self.directory_service.users = mock_members
 
-    def SideEffect2(user_key):
-      """Mock get user function to return different users after group get."""
-      if user_key == FAKE_ID_1:
-        return FAKE_GROUP_MEMBER_USER_1
-      else:
-        return FAKE_GROUP_MEMBER_USER_2
-
-    mock_get_user.side_effect = SideEffect2
+    mock_get_users.side_effect = MockGetUsersByKeys
 
     users_returned = self.directory_service.GetUsersByGroupKey(FAKE_GROUP_KEY)
 
@@ -229,9 +329,50 @@ class GoogleDirectoryServiceTest(unittest.TestCase):
     mock_list.assert_any_call(groupKey=FAKE_GROUP_KEY)
     mock_list.assert_any_call(groupKey=FAKE_GROUP_KEY,
                               pageToken=FAKE_PAGE_TOKEN)
-    mock_execute.assert_any_call(num_retries=NUM_RETRIES)
+    mock_execute.assert_any_call(http=MOCK_HTTP,
+                                 num_retries=NUM_RETRIES)
     self.assertEqual(users_returned, expected_list)
 
+  @patch.object(MOCK_SERVICE, 'new_batch_http_request')
+  @patch.object(MOCK_SERVICE, 'users')
+  def testGetUsersByKeys(self, mock_users, mock_new_batch):
+    """Test users are fetched in batches and kept in the order asked for."""
+    batch_size = google_directory_service.MAX_BATCH_SIZE
+    user_keys = ['key%d' % index for index in range(batch_size + 1)]
+    fake_error = Exception('not found')
+    batches = []
+
+    def NewBatch(callback):
+      """Mock a batch which answers its requests in reverse order."""
+      batch = MagicMock()
+      added = []
+      batch.add.side_effect = lambda request, request_id: added.append(
+          request_id)
+
+      def Execute():
+        """Call back with an error for the first user and others found."""
+        for request_id in reversed(added):
+          if request_id == '0':
+            callback(request_id, None, fake_error)
+          else:
+            callback(request_id, {'id': user_keys[int(request_id)]}, None)
+
+      batch.execute.side_effect = Execute
+      batches.append(batch)
+      return batch
+
+    mock_new_batch.side_effect = NewBatch
+
+    results = self.directory_service.GetUsersByKeys(user_keys)
+
+    self.assertEqual(len(batches), 2)
+    self.assertEqual(batches[0].add.call_count, batch_size)
+    self.assertEqual(batches[1].add.call_count, 1)
+    mock_users.return_value.get.assert_any_call(userKey='key1',
+                                                projection='full')
+    self.assertEqual(results[0], fake_error)
+    self.assertEqual([result['id'] for result in results[1:]], user_keys[1:])
+
   @patch.object(MOCK_SERVICE.users.get, 'execute')
   @patch.object(MOCK_SERVICE.users, 'get')
   @patch.object(MOCK_SERVICE, 'users')
@@ -246,7 +387,8 @@ class GoogleDirectoryServiceTest(unittest.TestCase):
 
     mock_users.assert_called_once_with()
     mock_get.assert_called_once_with(userKey=FAKE_ID_1, projection='full')
-    mock_execute.assert_called_once_with(num_retries=NUM_RETRIES)
+    mock_execute.assert_called_once_with(http=MOCK_HTTP,
+                                         num_retries=NUM_RETRIES)
     self.assertEqual(user_returned, FAKE_USER_1)
 
   @patch.object(GoogleDirectoryService, 'GetUser')
@@ -347,7 +489,8 @@ class GoogleDirectoryServiceTest(unittest.TestCase):
                                        event=fake_event_not_watched,
                                        projection='full', orderBy='email',
                                        body=fake_body)
-    mock_execute.assert_called_once_with(num_retries=NUM_RETRIES)
+    mock_execute.assert_called_once_with(http=MOCK_HTTP,
+                                         num_retries=NUM_RETRIES)
     mock_insert.assert_called_once_with(event=fake_event_not_watched,
                                         channel_id=fake_body['id'],
                                         resource_id=fake_resource_id)
@@ -377,7 +520,8 @@ class GoogleDirectoryServiceTest(unittest.TestCase):
 
     mock_channels.assert_called_once_with()
     mock_stop.assert_called_once_with(body=fake_body)
-    mock_execute.assert_called_once_with(num_retries=NUM_RETRIES)
+    mock_execute.assert_called_once_with(http=MOCK_HTTP,
+                                         num_retries=NUM_RETRIES)
     mock_delete.assert_called_once_with(fake_id)
 
 if __name__ == '__main__':
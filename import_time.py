@@ -0,0 +1,78 @@
+"""Measure how long each WSGI entry point takes to import.
+
+An instance imports appengine_config and the module of a handler's script
+before it can serve its first request, so this is much of its cold start
+time. Each module is imported in a fresh python process with the App Engine
+service stubs standing in for the real services, so the numbers are best
+compared against earlier runs rather than read as production timings.
+
+Usage: python import_time.py
+"""
+
+import os
+import re
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def GetEntryPoints():
+  """Get the modules of the WSGI applications in app.yaml.
+
+  Returns:
+    A list of module names in the order they are first routed to.
+  """
+  with open(os.path.join(ROOT, 'app.yaml')) as app_yaml:
+    scripts = re.findall(r'^\s*script:\s*(\w+)\.APP\s*$', app_yaml.read(),
+                         re.MULTILINE)
+  modules = []
+  for script in scripts:
+    if script not in modules:
+      modules.append(script)
+  return modules
+
+
+def MeasureImport(module_name):
+  """Import a module the way an instance would and time it.
+
+  Args:
+    module_name: The name of the module to import.
+
+  Returns:
+    The seconds taken to import appengine_config and then the module.
+  """
+  from google.appengine.ext import testbed
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.setup_env(user_email='import-time@example.com', user_id='1',
+                overwrite=True)
+  bed.init_app_identity_stub()
+  bed.init_datastore_v3_stub()
+  bed.init_memcache_stub()
+  bed.init_taskqueue_stub(root_path=ROOT)
+  bed.init_urlfetch_stub()
+  bed.init_user_stub()
+
+  start_time = time.time()
+  __import__('appengine_config')
+  __import__(module_name)
+  return time.time() - start_time
+
+
+def main(argv):
+  """Print the import time of each entry point, or of the one given."""
+  if len(argv) > 1:
+    print '%f' % MeasureImport(argv[1])
+    return
+  for module_name in GetEntryPoints():
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), module_name], cwd=ROOT)
+    seconds = float(output.split()[-1])
+    print '%-15s %8.1f ms' % (module_name, seconds * 1000)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,75 @@
+"""A small in-process cache for values shared between requests."""
+
+import collections
+import threading
+import time
+
+
+class LruCache(object):
+
+  """Cache values in memory, dropping the least recently used when full.
+
+  Instances are shared between the threads serving requests, so every
+  operation holds a lock. Entries can also expire after a time to live, which
+  bounds how stale a value can get when it is changed on another instance.
+  """
+
+  def __init__(self, max_size, ttl=None):
+    """Create an empty cache.
+
+    Args:
+      max_size: The most entries to keep.
+      ttl: Optional seconds after which an entry expires.
+    """
+    self.max_size = max_size
+    self.ttl = ttl
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def Get(self, key, default=None):
+    """Get a cached value and mark it as recently used.
+
+    Args:
+      key: The key of the value.
+      default: What to return if the key is not cached or has expired.
+
+    Returns:
+      The cached value or the default.
+    """
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        return default
+      value, expiry = entry
+      if expiry is not None and expiry <= time.time():
+        return default
+      self._entries[key] = entry
+      return value
+
+  def Set(self, key, value):
+    """Cache a value, dropping the least recently used entry if full.
+
+    Args:
+      key: The key of the value.
+      value: The value to cache.
+    """
+    expiry = None if self.ttl is None else time.time() + self.ttl
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (value, expiry)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def Delete(self, key):
+    """Remove a value from the cache if it is there.
+
+    Args:
+      key: The key of the value.
+    """
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def Clear(self):
+    """Remove every value from the cache."""
+    with self._lock:
+      self._entries.clear()
@@ -0,0 +1,64 @@
+"""Test lru cache module functionality."""
+import unittest
+
+from mock import patch
+
+from lru_cache import LruCache
+
+
+class LruCacheTest(unittest.TestCase):
+
+  """Test lru cache class functionality."""
+
+  def testGetAndSet(self):
+    """Test values are cached and falsy values are told apart from misses."""
+    cache = LruCache(2)
+    cache.Set('foo', False)
+
+    self.assertEqual(cache.Get('foo'), False)
+    self.assertEqual(cache.Get('bar'), None)
+    self.assertEqual(cache.Get('bar', 'baz'), 'baz')
+
+  def testDropsLeastRecentlyUsed(self):
+    """Test the least recently used value is dropped when the cache is full."""
+    cache = LruCache(2)
+    cache.Set('a', 1)
+    cache.Set('b', 2)
+    cache.Get('a')
+    cache.Set('c', 3)
+
+    self.assertEqual(cache.Get('a'), 1)
+    self.assertEqual(cache.Get('b'), None)
+    self.assertEqual(cache.Get('c'), 3)
+
+  @patch('lru_cache.time.time')
+  def testExpiry(self, mock_time):
+    """Test values expire once their time to live has passed."""
+    cache = LruCache(2, ttl=10)
+    mock_time.return_value = 100
+    cache.Set('foo', 'bar')
+
+    mock_time.return_value = 109
+    self.assertEqual(cache.Get('foo'), 'bar')
+    mock_time.return_value = 110
+    self.assertEqual(cache.Get('foo'), None)
+
+  def testDeleteAndClear(self):
+    """Test values can be removed individually or all at once."""
+    cache = LruCache(3)
+    cache.Set('a', 1)
+    cache.Set('b', 2)
+    cache.Set('c', 3)
+
+    cache.Delete('a')
+    cache.Delete('missing')
+    self.assertEqual(cache.Get('a'), None)
+    self.assertEqual(cache.Get('b'), 2)
+
+    cache.Clear()
+    self.assertEqual(cache.Get('b'), None)
+    self.assertEqual(cache.Get('c'), None)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,89 @@
+"""Assign users to a subset of the proxy servers."""
+
+import bisect
+import hashlib
+
+
+def _Hash(value):
+  """Get the position of a value on the hash ring."""
+  return int(hashlib.sha256(value).hexdigest()[:16], 16)
+
+
+class ProxyAssignment(object):
+
+  """Map users to the proxy servers which carry their keys.
+
+  Each proxy server is placed on a hash ring at VIRTUAL_NODES points derived
+  from its id. A user is assigned to the first REPLICATION_FACTOR distinct
+  proxy servers found walking the ring clockwise from the hash of their email,
+  so each proxy server carries about REPLICATION_FACTOR / M of the users.
+  Adding or removing a proxy server only moves the users next to its points.
+  """
+
+  REPLICATION_FACTOR = 2
+  VIRTUAL_NODES = 100
+
+  def __init__(self, proxy_servers):
+    """Build the hash ring for the given proxy servers.
+
+    Args:
+      proxy_servers: A list of all of the ProxyServer entities.
+    """
+    self._proxy_servers = {}
+    points = []
+    for proxy_server in proxy_servers:
+      proxy_id = proxy_server.key.id()
+      self._proxy_servers[proxy_id] = proxy_server
+      for replica in range(self.VIRTUAL_NODES):
+        points.append((_Hash('%s-%d' % (proxy_id, replica)), proxy_id))
+    points.sort()
+    self._hashes = [point_hash for point_hash, _ in points]
+    self._proxy_ids = [proxy_id for _, proxy_id in points]
+    # Identifies the assignment, so that proxy servers which received keys
+    # under a different ring are sent their full key string again.
+    self.digest = hashlib.sha256(repr((
+        self.REPLICATION_FACTOR, self.VIRTUAL_NODES,
+        sorted(self._proxy_servers)))).hexdigest()
+
+  def GetProxyServerIds(self, email):
+    """Get the ids of the proxy servers assigned to a user.
+
+    Args:
+      email: The email of the user.
+
+    Returns:
+      A list of distinct proxy server ids, the first being the primary.
+    """
+    num_replicas = min(self.REPLICATION_FACTOR, len(self._proxy_servers))
+    proxy_ids = []
+    index = bisect.bisect(self._hashes, _Hash(email))
+    while len(proxy_ids) < num_replicas:
+      proxy_id = self._proxy_ids[index % len(self._proxy_ids)]
+      if proxy_id not in proxy_ids:
+        proxy_ids.append(proxy_id)
+      index += 1
+    return proxy_ids
+
+  def GetProxyServers(self, email):
+    """Get the proxy servers assigned to a user.
+
+    Args:
+      email: The email of the user.
+
+    Returns:
+      A list of ProxyServer entities, the first being the primary.
+    """
+    return [self._proxy_servers[proxy_id]
+            for proxy_id in self.GetProxyServerIds(email)]
+
+  def IsAssigned(self, email, proxy_server):
+    """Check whether a proxy server carries a user's key.
+
+    Args:
+      email: The email of the user.
+      proxy_server: The ProxyServer entity to check.
+
+    Returns:
+      True if the user is assigned to the proxy server.
+    """
+    return proxy_server.key.id() in self.GetProxyServerIds(email)
@@ -0,0 +1,64 @@
+"""Test proxy assignment module functionality."""
+import unittest
+
+from datastore import ProxyServer
+from proxy_assignment import ProxyAssignment
+
+
+FAKE_EMAILS = ['user%d@bar.com' % index for index in range(1000)]
+
+
+class ProxyAssignmentTest(unittest.TestCase):
+
+  """Test proxy assignment class functionality."""
+
+  def setUp(self):
+    """Setup proxy servers to assign users to."""
+    self.proxy_servers = [ProxyServer(id=proxy_id, ip_address=str(proxy_id))
+                          for proxy_id in range(1, 6)]
+
+  def testGetProxyServers(self):
+    """Test each user gets distinct replicas and the load is spread."""
+    assignment = ProxyAssignment(self.proxy_servers)
+    counts = {}
+    for email in FAKE_EMAILS:
+      proxy_ids = assignment.GetProxyServerIds(email)
+      self.assertEqual(len(proxy_ids), ProxyAssignment.REPLICATION_FACTOR)
+      self.assertEqual(len(set(proxy_ids)), len(proxy_ids))
+      self.assertEqual(proxy_ids, assignment.GetProxyServerIds(email))
+      for proxy_id in proxy_ids:
+        counts[proxy_id] = counts.get(proxy_id, 0) + 1
+
+    expected = (len(FAKE_EMAILS) * ProxyAssignment.REPLICATION_FACTOR /
+                len(self.proxy_servers))
+    for proxy_server in self.proxy_servers:
+      self.assertTrue(expected / 2 < counts[proxy_server.key.id()] <
+                      expected * 2)
+
+  def testGetProxyServersWithFewProxies(self):
+    """Test users are assigned to every proxy if there are not enough."""
+    assignment = ProxyAssignment(self.proxy_servers[:1])
+    self.assertEqual(assignment.GetProxyServers(FAKE_EMAILS[0]),
+                     self.proxy_servers[:1])
+    self.assertEqual(ProxyAssignment([]).GetProxyServers(FAKE_EMAILS[0]), [])
+
+  def testAddingProxyServerMovesFewUsers(self):
+    """Test adding a proxy server only moves users onto the new one."""
+    before = ProxyAssignment(self.proxy_servers[:-1])
+    after = ProxyAssignment(self.proxy_servers)
+    new_proxy_server = self.proxy_servers[-1]
+    self.assertNotEqual(before.digest, after.digest)
+
+    for email in FAKE_EMAILS:
+      if not after.IsAssigned(email, new_proxy_server):
+        self.assertEqual(before.GetProxyServerIds(email),
+                         after.GetProxyServerIds(email))
+
+  def testDigestIgnoresOrder(self):
+    """Test the digest only depends on which proxy servers are in the ring."""
+    self.assertEqual(ProxyAssignment(self.proxy_servers).digest,
+                     ProxyAssignment(self.proxy_servers[::-1]).digest)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -3,14 +3,58 @@
 import admin
 from appengine_config import JINJA_ENVIRONMENT
 from config import PATHS
+from datastore import KeyBundle
+from datastore import KeyChange
+from datastore import KeyChangeLog
 from datastore import ProxyServer
-from datastore import User
-import httplib2
+from datetime import datetime
+from datetime import timedelta
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import urlfetch
+import hashlib
 import logging
+from proxy_assignment import ProxyAssignment
+import random
+import time
 import webapp2
 import xsrf
 
 
+# Seconds to wait on a single proxy server to accept the keys before giving up.
+PER_SERVER_DEADLINE = 10
+
+# Seconds allowed for one distribution run across all of the proxy servers.
+DISTRIBUTION_DEADLINE = 45
+
+# Maximum number of key pushes in flight at any one time.
+MAX_CONCURRENT_PUSHES = 10
+
+# Most key changes sent to a proxy server as a delta before the full key string
+# is sent instead.
+MAX_DELTA_CHANGES = 500
+
+# Number of most recent key changes kept for proxy servers that fall behind.
+KEY_CHANGE_LOG_LENGTH = 1000
+
+# Status a proxy server returns when a delta does not apply to its keys.
+DELTA_REJECTED_STATUS = 409
+
+# Header a proxy server which accepts deltas echoes the sequence number of its
+# keys back in, both for deltas and for full key strings.
+KEY_SEQUENCE_HEADER = 'X-Key-Sequence'
+
+# Attempts made to push keys to a single proxy server within one run.
+MAX_PUSH_ATTEMPTS = 3
+
+# Seconds to wait before the first retry, doubled for each retry after that.
+RETRY_BASE_DELAY = 1
+
+# Consecutive failed runs after which a proxy server is skipped for a while.
+CIRCUIT_BREAKER_THRESHOLD = 5
+
+# How long a proxy server which keeps failing is skipped before trying again.
+CIRCUIT_BREAKER_COOLDOWN = timedelta(minutes=30)
+
 
 def _RenderProxyServerFormTemplate(proxy_server):
   """Render the form to add or edit a proxy server."""
@@ -31,27 +75,346 @@ def _RenderListProxyServerTemplate():
   return template.render(template_values)
 
 
-def _MakeKeyString():
-  """Generate the key string in open ssh format for pushing to proxy servers.
+def _MakeKeyStrings(assignment, proxy_servers):
+  """Generate the key string in open ssh format for each proxy server.
+
+  Each key string includes only the public key of the users assigned to that
+  proxy server, in order to grant those users access to it. All of the key
+  strings are built in a single pass over the key bundle, which is kept up to
+  date as users change rather than built from all of the users.
+
+  Args:
+    assignment: The ProxyAssignment mapping users to proxy servers.
+    proxy_servers: A list of proxy server entities to build key strings for.
+
+  Returns:
+    key_strings: A dictionary of proxy server id to its key string.
+  """
+  lines_by_proxy_id = dict((proxy_server.key.id(), [])
+                           for proxy_server in proxy_servers)
+  for email, key_line in KeyBundle.IterKeyLines():
+    for proxy_id in assignment.GetProxyServerIds(email):
+      if proxy_id in lines_by_proxy_id:
+        lines_by_proxy_id[proxy_id].append(key_line)
+
+  return dict((proxy_id, ''.join(lines))
+              for proxy_id, lines in lines_by_proxy_id.iteritems())
+
+
+def _MakeKeyDelta(key_changes):
+  """Generate the delta of key changes for patching a proxy server's keys.
+
+  Each change is a line of '+' or '-' and a space followed by the line in open
+  ssh format being added or removed, e.g. '+ ssh-rsa public_key email'. An
+  added line replaces any line the proxy server already has for that email.
+
+  Args:
+    key_changes: A list of KeyChange entities in sequence order.
+
+  Returns:
+    key_delta: A string of the changes to apply in order.
+  """
+  delta_lines = []
+  for key_change in key_changes:
+    if key_change.action == KeyChange.ADD:
+      prefix = '+ '
+    else:
+      prefix = '- '
+    delta_lines.append(prefix + KeyBundle.MakeKeyLine(key_change.email,
+                                                      key_change.public_key,
+                                                      key_change.key_type))
+
+  return ''.join(delta_lines)
+
+
+def _MakeKeyStringDigests(assignment, proxy_servers):
+  """Get a digest identifying the contents of each proxy server's key string.
+
+  The digests are computed incrementally in a single pass over the key bundle
+  so that no key string ever needs to be held in memory as a whole.
+
+  Args:
+    assignment: The ProxyAssignment mapping users to proxy servers.
+    proxy_servers: A list of proxy server entities to get digests for.
+
+  Returns:
+    A dictionary of proxy server id to the hex string digest of its key string.
+  """
+  digesters = dict((proxy_server.key.id(), hashlib.sha256())
+                   for proxy_server in proxy_servers)
+  for email, key_line in KeyBundle.IterKeyLines():
+    for proxy_id in assignment.GetProxyServerIds(email):
+      if proxy_id in digesters:
+        digesters[proxy_id].update(key_line)
+
+  return dict((proxy_id, digester.hexdigest())
+              for proxy_id, digester in digesters.iteritems())
+
+
+def _MakeFullKeyPush(proxy_server, key_string, key_sequence):
+  """Describe a push replacing all of a proxy server's keys.
+
+  Args:
+    proxy_server: The proxy server entity to push the key string to.
+    key_string: The key string in open ssh format to push.
+    key_sequence: The sequence number of the last key change in key_string.
+
+  Returns:
+    key_push: A dictionary of the proxy server, method, payload and headers.
+  """
+  return {
+      'proxy_server': proxy_server,
+      'method': urlfetch.PUT,
+      'payload': key_string,
+      'headers': {
+          'content-type': 'text/plain',
+          KEY_SEQUENCE_HEADER: str(key_sequence),
+      },
+  }
+
+
+def _MakeDeltaKeyPush(proxy_server, key_delta, key_sequence):
+  """Describe a push patching a proxy server's keys with recent changes.
+
+  The proxy server should reject the delta with DELTA_REJECTED_STATUS if its
+  own sequence number does not match X-Key-Sequence-Base. Deltas are only
+  sent to proxy servers which echoed their sequence number back before.
+
+  Args:
+    proxy_server: The proxy server entity to push the delta to.
+    key_delta: The changes since the proxy server's sequence number.
+    key_sequence: The sequence number of the last key change in key_delta.
+
+  Returns:
+    key_push: A dictionary of the proxy server, method, payload and headers.
+  """
+  return {
+      'proxy_server': proxy_server,
+      'method': urlfetch.PATCH,
+      'payload': key_delta,
+      'headers': {
+          'content-type': 'text/plain',
+          KEY_SEQUENCE_HEADER: str(key_sequence),
+          'X-Key-Sequence-Base': str(proxy_server.key_sequence),
+      },
+  }
+
+
+def _CanPushDelta(assignment, proxy_server, key_sequence):
+  """Check whether a proxy server is recent enough to be sent a delta."""
+  base = proxy_server.key_sequence
+  return (proxy_server.assignment_digest == assignment.digest and
+          base is not None and 0 < key_sequence - base <= MAX_DELTA_CHANGES)
+
+
+def _MakeKeyPushes(assignment, proxy_servers, key_sequence):
+  """Decide whether each proxy server gets a delta or its full key string.
+
+  Proxy servers which acknowledged a recent enough sequence number under the
+  current assignment get only the changes since then to the users assigned to
+  them. Everyone else, including servers too far behind for the change log or
+  whose assigned users moved, gets their full key string. The full key
+  strings are only built if at least one proxy server needs one.
+
+  Args:
+    assignment: The ProxyAssignment mapping users to proxy servers.
+    proxy_servers: A list of proxy server entities to push keys to.
+    key_sequence: The sequence number of the last key change to push.
+
+  Returns:
+    key_pushes: A list of key push dictionaries, one per proxy server.
+  """
+  delta_bases = [proxy_server.key_sequence for proxy_server in proxy_servers
+                 if _CanPushDelta(assignment, proxy_server, key_sequence)]
+
+  key_changes = None
+  if delta_bases:
+    key_changes = KeyChangeLog.GetChangesSince(min(delta_bases), key_sequence)
+
+  use_deltas = [key_changes is not None and
+                _CanPushDelta(assignment, proxy_server, key_sequence)
+                for proxy_server in proxy_servers]
+  key_strings = {}
+  if not all(use_deltas):
+    key_strings = _MakeKeyStrings(assignment, [
+        proxy_server for proxy_server, use_delta
+        in zip(proxy_servers, use_deltas) if not use_delta])
+
+  key_pushes = []
+  for proxy_server, use_delta in zip(proxy_servers, use_deltas):
+    if not use_delta:
+      key_pushes.append(_MakeFullKeyPush(
+          proxy_server, key_strings[proxy_server.key.id()], key_sequence))
+      continue
+    base = proxy_server.key_sequence
+    changes_since_base = [
+        key_change for key_change in key_changes
+        if key_change.key.id() > base and
+        assignment.IsAssigned(key_change.email, proxy_server)]
+    key_pushes.append(_MakeDeltaKeyPush(proxy_server,
+                                        _MakeKeyDelta(changes_since_base),
+                                        key_sequence))
+
+  return key_pushes
+
+
+def _StartKeyPush(key_push, deadline):
+  """Start an asynchronous push of keys to a single proxy server.
+
+  Args:
+    key_push: A key push dictionary describing what to send where.
+    deadline: Seconds to wait on the proxy server before giving up.
+
+  Returns:
+    rpc: The urlfetch rpc object for the pending push.
+  """
+  # TODO(henry): Make the request secure.  Urlfetch supports https with
+  # validate_certificate=True.  http://goo.gl/mjU4Mh
+  url = 'http://%s/key' % key_push['proxy_server'].ip_address
+  rpc = urlfetch.create_rpc(deadline=deadline)
+  urlfetch.make_fetch_call(rpc, url,
+                           payload=key_push['payload'],
+                           method=key_push['method'],
+                           headers=key_push['headers'],
+                           follow_redirects=False)
+  return rpc
+
+
+def _FinishKeyPush(key_push, rpc):
+  """Wait on a pending key push and log its outcome.
+
+  Args:
+    key_push: A key push dictionary describing what was sent where.
+    rpc: The urlfetch rpc object for the pending push.
+
+  Returns:
+    A tuple of (status_code, error, key_sequence). The status code is the http
+    status code returned by the proxy server, or None if there was no
+    response. The error describes what went wrong, or is None on success. The
+    key sequence is the sequence number pushed if the proxy server echoed it
+    back, and None otherwise.
+  """
+  ip_address = key_push['proxy_server'].ip_address
+  try:
+    response = rpc.get_result()
+  except urlfetch.Error as error:
+    logging.error('Failed to distribute keys to %s: %s', ip_address,
+                  repr(error))
+    return None, repr(error), None
+  logging.info('Distributed keys to %s. Response: %s, Content: %s',
+               ip_address, response.status_code, response.content)
+  if not 200 <= response.status_code < 300:
+    return response.status_code, 'HTTP %d: %s' % (response.status_code,
+                                                  response.content), None
+  pushed_sequence = key_push['headers'][KEY_SEQUENCE_HEADER]
+  if response.headers.get(KEY_SEQUENCE_HEADER) != pushed_sequence:
+    return response.status_code, None, None
+  return response.status_code, None, int(pushed_sequence)
+
+
+def _IsRetryable(status_code):
+  """Check whether a failed push is worth retrying within the same run."""
+  return status_code is None or status_code >= 500
+
+
+def _GetRetryDelay(attempt):
+  """Get the seconds to wait before retrying after the given attempt.
+
+  The delay grows exponentially with each attempt and is jittered so that
+  retries to servers which failed together do not also retry together.
+
+  Args:
+    attempt: The number of the attempt which just failed, starting from 0.
+
+  Returns:
+    The delay in seconds.
+  """
+  return RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5)
+
 
-  This key string includes only the public key for each user in order to grant
-  the user access to each proxy server.
+def _IsCircuitOpen(proxy_server, now):
+  """Check whether a proxy server has failed too often to try right now.
+
+  Args:
+    proxy_server: The proxy server entity to check.
+    now: The current datetime.
 
   Returns:
-    key_string: A string of users with associated key.
+    True if the proxy server should be skipped until its cool-down expires.
   """
-  users = User.GetAll()
-  key_string = ''
-  ssh_starting_portion = 'ssh-rsa'
-  space = ' '
-  endline = '\n'
-  for user in users:
-    if not user.is_key_revoked:
-      user_string = (ssh_starting_portion + space + user.public_key + space +
-                     user.email + endline)
-      key_string += user_string
+  if (proxy_server.consecutive_failures or 0) < CIRCUIT_BREAKER_THRESHOLD:
+    return False
+  if proxy_server.last_failure is None:
+    return False
+  return now < proxy_server.last_failure + CIRCUIT_BREAKER_COOLDOWN
+
+
+def _DistributeKeys(key_pushes):
+  """Push keys out to all of the proxy servers concurrently.
 
-  return key_string
+  Up to MAX_CONCURRENT_PUSHES asynchronous urlfetch calls are kept in flight at
+  once, and a new push starts as soon as any one of them finishes, so the wall
+  time of a run is close to that of the slowest proxy server rather than the
+  sum over all of them. Each push is bounded by PER_SERVER_DEADLINE and the run
+  as a whole by DISTRIBUTION_DEADLINE.
+
+  A push which gets no response or a server error is retried up to
+  MAX_PUSH_ATTEMPTS times with jittered exponential backoff, while pushes to
+  healthy servers carry on. Pushes which cannot start before the overall
+  deadline are skipped until the next run.
+
+  Args:
+    key_pushes: A list of key push dictionaries describing what to send where.
+
+  Returns:
+    results: A list of (proxy_server, status_code, error, key_sequence)
+        tuples in the same order as key_pushes, holding the outcome of the
+        last attempt as returned by _FinishKeyPush. All but the proxy server
+        are None if the push was skipped.
+  """
+  run_deadline = time.time() + DISTRIBUTION_DEADLINE
+  outcomes = [(None, None, None)] * len(key_pushes)
+  # Pushes to start as (not_before, index, attempt), kept sorted.
+  waiting = [(0, index, 0) for index in range(len(key_pushes))]
+  in_flight = []
+  while waiting or in_flight:
+    now = time.time()
+    while waiting and len(in_flight) < MAX_CONCURRENT_PUSHES:
+      not_before, index, attempt = waiting[0]
+      remaining = run_deadline - max(now, not_before)
+      if remaining <= 0:
+        waiting.pop(0)
+        logging.error('Skipped distributing keys to %s: run deadline exceeded.',
+                      key_pushes[index]['proxy_server'].ip_address)
+        continue
+      if not_before > now:
+        break
+      waiting.pop(0)
+      deadline = min(PER_SERVER_DEADLINE, remaining)
+      rpc = _StartKeyPush(key_pushes[index], deadline)
+      in_flight.append((index, attempt, rpc))
+
+    if in_flight:
+      # Take whichever push finishes first, so that a server which is slow to
+      # respond does not hold up starting the pushes waiting behind it.
+      finished_rpc = apiproxy_stub_map.UserRPC.wait_any(
+          [rpc for _, _, rpc in in_flight])
+      position = next(position for position, (_, _, rpc)
+                      in enumerate(in_flight) if rpc is finished_rpc)
+      index, attempt, rpc = in_flight.pop(position)
+      outcomes[index] = _FinishKeyPush(key_pushes[index], rpc)
+      status_code = outcomes[index][0]
+      if _IsRetryable(status_code) and attempt + 1 < MAX_PUSH_ATTEMPTS:
+        not_before = time.time() + _GetRetryDelay(attempt)
+        waiting.append((not_before, index, attempt + 1))
+        waiting.sort()
+    elif waiting:
+      time.sleep(max(0, waiting[0][0] - time.time()))
+
+  results = []
+  for key_push, outcome in zip(key_pushes, outcomes):
+    results.append((key_push['proxy_server'],) + outcome)
+  return results
 
 
 class AddProxyServerHandler(webapp2.RequestHandler):
@@ -142,25 +505,105 @@ class DistributeKeyHandler(webapp2.RequestHandler):
   def get(self):
     """Send the current users and associated key out to each proxy server.
 
+    This handler is not intended primarily for a typical user, but for a cron
+    job to periodically trigger. Each proxy server only carries the keys of the
+    users assigned to it. Proxy servers which already acknowledged their
+    current key string are skipped unless force is passed in.
+    """
+    force = self.request.get('force')
+    # Number the pending key changes and apply them to the key bundle, which
+    # then holds every change up to key_sequence.
+    bundle_generation, key_sequence = KeyBundle.CatchUp()
+    all_proxy_servers = ProxyServer.GetAll()
+    # Every proxy server is part of the assignment, whether or not it is
+    # healthy, so that an outage does not move users around.
+    assignment = ProxyAssignment(all_proxy_servers)
+    key_string_digests = _MakeKeyStringDigests(assignment, all_proxy_servers)
+    # A concurrent catch up which applied more changes while the digests were
+    # computed puts them in the digests but not in any delta up to key_sequence.
+    digests_match_sequence = KeyChangeLog.GetSequence() == key_sequence
+    now = datetime.utcnow()
+    proxy_servers = []
+    for proxy_server in all_proxy_servers:
+      key_string_digest = key_string_digests[proxy_server.key.id()]
+      if force:
+        proxy_servers.append(proxy_server)
+      elif proxy_server.key_string_digest == key_string_digest:
+        continue
+      elif _IsCircuitOpen(proxy_server, now):
+        logging.warning('Skipped distributing keys to %s: cooling down after '
+                        '%d failures.', proxy_server.ip_address,
+                        proxy_server.consecutive_failures)
+      else:
+        proxy_servers.append(proxy_server)
+    if not proxy_servers:
+      self.response.write('all done!')
+      return
+
+    key_pushes = _MakeKeyPushes(assignment, proxy_servers, key_sequence)
+    results = _DistributeKeys(key_pushes)
+    delta_proxy_ids = set(
+        key_push['proxy_server'].key.id() for key_push in key_pushes
+        if key_push['method'] == urlfetch.PATCH)
+
+    # Proxy servers which answered a delta with anything but success, whether
+    # their keys did not match it or they no longer take deltas at all, get
+    # everything instead. Their sequence number is only kept if they echo it
+    # back for the full key string.
+    rejected_proxy_servers = [
+        proxy_server for proxy_server, status_code, error, _ in results
+        if proxy_server.key.id() in delta_proxy_ids and
+        status_code is not None and error is not None]
+    if rejected_proxy_servers:
+      rejected_proxy_ids = set(
+          proxy_server.key.id() for proxy_server in rejected_proxy_servers)
+      results = [result for result in results
+                 if result[0].key.id() not in rejected_proxy_ids]
+      delta_proxy_ids.difference_update(rejected_proxy_ids)
+      key_strings = _MakeKeyStrings(assignment, rejected_proxy_servers)
+      results += _DistributeKeys([
+          _MakeFullKeyPush(proxy_server, key_strings[proxy_server.key.id()],
+                           key_sequence)
+          for proxy_server in rejected_proxy_servers])
+
+    distributed = []
+    failures = []
+    for proxy_server, status_code, error, acked_sequence in results:
+      if error is not None:
+        failures.append((proxy_server, error))
+      elif status_code is not None:
+        key_string_digest = key_string_digests[proxy_server.key.id()]
+        if (proxy_server.key.id() in delta_proxy_ids and
+            not digests_match_sequence):
+          # Leave the digest unknown so that the next run sends the delta
+          # with the changes this one missed.
+          key_string_digest = None
+        distributed.append((proxy_server, key_string_digest, acked_sequence))
+    if KeyChangeLog.GetBundleGeneration() != bundle_generation:
+      # The bundle was rebuilt during the run, so the key strings sent may not
+      # hold every change up to key_sequence. Send everything next time.
+      distributed = [(proxy_server, None, None)
+                     for proxy_server, _, _ in distributed]
+    ProxyServer.SetDistributedKeys(distributed, assignment.digest)
+    ProxyServer.SetDistributionFailures(failures)
+    KeyChangeLog.Prune(KEY_CHANGE_LOG_LENGTH)
+    self.response.write('all done!')
+
+
+class RebuildKeyBundleHandler(webapp2.RequestHandler):
+
+  """Handler for rebuilding the key bundle from all of the users."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler requires admin login, and is controlled in the app.yaml.
+  def get(self):
+    """Rebuild the key bundle from scratch to repair any drift.
+
     This handler is not intended primarily for a typical user, but for a cron
     job to periodically trigger.
     """
-    # TODO(henry): See if we can use threading to parallelize the put requests.
-    key_string = _MakeKeyString()
-    proxy_servers = ProxyServer.GetAll()
-    for proxy_server in proxy_servers:
-      http = httplib2.Http()
-      # TODO(henry): Make the request secure.  The http object
-      # supports add_certificate() method.  http://goo.gl/mjU4Mh
-      # TODO(henry): Increase robustness here, e.g. add exception handling
-      # and retries.
-      response, content = http.request(
-          'http://%s/key' % proxy_server.ip_address,
-          headers={'content-type': 'text/plain'},
-          method='PUT',
-          body=key_string)
-      logging.info('Distributed keys to %s. Response: %s, Content: %s',
-                   proxy_server.ip_address, response.status, content)
+    KeyBundle.Rebuild()
     self.response.write('all done!')
 
 
@@ -171,6 +614,7 @@ APP = webapp2.WSGIApplication([
     (PATHS['proxy_server_list'], ListProxyServersHandler),
 
     (PATHS['cron_proxy_server_distribute_key'], DistributeKeyHandler),
+    (PATHS['cron_proxy_server_rebuild_key_bundle'], RebuildKeyBundleHandler),
     (admin.OAUTH_DECORATOR.callback_path,
      admin.OAUTH_DECORATOR.callback_handler()),
 ], debug=True)
@@ -1,13 +1,17 @@
 """Test proxy server module functionality."""
+from datetime import datetime
+import hashlib
 import sys
 import unittest
 
 from config import PATHS
+from mock import ANY
 from mock import MagicMock
 from mock import patch
 import webtest
 
 from datastore import ProxyServer
+from proxy_assignment import ProxyAssignment
 
 
 # Need to mock the decorator at function definition time, i.e. when the module
@@ -99,30 +103,487 @@ class ProxyServerTest(unittest.TestCase):
     mock_delete.assert_called_once_with(FAKE_ID)
     mock_render_list_template.assert_called_once_with()
 
-  @patch('proxy_server._MakeKeyString')
-  @patch('httplib2.Http.request')
+  @patch('datastore.KeyBundle.CatchUp')
+  @patch('datastore.KeyChangeLog.GetBundleGeneration')
+  @patch('datastore.KeyChangeLog.Prune')
+  @patch('datastore.ProxyServer.SetDistributionFailures')
+  @patch('datastore.ProxyServer.SetDistributedKeys')
+  @patch('proxy_server._DistributeKeys')
+  @patch('proxy_server._MakeKeyPushes')
+  @patch('proxy_server._MakeKeyStringDigests')
+  @patch('datastore.KeyChangeLog.GetSequence')
   @patch('datastore.ProxyServer.GetAll')
-  def testDistributeKeyHandler(self, mock_get_all, mock_request,
-                               mock_make_key_string):
+  def testDistributeKeyHandler(self, mock_get_all, mock_get_sequence,
+                               mock_make_digests, mock_make_pushes,
+                               mock_distribute, mock_set_keys,
+                               mock_set_failures, mock_prune,
+                               mock_get_generation, mock_catch_up):
     """Test the distribute handler calls to put the keys on each proxy."""
-    fake_proxy_server = GetFakeProxyServer()
-    fake_proxy_servers = [fake_proxy_server]
+    # pylint: disable=too-many-arguments
+    fake_proxy_server = GetFakeProxyServer(1)
+    failed_proxy_server = GetFakeProxyServer(2)
+    fake_proxy_servers = [fake_proxy_server, failed_proxy_server]
     mock_get_all.return_value = fake_proxy_servers
+    fake_sequence = 7
+    mock_catch_up.return_value = (1, fake_sequence)
+    mock_get_generation.return_value = 1
+    mock_get_sequence.return_value = fake_sequence
+    mock_make_digests.return_value = {1: 'digest1', 2: 'digest2'}
+
+    fake_key_pushes = [MagicMock(), MagicMock()]
+    mock_make_pushes.return_value = fake_key_pushes
+    mock_distribute.return_value = [
+        (fake_proxy_server, 200, None, fake_sequence),
+        (failed_proxy_server, None, 'error', None)]
 
-    mock_response = MagicMock()
-    mock_response.status = 200
-    fake_content = ''
-    mock_request.return_value = mock_response, fake_content
+    self.testapp.get(PATHS['cron_proxy_server_distribute_key'])
+    mock_make_pushes.assert_called_once_with(ANY, fake_proxy_servers,
+                                             fake_sequence)
+    mock_distribute.assert_called_once_with(fake_key_pushes)
+    mock_set_keys.assert_called_once_with(
+        [(fake_proxy_server, 'digest1', fake_sequence)],
+        ProxyAssignment(fake_proxy_servers).digest)
+    mock_set_failures.assert_called_once_with([(failed_proxy_server, 'error')])
+    mock_prune.assert_called_once_with(proxy_server.KEY_CHANGE_LOG_LENGTH)
+
+  @patch('datastore.KeyBundle.CatchUp')
+  @patch('datastore.KeyChangeLog.GetBundleGeneration')
+  @patch('datastore.KeyChangeLog.Prune')
+  @patch('datastore.ProxyServer.SetDistributionFailures')
+  @patch('datastore.ProxyServer.SetDistributedKeys')
+  @patch('proxy_server._DistributeKeys')
+  @patch('proxy_server._MakeKeyStringDigests')
+  @patch('datastore.KeyChangeLog.GetSequence')
+  @patch('datastore.ProxyServer.GetAll')
+  def testDistributeKeyHandlerUnchanged(self, mock_get_all, mock_get_sequence,
+                                        mock_make_digests, mock_distribute,
+                                        mock_set_keys, mock_set_failures,
+                                        mock_prune, mock_get_generation,
+                                        mock_catch_up):
+    """Test the distribute handler skips proxies which have the keys."""
+    # pylint: disable=too-many-arguments
+    # pylint: disable=unused-argument
+    mock_catch_up.return_value = (1, 0)
+    mock_get_generation.return_value = 1
+    mock_get_sequence.return_value = 0
+    up_to_date_proxy_server = GetFakeProxyServer()
+    up_to_date_proxy_server.key_string_digest = 'digest'
+    mock_get_all.return_value = [up_to_date_proxy_server]
+    mock_make_digests.return_value = {FAKE_ID: 'digest'}
 
-    fake_key_string = 'ssh-rsa public_key email'
-    mock_make_key_string.return_value = fake_key_string
+    self.testapp.get(PATHS['cron_proxy_server_distribute_key'])
+    mock_distribute.assert_not_called()
+    mock_set_keys.assert_not_called()
+    mock_prune.assert_not_called()
+
+    mock_distribute.return_value = [(up_to_date_proxy_server, 200, None, 0)]
+    self.testapp.get(PATHS['cron_proxy_server_distribute_key'] + '?force=true')
+    self.assertEqual(mock_distribute.call_count, 1)
+
+  @patch('datastore.KeyBundle.CatchUp')
+  @patch('datastore.KeyChangeLog.GetBundleGeneration')
+  @patch('datastore.KeyChangeLog.Prune')
+  @patch('datastore.ProxyServer.SetDistributionFailures')
+  @patch('datastore.ProxyServer.SetDistributedKeys')
+  @patch('proxy_server._DistributeKeys')
+  @patch('proxy_server._MakeKeyPushes')
+  @patch('proxy_server._MakeKeyStrings')
+  @patch('proxy_server._MakeKeyStringDigests')
+  @patch('datastore.KeyChangeLog.GetSequence')
+  @patch('datastore.ProxyServer.GetAll')
+  def testDistributeKeyHandlerDeltaRejected(self, mock_get_all,
+                                            mock_get_sequence,
+                                            mock_make_digests,
+                                            mock_make_key_strings,
+                                            mock_make_pushes, mock_distribute,
+                                            mock_set_keys, mock_set_failures,
+                                            mock_prune, mock_get_generation,
+                                            mock_catch_up):
+    """Test a proxy failing a delta is sent the full key string instead."""
+    # pylint: disable=protected-access
+    # pylint: disable=too-many-arguments
+    # pylint: disable=unused-argument
+    rejecting_proxy_server = GetFakeProxyServer(1)
+    rejecting_proxy_server.key_sequence = 5
+    # A proxy server which no longer takes deltas at all.
+    unsupported_proxy_server = GetFakeProxyServer(2)
+    unsupported_proxy_server.key_sequence = 5
+    failed_proxy_server = GetFakeProxyServer(3)
+    fake_proxy_servers = [rejecting_proxy_server, unsupported_proxy_server,
+                          failed_proxy_server]
+    mock_get_all.return_value = fake_proxy_servers
+    mock_catch_up.return_value = (1, 7)
+    mock_get_generation.return_value = 1
+    mock_get_sequence.return_value = 7
+    mock_make_digests.return_value = {1: 'digest1', 2: 'digest2',
+                                      3: 'digest3'}
+    mock_make_key_strings.return_value = {1: 'keys1', 2: 'keys2'}
+    mock_make_pushes.return_value = [
+        proxy_server._MakeDeltaKeyPush(rejecting_proxy_server, 'delta', 7),
+        proxy_server._MakeDeltaKeyPush(unsupported_proxy_server, 'delta', 7),
+        proxy_server._MakeFullKeyPush(failed_proxy_server, 'keys3', 7)]
+    mock_distribute.side_effect = [
+        [(rejecting_proxy_server, proxy_server.DELTA_REJECTED_STATUS,
+          'HTTP 409', None),
+         (unsupported_proxy_server, 405, 'HTTP 405', None),
+         (failed_proxy_server, 400, 'HTTP 400', None)],
+        [(rejecting_proxy_server, 200, None, 7),
+         (unsupported_proxy_server, 200, None, None)]]
+
+    self.testapp.get(PATHS['cron_proxy_server_distribute_key'])
+
+    self.assertEqual(mock_distribute.call_count, 2)
+    mock_make_key_strings.assert_called_once_with(
+        ANY, [rejecting_proxy_server, unsupported_proxy_server])
+    mock_distribute.assert_called_with([
+        proxy_server._MakeFullKeyPush(rejecting_proxy_server, 'keys1', 7),
+        proxy_server._MakeFullKeyPush(unsupported_proxy_server, 'keys2', 7)])
+    mock_set_keys.assert_called_once_with(
+        [(rejecting_proxy_server, 'digest1', 7),
+         (unsupported_proxy_server, 'digest2', None)],
+        ProxyAssignment(fake_proxy_servers).digest)
+    mock_set_failures.assert_called_once_with(
+        [(failed_proxy_server, 'HTTP 400')])
+
+  @patch('datastore.KeyBundle.CatchUp')
+  @patch('datastore.KeyChangeLog.GetBundleGeneration')
+  @patch('datastore.KeyChangeLog.Prune')
+  @patch('datastore.ProxyServer.SetDistributionFailures')
+  @patch('datastore.ProxyServer.SetDistributedKeys')
+  @patch('proxy_server._DistributeKeys')
+  @patch('proxy_server._MakeKeyPushes')
+  @patch('proxy_server._MakeKeyStringDigests')
+  @patch('datastore.KeyChangeLog.GetSequence')
+  @patch('datastore.ProxyServer.GetAll')
+  def testDistributeKeyHandlerConcurrentChange(self, mock_get_all,
+                                               mock_get_sequence,
+                                               mock_make_digests,
+                                               mock_make_pushes,
+                                               mock_distribute, mock_set_keys,
+                                               mock_set_failures, mock_prune,
+                                               mock_get_generation,
+                                               mock_catch_up):
+    """Test a delta missing a change made during the run keeps no digest."""
+    # pylint: disable=protected-access
+    # pylint: disable=too-many-arguments
+    # pylint: disable=unused-argument
+    delta_proxy_server = GetFakeProxyServer(1)
+    delta_proxy_server.key_sequence = 5
+    full_proxy_server = GetFakeProxyServer(2)
+    fake_proxy_servers = [delta_proxy_server, full_proxy_server]
+    mock_get_all.return_value = fake_proxy_servers
+    # Another run applies a key change to the bundle after this one caught up
+    # but before the key bundle is read for the digests.
+    mock_catch_up.return_value = (1, 7)
+    mock_get_generation.return_value = 1
+    mock_get_sequence.return_value = 8
+    mock_make_digests.return_value = {1: 'digest1', 2: 'digest2'}
+    mock_make_pushes.return_value = [
+        proxy_server._MakeDeltaKeyPush(delta_proxy_server, 'delta', 7),
+        proxy_server._MakeFullKeyPush(full_proxy_server, 'keys', 7)]
+    mock_distribute.return_value = [(delta_proxy_server, 200, None, 7),
+                                    (full_proxy_server, 200, None, 7)]
+
+    self.testapp.get(PATHS['cron_proxy_server_distribute_key'])
+
+    mock_set_keys.assert_called_once_with(
+        [(delta_proxy_server, None, 7), (full_proxy_server, 'digest2', 7)],
+        ProxyAssignment(fake_proxy_servers).digest)
+
+  @patch('datastore.KeyBundle.CatchUp')
+  @patch('datastore.KeyChangeLog.GetBundleGeneration')
+  @patch('datastore.KeyChangeLog.Prune')
+  @patch('datastore.ProxyServer.SetDistributionFailures')
+  @patch('datastore.ProxyServer.SetDistributedKeys')
+  @patch('proxy_server._DistributeKeys')
+  @patch('proxy_server._MakeKeyPushes')
+  @patch('proxy_server._MakeKeyStringDigests')
+  @patch('datastore.KeyChangeLog.GetSequence')
+  @patch('datastore.ProxyServer.GetAll')
+  def testDistributeKeyHandlerBundleRebuilt(self, mock_get_all,
+                                            mock_get_sequence,
+                                            mock_make_digests,
+                                            mock_make_pushes, mock_distribute,
+                                            mock_set_keys, mock_set_failures,
+                                            mock_prune, mock_get_generation,
+                                            mock_catch_up):
+    """Test keys sent while the bundle was rebuilt are not recorded."""
+    # pylint: disable=too-many-arguments
+    # pylint: disable=unused-argument
+    fake_proxy_server = GetFakeProxyServer()
+    mock_get_all.return_value = [fake_proxy_server]
+    mock_catch_up.return_value = (1, 7)
+    mock_get_generation.return_value = 2
+    mock_get_sequence.return_value = 7
+    mock_make_digests.return_value = {FAKE_ID: 'digest'}
+    mock_distribute.return_value = [(fake_proxy_server, 200, None, 7)]
 
     self.testapp.get(PATHS['cron_proxy_server_distribute_key'])
-    mock_request.assert_called_once_with(
-        'http://%s/key' % fake_proxy_server.ip_address,
-        headers={'content-type': 'text/plain'},
-        method='PUT',
-        body=fake_key_string)
+
+    mock_set_keys.assert_called_once_with(
+        [(fake_proxy_server, None, None)],
+        ProxyAssignment([fake_proxy_server]).digest)
+
+  @patch('datastore.KeyBundle.CatchUp')
+  @patch('datastore.KeyChangeLog.GetBundleGeneration')
+  @patch('datastore.KeyChangeLog.Prune')
+  @patch('datastore.ProxyServer.SetDistributionFailures')
+  @patch('datastore.ProxyServer.SetDistributedKeys')
+  @patch('proxy_server._DistributeKeys')
+  @patch('proxy_server._MakeKeyPushes')
+  @patch('proxy_server._MakeKeyStringDigests')
+  @patch('datastore.KeyChangeLog.GetSequence')
+  @patch('datastore.ProxyServer.GetAll')
+  def testDistributeKeyHandlerCircuitOpen(self, mock_get_all,
+                                          mock_get_sequence,
+                                          mock_make_digests,
+                                          mock_make_pushes, mock_distribute,
+                                          mock_set_keys, mock_set_failures,
+                                          mock_prune, mock_get_generation,
+                                          mock_catch_up):
+    """Test proxies which keep failing are skipped until they cool down."""
+    # pylint: disable=too-many-arguments
+    # pylint: disable=unused-argument
+    healthy_proxy_server = GetFakeProxyServer(1)
+    failing_proxy_server = GetFakeProxyServer(2)
+    failing_proxy_server.consecutive_failures = (
+        proxy_server.CIRCUIT_BREAKER_THRESHOLD)
+    failing_proxy_server.last_failure = datetime.utcnow()
+    cooled_down_proxy_server = GetFakeProxyServer(3)
+    cooled_down_proxy_server.consecutive_failures = (
+        proxy_server.CIRCUIT_BREAKER_THRESHOLD)
+    cooled_down_proxy_server.last_failure = (
+        datetime.utcnow() - proxy_server.CIRCUIT_BREAKER_COOLDOWN)
+    mock_get_all.return_value = [healthy_proxy_server, failing_proxy_server,
+                                 cooled_down_proxy_server]
+    mock_catch_up.return_value = (1, 0)
+    mock_get_generation.return_value = 1
+    mock_get_sequence.return_value = 0
+    mock_make_digests.return_value = {1: 'digest', 2: 'digest', 3: 'digest'}
+    mock_distribute.return_value = []
+
+    self.testapp.get(PATHS['cron_proxy_server_distribute_key'])
+    mock_make_pushes.assert_called_once_with(
+        ANY, [healthy_proxy_server, cooled_down_proxy_server], 0)
+
+    mock_make_pushes.reset_mock()
+    self.testapp.get(PATHS['cron_proxy_server_distribute_key'] + '?force=true')
+    mock_make_pushes.assert_called_once_with(
+        ANY,
+        [healthy_proxy_server, failing_proxy_server, cooled_down_proxy_server],
+        0)
+
+  @patch('proxy_server._MakeKeyStrings')
+  @patch('datastore.KeyChangeLog.GetChangesSince')
+  def testMakeKeyPushes(self, mock_get_changes, mock_make_key_strings):
+    """Test proxies get a delta only if they are recent enough."""
+    # pylint: disable=protected-access
+    new_proxy_server = GetFakeProxyServer(1)
+    recent_proxy_server = GetFakeProxyServer(2)
+    behind_proxy_server = GetFakeProxyServer(3)
+    moved_proxy_server = GetFakeProxyServer(4)
+    fake_proxy_servers = [new_proxy_server, recent_proxy_server,
+                          behind_proxy_server, moved_proxy_server]
+    assignment = ProxyAssignment(fake_proxy_servers)
+    recent_proxy_server.key_sequence = 8
+    recent_proxy_server.assignment_digest = assignment.digest
+    behind_proxy_server.key_sequence = 9 - proxy_server.MAX_DELTA_CHANGES - 1
+    behind_proxy_server.assignment_digest = assignment.digest
+    moved_proxy_server.key_sequence = 8
+    moved_proxy_server.assignment_digest = 'old assignment'
+
+    emails = ['user%d@bar.com' % index for index in range(20)]
+    assigned_email = [email for email in emails
+                      if assignment.IsAssigned(email, recent_proxy_server)][0]
+    other_email = [email for email in emails
+                   if not assignment.IsAssigned(email, recent_proxy_server)][0]
+    fake_changes = [
+        MagicMock(action='add', email=assigned_email, public_key='123abc',
+                  key_type='ssh-rsa',
+                  key=MagicMock(id=MagicMock(return_value=9))),
+        MagicMock(action='add', email=other_email, public_key='456def',
+                  key_type='ssh-rsa',
+                  key=MagicMock(id=MagicMock(return_value=9)))]
+    mock_get_changes.return_value = fake_changes
+    mock_make_key_strings.return_value = {1: 'keys1', 3: 'keys3', 4: 'keys4'}
+
+    key_pushes = proxy_server._MakeKeyPushes(assignment, fake_proxy_servers, 9)
+
+    mock_get_changes.assert_called_once_with(8, 9)
+    mock_make_key_strings.assert_called_once_with(
+        assignment, [new_proxy_server, behind_proxy_server, moved_proxy_server])
+    self.assertEqual(key_pushes[0], proxy_server._MakeFullKeyPush(
+        new_proxy_server, 'keys1', 9))
+    self.assertEqual(key_pushes[1], proxy_server._MakeDeltaKeyPush(
+        recent_proxy_server, '+ ssh-rsa 123abc %s\n' % assigned_email, 9))
+    self.assertEqual(key_pushes[2], proxy_server._MakeFullKeyPush(
+        behind_proxy_server, 'keys3', 9))
+    self.assertEqual(key_pushes[3], proxy_server._MakeFullKeyPush(
+        moved_proxy_server, 'keys4', 9))
+
+  @patch('datastore.KeyBundle.IterKeyLines')
+  def testMakeKeyStrings(self, mock_iter_key_lines):
+    """Test each proxy only gets the lines of the users assigned to it."""
+    # pylint: disable=protected-access
+    fake_proxy_servers = [GetFakeProxyServer(proxy_id)
+                          for proxy_id in range(1, 4)]
+    assignment = ProxyAssignment(fake_proxy_servers)
+    emails = ['user%d@bar.com' % index for index in range(20)]
+    fake_key_lines = [(email, 'ssh-rsa 123abc %s\n' % email)
+                      for email in emails]
+    mock_iter_key_lines.side_effect = lambda: iter(fake_key_lines)
+
+    key_strings = proxy_server._MakeKeyStrings(assignment, fake_proxy_servers)
+    key_string_digests = proxy_server._MakeKeyStringDigests(
+        assignment, fake_proxy_servers)
+
+    for fake_proxy_server in fake_proxy_servers:
+      proxy_id = fake_proxy_server.key.id()
+      self.assertEqual(key_strings[proxy_id], ''.join(
+          key_line for email, key_line in fake_key_lines
+          if assignment.IsAssigned(email, fake_proxy_server)))
+      self.assertEqual(key_string_digests[proxy_id],
+                       hashlib.sha256(key_strings[proxy_id]).hexdigest())
+
+  def testMakeKeyDelta(self):
+    """Test the key delta lists additions and removals in order."""
+    # pylint: disable=protected-access
+    fake_changes = [
+        MagicMock(action='add', email='foo@bar.com', public_key='123abc',
+                  key_type='ssh-ed25519'),
+        MagicMock(action='remove', email='bar@baz.com', public_key='def456',
+                  key_type='ssh-rsa')]
+
+    key_delta = proxy_server._MakeKeyDelta(fake_changes)
+
+    self.assertEqual(key_delta, '+ ssh-ed25519 123abc foo@bar.com\n'
+                                '- ssh-rsa def456 bar@baz.com\n')
+
+  @patch('proxy_server.time.sleep')
+  @patch('proxy_server._GetRetryDelay')
+  @patch('proxy_server.apiproxy_stub_map.UserRPC.wait_any')
+  @patch('proxy_server.urlfetch.make_fetch_call')
+  @patch('proxy_server.urlfetch.create_rpc')
+  def testDistributeKeys(self, mock_create_rpc, mock_make_fetch_call,
+                         mock_wait_any, mock_get_retry_delay, mock_sleep):
+    """Test keys are pushed to every proxy even if one keeps failing."""
+    # Disabling the protected access check here intentionally so we can test a
+    # private method.
+    # pylint: disable=protected-access
+    # pylint: disable=unused-argument
+    fake_proxy_server_1 = GetFakeProxyServer()
+    fake_proxy_server_2 = GetFakeProxyServer()
+    fake_proxy_server_2.ip_address = '0.0.0.0'
+    fake_key_string = 'ssh-rsa public_key email'
+    key_push_1 = proxy_server._MakeFullKeyPush(fake_proxy_server_1,
+                                               fake_key_string, 1)
+    key_push_2 = proxy_server._MakeFullKeyPush(fake_proxy_server_2,
+                                               fake_key_string, 1)
+
+    fake_error = proxy_server.urlfetch.DeadlineExceededError()
+    failing_rpc = MagicMock()
+    failing_rpc.get_result.side_effect = fake_error
+    working_rpc = MagicMock()
+    working_rpc.get_result.return_value = MagicMock(
+        status_code=200, headers={proxy_server.KEY_SEQUENCE_HEADER: '1'})
+    mock_create_rpc.side_effect = (
+        [failing_rpc, working_rpc] +
+        [failing_rpc] * (proxy_server.MAX_PUSH_ATTEMPTS - 1))
+    mock_wait_any.side_effect = lambda rpcs: rpcs[0]
+    mock_get_retry_delay.return_value = 0
+
+    results = proxy_server._DistributeKeys([key_push_1, key_push_2])
+
+    self.assertEqual(mock_create_rpc.call_count,
+                     proxy_server.MAX_PUSH_ATTEMPTS + 1)
+    mock_make_fetch_call.assert_any_call(
+        failing_rpc, 'http://%s/key' % fake_proxy_server_1.ip_address,
+        payload=fake_key_string, method=proxy_server.urlfetch.PUT,
+        headers=key_push_1['headers'], follow_redirects=False)
+    mock_make_fetch_call.assert_any_call(
+        working_rpc, 'http://%s/key' % fake_proxy_server_2.ip_address,
+        payload=fake_key_string, method=proxy_server.urlfetch.PUT,
+        headers=key_push_2['headers'], follow_redirects=False)
+    self.assertEqual(results,
+                     [(fake_proxy_server_1, None, repr(fake_error), None),
+                      (fake_proxy_server_2, 200, None, 1)])
+
+  @patch('proxy_server._GetRetryDelay')
+  @patch('proxy_server.apiproxy_stub_map.UserRPC.wait_any')
+  @patch('proxy_server.urlfetch.make_fetch_call')
+  @patch('proxy_server.urlfetch.create_rpc')
+  def testDistributeKeysRetries(self, mock_create_rpc, mock_make_fetch_call,
+                                mock_wait_any, mock_get_retry_delay):
+    """Test server errors are retried after a backoff and client errors not."""
+    # pylint: disable=protected-access
+    # pylint: disable=unused-argument
+    fake_proxy_server_1 = GetFakeProxyServer()
+    fake_proxy_server_2 = GetFakeProxyServer()
+    key_push_1 = proxy_server._MakeFullKeyPush(fake_proxy_server_1, 'keys', 1)
+    key_push_2 = proxy_server._MakeFullKeyPush(fake_proxy_server_2, 'keys', 1)
+
+    unavailable_rpc = MagicMock()
+    unavailable_rpc.get_result.return_value = MagicMock(status_code=503,
+                                                        content='busy')
+    bad_request_rpc = MagicMock()
+    bad_request_rpc.get_result.return_value = MagicMock(status_code=400,
+                                                        content='bad')
+    working_rpc = MagicMock()
+    working_rpc.get_result.return_value = MagicMock(status_code=200,
+                                                    headers={})
+    mock_create_rpc.side_effect = [unavailable_rpc, bad_request_rpc,
+                                   working_rpc]
+    mock_wait_any.side_effect = lambda rpcs: rpcs[0]
+    mock_get_retry_delay.return_value = 0
+
+    results = proxy_server._DistributeKeys([key_push_1, key_push_2])
+
+    self.assertEqual(mock_create_rpc.call_count, 3)
+    mock_get_retry_delay.assert_called_once_with(0)
+    self.assertEqual(results,
+                     [(fake_proxy_server_1, 200, None, None),
+                      (fake_proxy_server_2, 400, 'HTTP 400: bad', None)])
+
+  @patch('proxy_server.MAX_CONCURRENT_PUSHES', 2)
+  @patch('proxy_server.apiproxy_stub_map.UserRPC.wait_any')
+  @patch('proxy_server.urlfetch.make_fetch_call')
+  @patch('proxy_server.urlfetch.create_rpc')
+  def testDistributeKeysFinishedFirst(self, mock_create_rpc,
+                                      mock_make_fetch_call, mock_wait_any):
+    """Test a slow push does not hold up pushes waiting behind it."""
+    # pylint: disable=protected-access
+    # pylint: disable=unused-argument
+    fake_proxy_servers = [GetFakeProxyServer() for _ in range(3)]
+    key_pushes = [proxy_server._MakeFullKeyPush(fake_proxy_server, 'keys', 1)
+                  for fake_proxy_server in fake_proxy_servers]
+
+    slow_rpc = MagicMock()
+    slow_rpc.get_result.return_value = MagicMock(status_code=200, headers={})
+    fast_rpc = MagicMock()
+    fast_rpc.get_result.return_value = MagicMock(status_code=200, headers={})
+    last_rpc = MagicMock()
+    last_rpc.get_result.return_value = MagicMock(status_code=200, headers={})
+    mock_create_rpc.side_effect = [slow_rpc, fast_rpc, last_rpc]
+    # The slow push only finishes once nothing else is left in flight.
+    mock_wait_any.side_effect = (
+        lambda rpcs: [rpc for rpc in rpcs if rpc is not slow_rpc][0]
+        if len(rpcs) > 1 else rpcs[0])
+
+    results = proxy_server._DistributeKeys(key_pushes)
+
+    self.assertEqual(mock_wait_any.call_args_list[1][0][0],
+                     [slow_rpc, last_rpc])
+    self.assertEqual(results,
+                     [(fake_proxy_server, 200, None, None)
+                      for fake_proxy_server in fake_proxy_servers])
+
+  def testGetRetryDelay(self):
+    """Test the retry delay grows exponentially within the jitter bounds."""
+    # pylint: disable=protected-access
+    for attempt in range(proxy_server.MAX_PUSH_ATTEMPTS):
+      delay = proxy_server._GetRetryDelay(attempt)
+      base_delay = proxy_server.RETRY_BASE_DELAY * 2 ** attempt
+      self.assertTrue(0.5 * base_delay <= delay <= 1.5 * base_delay)
 
   def testRenderAddProxyServerTemplate(self):
     """Test the proxy server add form is rendered as in the html."""
@@ -168,43 +629,16 @@ class ProxyServerTest(unittest.TestCase):
     self.assertTrue(FAKE_SSH_PRIVATE_KEY in list_proxy_server_template)
     self.assertTrue(FAKE_FINGERPRINT in list_proxy_server_template)
 
-  @patch('datastore.User.GetAll')
-  def testMakeKeyString(self, mock_get_all):
-    """Test that the key string is generated with all non-revoked users."""
-    # Disabling the protected access check here intentionally so we can test a
-    # private method.
-    # pylint: disable=protected-access
-    fake_emails = ['foo@bar.com', 'bar@baz.com', 'baz@foo.com']
-    fake_public_keys = ['123abc', 'def456', '789ghi']
-    fake_user_1 = MagicMock(email=fake_emails[0],
-                            public_key=fake_public_keys[0],
-                            is_key_revoked=False)
-    fake_result_1 = ('ssh-rsa ' + fake_public_keys[0] + ' ' +
-                     fake_emails[0] + '\n')
-    fake_user_2 = MagicMock(email=fake_emails[1],
-                            public_key=fake_public_keys[1],
-                            is_key_revoked=False)
-    fake_result_2 = ('ssh-rsa ' + fake_public_keys[1] + ' ' +
-                     fake_emails[1] + '\n')
-    user_with_revoked_key = MagicMock(email=fake_emails[2],
-                                      public_key=fake_public_keys[2],
-                                      is_key_revoked=True)
-    fake_result_3 = ('ssh-rsa ' + fake_public_keys[2] + ' ' +
-                     fake_emails[2] + '\n')
-    fake_users = [fake_user_1, fake_user_2, user_with_revoked_key]
-    mock_get_all.return_value = fake_users
-
-    key_string = proxy_server._MakeKeyString()
-
-    mock_get_all.assert_called_once_with()
-
-    self.assertEqual(fake_result_1 + fake_result_2, key_string)
-    self.assertTrue(fake_result_3 not in key_string)
-
-
-def GetFakeProxyServer():
+  @patch('datastore.KeyBundle.Rebuild')
+  def testRebuildKeyBundleHandler(self, mock_rebuild):
+    """Test the rebuild handler rebuilds the key bundle from scratch."""
+    self.testapp.get(PATHS['cron_proxy_server_rebuild_key_bundle'])
+    mock_rebuild.assert_called_once_with()
+
+
+def GetFakeProxyServer(proxy_id=FAKE_ID):
   """Return an instance of a proxy server with mocked values."""
-  return ProxyServer(id=FAKE_ID,
+  return ProxyServer(id=proxy_id,
                      name=FAKE_NAME,
                      ip_address=FAKE_IP_ADDRESS,
                      ssh_private_key=FAKE_SSH_PRIVATE_KEY,
@@ -43,6 +43,7 @@ class SetupOAuthClientHandler(webapp2.RequestHandler):
     client_secret = self.request.get('client_secret')
     OAuth.Update(client_id, client_secret)
     OAuth.Flush()
+    admin.OAUTH_DECORATOR.Reset()
     dv_content = self.request.get('dv_content')
     DomainVerification.Update(dv_content)
     if User.GetCount() > 0:
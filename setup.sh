@@ -46,6 +46,10 @@ CHROME_DRIVER_VERSION="2.20"
 CHROME_DRIVER_FILE="chromedriver_linux64.zip"
 CHROME_DRIVER_LOCATION="http://chromedriver.storage.googleapis.com/${CHROME_DRIVER_VERSION}/${CHROME_DRIVER_FILE}"
 
+DISCOVERY_LOCATION="https://www.googleapis.com/discovery/v1/apis/admin/directory_v1/rest"
+DISCOVERY_DIR="$ROOT_DIR/discovery"
+DISCOVERY_FILE="$DISCOVERY_DIR/admin_directory_v1.json"
+
 NODE_MODULES_ROOT="$ROOT_DIR/node_modules"
 NODE_MODULES_UFO="$UFO_MS_LOCAL_DIR/node_modules"
 NODE_MODULES_UP="$UFO_MS_UP/node_modules"
@@ -95,7 +99,9 @@ function addVendorPackage ()
 
 function addAppEngineRuntimePackages ()
 {
-  runAndAssertCmd "pip install Jinja2"
+  # Must match the jinja2 version in app.yaml, since the precompiled templates
+  # only load under the Jinja2 version which compiled them.
+  runAndAssertCmd "pip install Jinja2==2.6"
   runAndAssertCmd "pip install pyyaml"
 }
 
@@ -104,6 +110,14 @@ function fixFancyUrlLibDirectoryStructure ()
   runAndAssertCmd "cp ${AE_PYTHON_FANCY}fancy_urllib/__init__.py ${AE_PYTHON_FANCY}__init__.py "
 }
 
+function addDiscoveryDocument ()
+{
+  if [ ! -d  "$DISCOVERY_DIR" ]; then
+    runAndAssertCmd "mkdir $DISCOVERY_DIR"
+  fi
+  runAndAssertCmd "wget -O $DISCOVERY_FILE $DISCOVERY_LOCATION"
+}
+
 function addChromeDriver ()
 {
   runAndAssertCmd "wget $CHROME_DRIVER_LOCATION"
@@ -167,6 +181,7 @@ function setupDevelopmentEnvironment ()
     fixFancyUrlLibDirectoryStructure
     addAllExports
     addTestingPackages
+    addDiscoveryDocument
     runAndAssertCmd "chown -R ${SUDO_USER:-$USER} *"
     addNode
     addBower
@@ -233,6 +248,16 @@ function testOntravis ()
   addBower
 }
 
+function measureImportTime ()
+{
+  runAndAssertCmd "python import_time.py"
+}
+
+function compileTemplates ()
+{
+  runAndAssertCmd "python compile_templates.py"
+}
+
 function package ()
 {
   DIR_TO_PACKAGE="*"
@@ -260,6 +285,10 @@ function release ()
 function deploy ()
 {
   runBowerInstall
+  if [ ! -e  "$DISCOVERY_FILE" ]; then
+    addDiscoveryDocument
+  fi
+  compileTemplates
   AE_FILE=""
   if [ -d  "$AE_PYTHON_LOCAL_DIR" ]; then
     AE_FILE="${AE_PYTHON_LOCAL_DIR}appcfg.py"
@@ -297,7 +326,7 @@ function installManagementServer ()
 function printHelp ()
 {
   echo
-  echo "Usage: setup.sh [install|release|deploy|travis|setup|clean]"
+  echo "Usage: setup.sh [install|release|deploy|travis|setup|clean|discovery|importtime|templates]"
   echo
   echo "  install      - Sets up the entire project from github."
   echo "  release      - Runs the tests and generate a tgz if successful."
@@ -305,6 +334,9 @@ function printHelp ()
   echo "  travis       - Prepares the machine for unit testing."
   echo "  setup        - Prepares the machine for development and testing."
   echo "  clean        - Remove existing dependency setup."
+  echo "  discovery    - Refreshes the bundled Directory API discovery document."
+  echo "  importtime   - Prints how long each app module takes to import."
+  echo "  templates    - Precompiles the templates as deploy does."
   echo
   echo
   echo "It is recommended to run setup as root to ensure correct installation."
@@ -378,6 +410,12 @@ elif [ "$1" == 'setup' ]; then
   setupDevelopmentEnvironment
 elif [ "$1" == 'clean' ]; then
   clean
+elif [ "$1" == 'discovery' ]; then
+  addDiscoveryDocument
+elif [ "$1" == 'importtime' ]; then
+  measureImportTime
+elif [ "$1" == 'templates' ]; then
+  compileTemplates
 elif [ "$1" == 'metal' ]; then
   installFromBareMetal
 else
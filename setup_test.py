@@ -68,6 +68,7 @@ class SetupTest(unittest.TestCase):
                                              unicode(FAKE_CONTENT, 'utf-8')))
     mock_oauth_update.assert_called_once_with(FAKE_ID, FAKE_SECRET)
     mock_flush.assert_called_once_with()
+    MOCK_ADMIN.OAUTH_DECORATOR.Reset.assert_called_with()
     mock_dv_update.assert_called_once_with(FAKE_CONTENT)
     mock_get_count.assert_called_once_with()
     self.assertEqual(resp.status_int, 302)
@@ -88,6 +89,7 @@ class SetupTest(unittest.TestCase):
                                              unicode(FAKE_CONTENT, 'utf-8')))
     mock_oauth_update.assert_called_once_with(FAKE_ID, FAKE_SECRET)
     mock_flush.assert_called_once_with()
+    MOCK_ADMIN.OAUTH_DECORATOR.Reset.assert_called_with()
     mock_dv_update.assert_called_once_with(FAKE_CONTENT)
     mock_get_count.assert_called_once_with()
 
@@ -7,11 +7,83 @@ from datastore import Notification
 from datastore import NotificationChannel
 from error_handlers import Handle500
 from googleapiclient import errors
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google_directory_service import GoogleDirectoryService
 import json
+import logging
+from lru_cache import LruCache
+import time
 import webapp2
 
 
+# Notifications queued but not stored yet beyond which new ones are refused
+# until the backlog is worked off.
+MAX_NOTIFICATION_BACKLOG = 10000
+# Seconds the directory is asked to wait before resending a refused one.
+BACKLOG_RETRY_AFTER = 30
+# Seconds an instance reuses the size of the backlog for, so that not every
+# notification has to wait on fetching it.
+BACKLOG_CHECK_TTL = 5
+# Seconds a single run spends storing notifications before handing over to
+# another run.
+STORE_TIME_LIMIT = 60
+
+# The directory resends a notification until it is acknowledged, so recently
+# received ones are remembered by each instance and across them in memcache.
+RECENT_NOTIFICATIONS_CACHE_SIZE = 10000
+RECENT_NOTIFICATIONS_TTL = 3600
+RECENT_NOTIFICATIONS_MEMCACHE_PREFIX = 'notification:'
+
+_BACKLOG_CACHE = LruCache(1, ttl=BACKLOG_CHECK_TTL)
+_RECENT_NOTIFICATIONS = LruCache(RECENT_NOTIFICATIONS_CACHE_SIZE,
+                                 ttl=RECENT_NOTIFICATIONS_TTL)
+
+
+def _IsBacklogged():
+  """Check whether too many notifications are waiting to be stored."""
+  backlog = _BACKLOG_CACHE.Get('backlog')
+  if backlog is None:
+    try:
+      backlog = Notification.GetBacklog()
+    except taskqueue.Error as error:
+      logging.warning('Could not get the notification backlog: %s', error)
+      return False
+    _BACKLOG_CACHE.Set('backlog', backlog)
+  return backlog >= MAX_NOTIFICATION_BACKLOG
+
+
+def _ClaimNotification(notification_id):
+  """Claim a notification so that later deliveries of it are ignored.
+
+  Args:
+    notification_id: The id of the notification, from Notification.MakeId.
+
+  Returns:
+    True if the notification is new, or False if it was already received.
+  """
+  if _RECENT_NOTIFICATIONS.Get(notification_id):
+    return False
+  memcache_key = RECENT_NOTIFICATIONS_MEMCACHE_PREFIX + notification_id
+  if not memcache.add(memcache_key, True, time=RECENT_NOTIFICATIONS_TTL):
+    # Adding also fails if memcache is unavailable, in which case the
+    # notification is taken as new. Its entity is keyed by its id anyway.
+    if memcache.get(memcache_key):
+      _RECENT_NOTIFICATIONS.Set(notification_id, True)
+      return False
+  _RECENT_NOTIFICATIONS.Set(notification_id, True)
+  return True
+
+
+def _ReleaseNotification(notification_id):
+  """Release the claim on a notification so that it can be received again.
+
+  Args:
+    notification_id: The id of the notification, from Notification.MakeId.
+  """
+  _RECENT_NOTIFICATIONS.Delete(notification_id)
+  memcache.delete(RECENT_NOTIFICATIONS_MEMCACHE_PREFIX + notification_id)
+
 
 def _RenderNotificationsTemplate():
   """Render a list of notifications."""
@@ -40,14 +112,42 @@ class PushNotificationHandler(webapp2.RequestHandler):
   # pylint: disable=too-few-public-methods
 
   def post(self):
-    """Receive push notifications and issue some sort of response."""
+    """Receive push notifications and issue some sort of response.
+
+    Notifications are queued to be stored in batches rather than stored here,
+    so that a burst of them is answered quickly. If too many are waiting to
+    be stored already, the directory is asked to send this one again later.
+    Notifications which were already received are acknowledged and ignored.
+    """
+    if _IsBacklogged():
+      self.response.set_status(503)
+      self.response.headers['Retry-After'] = str(BACKLOG_RETRY_AFTER)
+      return
     state = self.request.headers.get('X-Goog-Resource-State')
     number = self.request.headers.get('X-Goog-Message-Number')
+    channel_id = self.request.headers.get('X-Goog-Channel-ID')
     json_body = self.request.body
     body_object = json.loads(json_body)
     uuid = body_object['id']
     email = body_object['primaryEmail']
-    Notification.Insert(state=state, number=number, uuid=uuid, email=email)
+    name = body_object.get('name', {}).get('fullName')
+    notification_id = Notification.MakeId(channel_id, number)
+    if notification_id and not _ClaimNotification(notification_id):
+      self.response.write('Already got this notification.')
+      return
+    try:
+      Notification.Enqueue(state=state, number=number, uuid=uuid, email=email,
+                           channel_id=channel_id, name=name)
+    except taskqueue.Error as error:
+      logging.warning('Could not queue notification %s: %s', number, error)
+      # Let the directory's retry through, since this delivery was not kept.
+      if notification_id:
+        _ReleaseNotification(notification_id)
+      self.response.set_status(503)
+      self.response.headers['Retry-After'] = str(BACKLOG_RETRY_AFTER)
+      return
+    if state == 'makeAdmin':
+      admin.InvalidateIsAdmin(email)
     self.response.write('Got a notification!')
 
 
@@ -128,8 +228,37 @@ class UnsubscribeHandler(webapp2.RequestHandler):
       self.response.write('An error occurred: ' + str(error))
 
 
+class StoreNotificationsHandler(webapp2.RequestHandler):
+
+  """Apply and store the push notifications waiting in the queue."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler requires admin login, and is controlled in the app.yaml.
+  def get(self):
+    """Process the queued notifications in batches until the queue is empty.
+
+    This handler is not intended for a typical user, but for the task which
+    notifications schedule as they arrive and for a cron job. If notifications
+    are still waiting after STORE_TIME_LIMIT seconds, another run is scheduled
+    to process them.
+    """
+    start_time = time.time()
+    stored = 0
+    while True:
+      batch_size = Notification.ProcessQueued()
+      stored += batch_size
+      if not batch_size:
+        break
+      if time.time() - start_time > STORE_TIME_LIMIT:
+        Notification.ScheduleStore()
+        break
+    self.response.write('stored %d notifications' % stored)
+
+
 APP = webapp2.WSGIApplication([
     (PATHS['receive_push_notifications'], PushNotificationHandler),
+    (PATHS['cron_sync_store_notifications'], StoreNotificationsHandler),
     (PATHS['sync_top_level_path'], DefaultPathHandler),
     (PATHS['notification_channels_list'], ListChannelsHandler),
     (PATHS['notifications_list'], ListNotificationsHandler),
@@ -40,10 +40,17 @@ class SyncTest(unittest.TestCase):
   def setUp(self):
     """Setup test app on which to call handlers."""
     self.testapp = webtest.TestApp(sync.APP)
-
-  @patch('sync.Notification.Insert')
-  def testPushNotificationHandler(self, mock_insert):
-    """Test that push notifications trigger an insert in the datastore."""
+    # pylint: disable=protected-access
+    sync._BACKLOG_CACHE.Clear()
+    sync._RECENT_NOTIFICATIONS.Clear()
+    backlog_patcher = patch('sync.Notification.GetBacklog', return_value=0)
+    self.mock_get_backlog = backlog_patcher.start()
+    self.addCleanup(backlog_patcher.stop)
+
+  @patch('sync.admin.InvalidateIsAdmin')
+  @patch('sync.Notification.Enqueue')
+  def testPushNotificationHandler(self, mock_insert, mock_invalidate):
+    """Test that push notifications are queued to be stored."""
     params = {}
     params['id'] = FAKE_UUID
     params['primaryEmail'] = FAKE_EMAIL
@@ -56,8 +63,148 @@ class SyncTest(unittest.TestCase):
                                  json_body, headers)
 
     mock_insert.assert_called_once_with(state=FAKE_STATE, number=FAKE_NUMBER,
-                                        uuid=FAKE_UUID, email=FAKE_EMAIL)
+                                        uuid=FAKE_UUID, email=FAKE_EMAIL,
+                                        channel_id=None, name=None)
     self.assertEqual('Got a notification!' in response, True)
+    mock_invalidate.assert_not_called()
+
+  @patch('sync.admin.InvalidateIsAdmin')
+  @patch('sync.Notification.Enqueue')
+  def testPushNotificationHandlerMakeAdmin(self, mock_insert, mock_invalidate):
+    """Test a change in admin status drops the user's cached admin status."""
+    json_body = json.dumps({'id': FAKE_UUID, 'primaryEmail': FAKE_EMAIL})
+    headers = {}
+    headers['X-Goog-Resource-State'] = 'makeAdmin'
+    headers['X-Goog-Message-Number'] = FAKE_NUMBER
+
+    self.testapp.post(PATHS['receive_push_notifications'], json_body, headers)
+
+    mock_insert.assert_called_once_with(state='makeAdmin', number=FAKE_NUMBER,
+                                        uuid=FAKE_UUID, email=FAKE_EMAIL,
+                                        channel_id=None, name=None)
+    mock_invalidate.assert_called_once_with(FAKE_EMAIL)
+
+  @patch('sync.memcache')
+  @patch('sync.Notification.Enqueue')
+  def testPushNotificationHandlerDuplicate(self, mock_enqueue, mock_memcache):
+    """Test a notification delivered twice is only queued once."""
+    mock_memcache.add.return_value = True
+    json_body = json.dumps({'id': FAKE_UUID, 'primaryEmail': FAKE_EMAIL})
+    headers = {}
+    headers['X-Goog-Resource-State'] = FAKE_STATE
+    headers['X-Goog-Message-Number'] = FAKE_NUMBER
+    headers['X-Goog-Channel-ID'] = FAKE_CHANNEL_ID
+
+    self.testapp.post(PATHS['receive_push_notifications'], json_body, headers)
+    response = self.testapp.post(PATHS['receive_push_notifications'],
+                                 json_body, headers)
+
+    mock_enqueue.assert_called_once_with(state=FAKE_STATE, number=FAKE_NUMBER,
+                                         uuid=FAKE_UUID, email=FAKE_EMAIL,
+                                         channel_id=FAKE_CHANNEL_ID,
+                                         name=None)
+    self.assertEqual(response.status_int, 200)
+    self.assertTrue('Already got this notification.' in response)
+    mock_memcache.add.assert_called_once_with(
+        sync.RECENT_NOTIFICATIONS_MEMCACHE_PREFIX + FAKE_CHANNEL_ID + ':' +
+        FAKE_NUMBER, True, time=sync.RECENT_NOTIFICATIONS_TTL)
+
+  @patch('sync.memcache')
+  def testClaimNotification(self, mock_memcache):
+    """Test notifications claimed by another instance are duplicates."""
+    # pylint: disable=protected-access
+    mock_memcache.add.return_value = False
+    mock_memcache.get.return_value = True
+    self.assertFalse(sync._ClaimNotification('other:1'))
+
+    mock_memcache.get.return_value = None
+    self.assertTrue(sync._ClaimNotification('unavailable:1'))
+    self.assertFalse(sync._ClaimNotification('unavailable:1'))
+
+  @patch('sync.memcache')
+  @patch('sync.Notification.Enqueue')
+  def testPushNotificationHandlerReleasesOnError(self, mock_enqueue,
+                                                 mock_memcache):
+    """Test a notification which could not be queued can be received again."""
+    mock_memcache.add.return_value = True
+    mock_enqueue.side_effect = [sync.taskqueue.TransientError(), None]
+    json_body = json.dumps({'id': FAKE_UUID, 'primaryEmail': FAKE_EMAIL})
+    headers = {}
+    headers['X-Goog-Resource-State'] = FAKE_STATE
+    headers['X-Goog-Message-Number'] = FAKE_NUMBER
+    headers['X-Goog-Channel-ID'] = FAKE_CHANNEL_ID
+
+    self.testapp.post(PATHS['receive_push_notifications'], json_body, headers,
+                      status=503)
+    response = self.testapp.post(PATHS['receive_push_notifications'],
+                                 json_body, headers)
+
+    self.assertEqual(mock_enqueue.call_count, 2)
+    self.assertTrue('Got a notification!' in response)
+    mock_memcache.delete.assert_called_once_with(
+        sync.RECENT_NOTIFICATIONS_MEMCACHE_PREFIX + FAKE_CHANNEL_ID + ':' +
+        FAKE_NUMBER)
+
+  @patch('sync.Notification.Enqueue')
+  def testPushNotificationHandlerBacklogged(self, mock_enqueue):
+    """Test notifications are refused while the backlog is too deep."""
+    self.mock_get_backlog.return_value = sync.MAX_NOTIFICATION_BACKLOG
+    json_body = json.dumps({'id': FAKE_UUID, 'primaryEmail': FAKE_EMAIL})
+
+    response = self.testapp.post(PATHS['receive_push_notifications'],
+                                 json_body, status=503)
+
+    mock_enqueue.assert_not_called()
+    self.assertEqual(response.headers['Retry-After'],
+                     str(sync.BACKLOG_RETRY_AFTER))
+
+  @patch('sync.Notification.GetBacklog')
+  def testIsBacklogged(self, mock_get_backlog):
+    """Test the backlog is compared to the limit and reused for a while."""
+    # pylint: disable=protected-access
+    mock_get_backlog.return_value = sync.MAX_NOTIFICATION_BACKLOG - 1
+    self.assertFalse(sync._IsBacklogged())
+
+    mock_get_backlog.return_value = sync.MAX_NOTIFICATION_BACKLOG
+    self.assertFalse(sync._IsBacklogged())
+    sync._BACKLOG_CACHE.Clear()
+    sync._RECENT_NOTIFICATIONS.Clear()
+    self.assertTrue(sync._IsBacklogged())
+    self.assertEqual(mock_get_backlog.call_count, 2)
+
+  @patch('sync.Notification.GetBacklog')
+  def testIsBackloggedWhenQueueUnavailable(self, mock_get_backlog):
+    """Test notifications are still accepted if the backlog is unknown."""
+    # pylint: disable=protected-access
+    mock_get_backlog.side_effect = sync.taskqueue.TransientError()
+    self.assertFalse(sync._IsBacklogged())
+
+  @patch('sync.Notification.ScheduleStore')
+  @patch('sync.Notification.ProcessQueued')
+  def testStoreNotificationsHandler(self, mock_process_queued,
+                                    mock_schedule_store):
+    """Test batches are stored until the queue is empty."""
+    mock_process_queued.side_effect = [500, 20, 0]
+
+    response = self.testapp.get(PATHS['cron_sync_store_notifications'])
+
+    self.assertEqual(mock_process_queued.call_count, 3)
+    mock_schedule_store.assert_not_called()
+    self.assertTrue('stored 520 notifications' in response)
+
+  @patch('sync.time.time')
+  @patch('sync.Notification.ScheduleStore')
+  @patch('sync.Notification.ProcessQueued')
+  def testStoreNotificationsHandlerTimeLimit(self, mock_process_queued,
+                                             mock_schedule_store, mock_time):
+    """Test another run is scheduled if storing takes too long."""
+    mock_process_queued.return_value = 500
+    mock_time.side_effect = [0, 1, sync.STORE_TIME_LIMIT + 1]
+
+    self.testapp.get(PATHS['cron_sync_store_notifications'])
+
+    self.assertEqual(mock_process_queued.call_count, 2)
+    mock_schedule_store.assert_called_once_with()
 
   def testDefaultPathHandler(self):
     """Test that the default path redirects to the notifications path."""
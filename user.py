@@ -4,14 +4,24 @@ import admin
 from appengine_config import JINJA_ENVIRONMENT
 from ast import literal_eval
 import base64
+from config import KEY_PAIR_POOL_SIZE
 from config import PATHS
+from datastore import AddUsersJob
 from datastore import DomainVerification
+from datastore import KeyPair
 from datastore import ProxyServer
+from datastore import ReconcileJob
 from datastore import User
 from error_handlers import Handle500
 from googleapiclient import errors
+from google.appengine.api.users import get_current_user
+from google_directory_service import ADD_USER_FIELDS
 from google_directory_service import GoogleDirectoryService
+from google_directory_service import RECONCILE_USER_FIELDS
 import json
+import logging
+from oauth2client.client import AccessTokenRefreshError
+from proxy_assignment import ProxyAssignment
 import random
 import webapp2
 import xsrf
@@ -41,7 +51,7 @@ def _GenerateUserPayload(users):
   return user_token_payloads
 
 
-def _MakeInviteCode(user):
+def _MakeInviteCode(user, host):
   """Create an invite code for the given user.
 
   The invite code is a format created by the uproxy team.
@@ -58,7 +68,8 @@ def _MakeInviteCode(user):
 
   It includes the host ip (of the proxy server or load balancer) to connect
   the user to, the user username (user's email) to connect with, and
-  the credential (private key) necessary to authenticate with the host.
+  the credential (private key) necessary to authenticate with the host. Since
+  users may hold either RSA or Ed25519 keys, the key type is included too.
 
   TODO: Guard against any future breakage when the invite code format
   is changed again.  Possibly adding a test on the uproxy-lib side
@@ -66,38 +77,67 @@ def _MakeInviteCode(user):
 
   Args:
     user: A user from the datastore to generate an invite code for.
+    host: The ip address of the proxy server the invite code points at.
 
   Returns:
-    invite_code: A base64 encoded dictionary of host, user, and pass which
-    correspond to the proxy server/load balancer's ip, the user's email, and
-    the user's private key, respectively.  See example above.
+    invite_code: A base64 encoded dictionary of host, user, pass and keyType
+    which correspond to the proxy server/load balancer's ip, the user's email,
+    the user's private key and its type, respectively.  See example above.
   """
   invite_code_data = {
       'networkName': 'Cloud',
       'networkData': {}
   }
-  invite_code_data['networkData']['host'] = _GetInviteCodeIp()
+  invite_code_data['networkData']['host'] = host
   invite_code_data['networkData']['user'] = user.email
   invite_code_data['networkData']['pass'] = user.private_key
+  invite_code_data['networkData']['keyType'] = user.key_type
   json_data = json.dumps(invite_code_data)
   invite_code = base64.urlsafe_b64encode(json_data)
 
   return invite_code
 
 
-def _GetInviteCodeIp():
+def _GetInviteCodeIp(user):
   """Get the ip address for placing in the invite code.
 
   Eventually this method will actually get the load balancer's ip as we will
-  want in the final version. For now, it is used as a simple stub to just pick
-  a random proxy server's ip.
+  want in the final version. For now, it picks a random one of the proxy
+  servers assigned to the user, since only those carry the user's key. The
+  invite code stops working once that proxy server no longer carries the key,
+  see _IsInviteCodeStale.
+
+    Args:
+      user: A user entity.
 
     Returns:
       ip_address: An ip address for an invite code.
   """
-  proxy_servers = ProxyServer.GetAll()
-  index = random.randint(0, len(proxy_servers) - 1)
-  return proxy_servers[index].ip_address
+  assignment = ProxyAssignment(ProxyServer.GetAll())
+  return random.choice(assignment.GetProxyServers(user.email)).ip_address
+
+
+def _IsInviteCodeStale(user):
+  """Check whether the user's latest invite code may no longer work.
+
+  An invite code points at one of the proxy servers assigned to the user.
+  Adding, removing or moving proxy servers can assign the user elsewhere, and
+  rotating the user's key pair replaces the key in the code, so the code has
+  to be issued again. Codes issued before their host was recorded count as
+  stale too.
+
+  Args:
+    user: A user entity.
+
+  Returns:
+    True if the user should be given a new invite code.
+  """
+  if user.invite_code_host is None:
+    return True
+  assignment = ProxyAssignment(ProxyServer.GetAll())
+  return user.invite_code_host not in [
+      proxy_server.ip_address
+      for proxy_server in assignment.GetProxyServers(user.email)]
 
 
 def _RenderUserListTemplate():
@@ -131,6 +171,24 @@ def _RenderAddUsersTemplate(directory_users, error=None):
   return template.render(template_values)
 
 
+def _RenderAddUsersJobTemplate(job):
+  """Render a page showing the progress of adding users in the background."""
+  template_values = {
+      'job': job,
+  }
+  template = JINJA_ENVIRONMENT.get_template('templates/add_users_job.html')
+  return template.render(template_values)
+
+
+def _RenderReconcileJobTemplate(job):
+  """Render a page showing the summary of reconciling users."""
+  template_values = {
+      'job': job,
+  }
+  template = JINJA_ENVIRONMENT.get_template('templates/reconcile_job.html')
+  return template.render(template_values)
+
+
 def _RenderUserDetailsTemplate(user, invite_code=None):
   """Render a user add page that lets users be added by group key."""
   template_values = {
@@ -139,6 +197,8 @@ def _RenderUserDetailsTemplate(user, invite_code=None):
   }
   if invite_code is not None:
     template_values['invite_code'] = invite_code
+  else:
+    template_values['invite_code_stale'] = _IsInviteCodeStale(user)
   template = JINJA_ENVIRONMENT.get_template('templates/user_details.html')
   return template.render(template_values)
 
@@ -197,7 +257,9 @@ class GetInviteCodeHandler(webapp2.RequestHandler):
     """Output a list of all current users along with the requested token."""
     urlsafe_key = self.request.get('key')
     user = User.GetByKey(urlsafe_key)
-    invite_code = _MakeInviteCode(user)
+    host = _GetInviteCodeIp(user)
+    invite_code = _MakeInviteCode(user, host)
+    User.SetInviteCodeHost(urlsafe_key, host)
 
     self.response.write(_RenderUserDetailsTemplate(user, invite_code))
 
@@ -241,7 +303,8 @@ class AddUsersHandler(webapp2.RequestHandler):
 
       directory_users = []
       if get_all:
-        directory_users = directory_service.GetUsers()
+        directory_users = list(directory_service.ListUsers(
+            projection='basic', fields=ADD_USER_FIELDS))
       elif group_key is not None and group_key is not '':
         directory_users = directory_service.GetUsersByGroupKey(group_key)
       elif user_key is not None and user_key is not '':
@@ -260,7 +323,12 @@ class AddUsersHandler(webapp2.RequestHandler):
   @admin.RequireAppOrDomainAdmin
   @xsrf.XSRFProtect
   def post(self):
-    """Add all of the selected users into the datastore."""
+    """Add all of the selected users into the datastore.
+
+    A manually entered user is added straight away. Users selected from the
+    directory are added by a background job instead, and the admin is sent
+    to a page showing its progress.
+    """
     manual = self.request.get('manual')
     users_to_add = []
     if manual:
@@ -271,13 +339,105 @@ class AddUsersHandler(webapp2.RequestHandler):
       decoded_user['name']['fullName'] = user_name
       decoded_user['primaryEmail'] = user_email
       users_to_add.append(decoded_user)
-    else:
-      users = self.request.get_all('selected_user')
-      for user in users:
-        decoded_user = literal_eval(user)
-        users_to_add.append(decoded_user)
-    User.InsertUsers(users_to_add)
-    self.redirect(PATHS['user_page_path'])
+      User.InsertUsers(users_to_add, from_directory=False)
+      self.redirect(PATHS['user_page_path'])
+      return
+
+    users = self.request.get_all('selected_user')
+    for user in users:
+      decoded_user = literal_eval(user)
+      users_to_add.append(decoded_user)
+    job = AddUsersJob.Start(users_to_add)
+    self.redirect('{0}?id={1}'.format(PATHS['user_add_job_path'],
+                                      job.key.id()))
+
+
+class AddUsersJobHandler(webapp2.RequestHandler):
+
+  """Display the progress of adding users in the background."""
+
+  # pylint: disable=too-few-public-methods
+
+  @admin.OAUTH_DECORATOR.oauth_required
+  @admin.RequireAppOrDomainAdmin
+  def get(self):
+    """Output the progress page for the job id passed in."""
+    job = AddUsersJob.Get(int(self.request.get('id')))
+    if job is None:
+      self.abort(404)
+    self.response.write(_RenderAddUsersJobTemplate(job))
+
+
+class AddUsersJobStatusHandler(webapp2.RequestHandler):
+
+  """Report the progress of adding users in the background as json."""
+
+  # pylint: disable=too-few-public-methods
+
+  @admin.OAUTH_DECORATOR.oauth_required
+  @admin.RequireAppOrDomainAdmin
+  def get(self):
+    """Output the progress of the job id passed in, for the page to poll."""
+    job = AddUsersJob.Get(int(self.request.get('id')))
+    if job is None:
+      self.abort(404)
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(job.ToDict()))
+
+
+class ReconcileUsersHandler(webapp2.RequestHandler):
+
+  """Resync the users in the datastore with the directory."""
+
+  # pylint: disable=too-few-public-methods
+
+  @admin.OAUTH_DECORATOR.oauth_required
+  @admin.RequireAppOrDomainAdmin
+  @xsrf.XSRFProtect
+  def post(self):
+    """Start reconciling the users in the background and show its progress.
+
+    The job lists the directory with the current admin's credentials. If
+    add_new is passed in, directory users who are not in the datastore yet
+    are added as well.
+    """
+    add_new = bool(self.request.get('add_new'))
+    job = ReconcileJob.Start(get_current_user().user_id(), add_new)
+    self.redirect('{0}?id={1}'.format(PATHS['user_reconcile_job_path'],
+                                      job.key.id()))
+
+
+class ReconcileJobHandler(webapp2.RequestHandler):
+
+  """Display the summary of reconciling users in the background."""
+
+  # pylint: disable=too-few-public-methods
+
+  @admin.OAUTH_DECORATOR.oauth_required
+  @admin.RequireAppOrDomainAdmin
+  def get(self):
+    """Output the summary page for the job id passed in."""
+    job = ReconcileJob.Get(int(self.request.get('id')))
+    if job is None:
+      self.abort(404)
+    self.response.write(_RenderReconcileJobTemplate(job))
+
+
+class ReconcileJobStatusHandler(webapp2.RequestHandler):
+
+  """Report the summary of reconciling users in the background as json."""
+
+  # pylint: disable=too-few-public-methods
+
+  @admin.OAUTH_DECORATOR.oauth_required
+  @admin.RequireAppOrDomainAdmin
+  def get(self):
+    """Output the summary of the job id passed in, for the page to poll."""
+    job = ReconcileJob.Get(int(self.request.get('id')))
+    if job is None:
+      self.abort(404)
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(job.ToDict()))
 
 
 class ToggleKeyRevokedHandler(webapp2.RequestHandler):
@@ -311,6 +471,79 @@ class GetUserDetailsHandler(webapp2.RequestHandler):
     self.response.write(_RenderUserDetailsTemplate(user))
 
 
+class RefillKeyPairPoolHandler(webapp2.RequestHandler):
+
+  """Handler for topping up the pool of pre-generated key pairs."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler requires admin login, and is controlled in the app.yaml.
+  def get(self):
+    """Generate key pairs until the pool holds KEY_PAIR_POOL_SIZE of them.
+
+    This handler is not intended primarily for a typical user, but for a cron
+    job or task to trigger whenever key pairs are claimed from the pool. If
+    count is passed in, exactly that many key pairs are added instead, which
+    is how bulk generation is fanned out across tasks.
+    """
+    count = self.request.get('count')
+    if count:
+      added = int(count)
+      KeyPair.Generate(added)
+    else:
+      added = KeyPair.Refill(KEY_PAIR_POOL_SIZE)
+    self.response.write('added %d key pairs' % added)
+
+
+class AddUsersChunkHandler(webapp2.RequestHandler):
+
+  """Handler for adding one chunk of the users in a background job."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler requires admin login, and is controlled in the app.yaml.
+  def get(self):
+    """Add the users in the chunk and update the job's progress.
+
+    This handler is not intended for a typical user, but for the tasks queued
+    when a bulk add is started. Chunks which are already done are skipped, so
+    a retried task does not add its users again.
+    """
+    job_id = int(self.request.get('job'))
+    chunk_id = int(self.request.get('chunk'))
+    added = AddUsersJob.ProcessChunk(job_id, chunk_id)
+    self.response.write('added %d users' % added)
+
+
+class ReconcileUsersTaskHandler(webapp2.RequestHandler):
+
+  """Handler for reconciling the users with the directory in a task."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler requires admin login, and is controlled in the app.yaml.
+  def get(self):
+    """Run the reconciliation job passed in and output its summary.
+
+    This handler is not intended for a typical user, but for the task queued
+    when a reconciliation is started. If the directory cannot be listed, the
+    job is marked failed rather than retried, since the admin has to act.
+    """
+    job = ReconcileJob.Get(int(self.request.get('job')))
+    if job is None:
+      self.response.write('job not found')
+      return
+    try:
+      credentials = admin.StoredCredentials(job.user_id)
+      directory_service = GoogleDirectoryService(credentials)
+      job.Run(directory_service.ListUsers(projection='basic',
+                                          fields=RECONCILE_USER_FIELDS))
+    except (errors.HttpError, AccessTokenRefreshError) as error:
+      logging.error('Reconciling users failed: %s', error)
+      job.Fail(error)
+    self.response.write(json.dumps(job.ToDict()))
+
+
 APP = webapp2.WSGIApplication([
     (PATHS['landing_page_path'], LandingPageHandler),
     (PATHS['user_page_path'], ListUsersHandler),
@@ -318,8 +551,16 @@ APP = webapp2.WSGIApplication([
     (PATHS['user_get_invite_code_path'], GetInviteCodeHandler),
     (PATHS['user_get_new_key_pair_path'], GetNewKeyPairHandler),
     (PATHS['user_add_path'], AddUsersHandler),
+    (PATHS['user_add_job_path'], AddUsersJobHandler),
+    (PATHS['user_add_job_status_path'], AddUsersJobStatusHandler),
+    (PATHS['user_reconcile_path'], ReconcileUsersHandler),
+    (PATHS['user_reconcile_job_path'], ReconcileJobHandler),
+    (PATHS['user_reconcile_job_status_path'], ReconcileJobStatusHandler),
     (PATHS['user_toggle_revoked_path'], ToggleKeyRevokedHandler),
     (PATHS['user_details_path'], GetUserDetailsHandler),
+    (PATHS['cron_user_refill_key_pair_pool'], RefillKeyPairPoolHandler),
+    (PATHS['cron_user_add_users_chunk'], AddUsersChunkHandler),
+    (PATHS['cron_user_reconcile_users'], ReconcileUsersTaskHandler),
     (admin.OAUTH_DECORATOR.callback_path,
      admin.OAUTH_DECORATOR.callback_handler()),
 ], debug=True)
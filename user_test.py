@@ -5,6 +5,9 @@ import sys
 
 import base64
 from config import PATHS
+from datastore import AddUsersJob
+from datastore import ProxyServer
+from datastore import ReconcileJob
 from datastore import User
 from googleapiclient import errors
 from google.appengine.ext import ndb
@@ -52,6 +55,14 @@ FAKE_ADD_USER['email'] = FAKE_EMAIL_1
 FAKE_ADD_USER['role'] = 'MEMBER'
 FAKE_ADD_USER['type'] = 'USER'
 FAKE_USER_ARRAY.append(FAKE_ADD_USER)
+FAKE_JOB_ID = 1234
+FAKE_ADD_USERS_JOB = AddUsersJob(id=FAKE_JOB_ID, num_users=2, num_chunks=1,
+                                 added_users=0, done_chunks=0)
+FAKE_USER_ID = '1234567890'
+FAKE_RECONCILE_JOB = ReconcileJob(id=FAKE_JOB_ID, user_id=FAKE_USER_ID,
+                                  added_users=1, updated_users=2,
+                                  removed_users=3, unchanged_users=4,
+                                  total_seconds=12.34)
 
 
 class UserTest(unittest.TestCase):
@@ -84,20 +95,26 @@ class UserTest(unittest.TestCase):
     mock_delete_user.assert_called_once_with(FAKE_DS_KEY)
     mock_user_template.assert_called_once_with()
 
+  @patch('user.User.SetInviteCodeHost')
   @patch('user.User.GetByKey')
+  @patch('user._GetInviteCodeIp')
   @patch('user._MakeInviteCode')
   @patch('user._RenderUserDetailsTemplate')
   def testGetInviteCodeHandler(self, mock_user_template, mock_make_invite_code,
-                               mock_get_user):
+                               mock_get_ip, mock_get_user, mock_set_host):
     """Test the invite code handler generates an invite code for the user."""
+    # pylint: disable=too-many-arguments
     mock_get_user.return_value = FAKE_USER
+    fake_ip = '0.0.0.0'
+    mock_get_ip.return_value = fake_ip
     fake_invite_code = 'base64EncodedBlob'
     mock_make_invite_code.return_value = fake_invite_code
 
     self.testapp.get(PATHS['user_get_invite_code_path'] + '?key=' + FAKE_DS_KEY)
 
     mock_get_user.assert_called_once_with(FAKE_DS_KEY)
-    mock_make_invite_code.assert_called_once_with(FAKE_USER)
+    mock_make_invite_code.assert_called_once_with(FAKE_USER, fake_ip)
+    mock_set_host.assert_called_once_with(FAKE_DS_KEY, fake_ip)
     mock_user_template.assert_called_once_with(FAKE_USER, fake_invite_code)
 
   @patch('user._RenderUserDetailsTemplate')
@@ -115,13 +132,32 @@ class UserTest(unittest.TestCase):
     mock_get_by_key.assert_called_once_with(FAKE_DS_KEY)
     mock_render_details.assert_called_once_with(FAKE_USER)
 
+  @patch('user.KeyPair.Refill')
+  def testRefillKeyPairPoolHandler(self, mock_refill):
+    """Test the refill handler tops the key pair pool up to its stock."""
+    mock_refill.return_value = 3
+
+    response = self.testapp.get(PATHS['cron_user_refill_key_pair_pool'])
+
+    mock_refill.assert_called_once_with(user.KEY_PAIR_POOL_SIZE)
+    self.assertTrue('added 3 key pairs' in response.body)
+
+  @patch('user.KeyPair.Generate')
+  def testRefillKeyPairPoolHandlerWithCount(self, mock_generate):
+    """Test a fanned out generation task adds exactly its count."""
+    response = self.testapp.get(
+        PATHS['cron_user_refill_key_pair_pool'] + '?count=5')
+
+    mock_generate.assert_called_once_with(5)
+    self.assertTrue('added 5 key pairs' in response.body)
+
   @patch('user._RenderAddUsersTemplate')
   @patch('google_directory_service.GoogleDirectoryService.WatchUsers')
   @patch('google_directory_service.GoogleDirectoryService.GetUserAsList')
   @patch('google_directory_service.GoogleDirectoryService.GetUsersByGroupKey')
-  @patch('google_directory_service.GoogleDirectoryService.GetUsers')
+  @patch('google_directory_service.GoogleDirectoryService.ListUsers')
   @patch('google_directory_service.GoogleDirectoryService.__init__')
-  def testAddUsersGetHandlerNoParam(self, mock_ds, mock_get_users,
+  def testAddUsersGetHandlerNoParam(self, mock_ds, mock_list_users,
                                     mock_get_by_key, mock_get_user,
                                     mock_watch_users, mock_render):
     """Test the add users get handler displays no users on initial get."""
@@ -130,7 +166,7 @@ class UserTest(unittest.TestCase):
     self.testapp.get(PATHS['user_add_path'])
 
     mock_ds.assert_called_once_with(MOCK_ADMIN.OAUTH_DECORATOR)
-    mock_get_users.assert_not_called()
+    mock_list_users.assert_not_called()
     mock_get_user.assert_not_called()
     mock_get_by_key.assert_not_called()
     mock_watch_users.assert_not_called()
@@ -140,9 +176,9 @@ class UserTest(unittest.TestCase):
   @patch('google_directory_service.GoogleDirectoryService.WatchUsers')
   @patch('google_directory_service.GoogleDirectoryService.GetUserAsList')
   @patch('google_directory_service.GoogleDirectoryService.GetUsersByGroupKey')
-  @patch('google_directory_service.GoogleDirectoryService.GetUsers')
+  @patch('google_directory_service.GoogleDirectoryService.ListUsers')
   @patch('google_directory_service.GoogleDirectoryService.__init__')
-  def testAddUsersGetHandlerWithGroup(self, mock_ds, mock_get_users,
+  def testAddUsersGetHandlerWithGroup(self, mock_ds, mock_list_users,
                                       mock_get_by_key, mock_get_user,
                                       mock_watch_users, mock_render):
     """Test the add users get handler displays users from a given group."""
@@ -153,7 +189,7 @@ class UserTest(unittest.TestCase):
     mock_get_by_key.return_value = FAKE_USER_ARRAY
     self.testapp.get(PATHS['user_add_path'] + '?group_key=' + group_key)
 
-    mock_get_users.assert_not_called()
+    mock_list_users.assert_not_called()
     mock_get_user.assert_not_called()
     mock_ds.assert_called_once_with(MOCK_ADMIN.OAUTH_DECORATOR)
     mock_get_by_key.assert_called_once_with(group_key)
@@ -167,9 +203,9 @@ class UserTest(unittest.TestCase):
   @patch('google_directory_service.GoogleDirectoryService.WatchUsers')
   @patch('google_directory_service.GoogleDirectoryService.GetUserAsList')
   @patch('google_directory_service.GoogleDirectoryService.GetUsersByGroupKey')
-  @patch('google_directory_service.GoogleDirectoryService.GetUsers')
+  @patch('google_directory_service.GoogleDirectoryService.ListUsers')
   @patch('google_directory_service.GoogleDirectoryService.__init__')
-  def testAddUsersGetHandlerWithUser(self, mock_ds, mock_get_users,
+  def testAddUsersGetHandlerWithUser(self, mock_ds, mock_list_users,
                                      mock_get_by_key, mock_get_user,
                                      mock_watch_users, mock_render):
     """Test the add users get handler displays a given user as requested."""
@@ -180,7 +216,7 @@ class UserTest(unittest.TestCase):
     mock_get_user.return_value = FAKE_USER_ARRAY
     self.testapp.get(PATHS['user_add_path'] + '?user_key=' + user_key)
 
-    mock_get_users.assert_not_called()
+    mock_list_users.assert_not_called()
     mock_get_by_key.assert_not_called()
     mock_ds.assert_called_once_with(MOCK_ADMIN.OAUTH_DECORATOR)
     mock_get_user.assert_called_once_with(user_key)
@@ -194,21 +230,22 @@ class UserTest(unittest.TestCase):
   @patch('google_directory_service.GoogleDirectoryService.WatchUsers')
   @patch('google_directory_service.GoogleDirectoryService.GetUserAsList')
   @patch('google_directory_service.GoogleDirectoryService.GetUsersByGroupKey')
-  @patch('google_directory_service.GoogleDirectoryService.GetUsers')
+  @patch('google_directory_service.GoogleDirectoryService.ListUsers')
   @patch('google_directory_service.GoogleDirectoryService.__init__')
-  def testAddUsersGetHandlerWithAll(self, mock_ds, mock_get_users,
+  def testAddUsersGetHandlerWithAll(self, mock_ds, mock_list_users,
                                     mock_get_by_key, mock_get_user,
                                     mock_watch_users, mock_render):
     """Test the add users get handler displays all users in a domain."""
     # pylint: disable=too-many-arguments
     mock_ds.return_value = None
-    mock_get_users.return_value = FAKE_USER_ARRAY
+    mock_list_users.return_value = iter(FAKE_USER_ARRAY)
     self.testapp.get(PATHS['user_add_path'] + '?get_all=true')
 
     mock_get_by_key.assert_not_called()
     mock_get_user.assert_not_called()
     mock_ds.assert_called_once_with(MOCK_ADMIN.OAUTH_DECORATOR)
-    mock_get_users.assert_called_once_with()
+    mock_list_users.assert_called_once_with(projection='basic',
+                                            fields=user.ADD_USER_FIELDS)
     mock_watch_users.assert_any_call('delete')
     mock_watch_users.assert_any_call('makeAdmin')
     mock_watch_users.assert_any_call('undelete')
@@ -219,9 +256,9 @@ class UserTest(unittest.TestCase):
   @patch('google_directory_service.GoogleDirectoryService.WatchUsers')
   @patch('google_directory_service.GoogleDirectoryService.GetUserAsList')
   @patch('google_directory_service.GoogleDirectoryService.GetUsersByGroupKey')
-  @patch('google_directory_service.GoogleDirectoryService.GetUsers')
+  @patch('google_directory_service.GoogleDirectoryService.ListUsers')
   @patch('google_directory_service.GoogleDirectoryService.__init__')
-  def testAddUsersGetHandlerWithError(self, mock_ds, mock_get_users,
+  def testAddUsersGetHandlerWithError(self, mock_ds, mock_list_users,
                                       mock_get_by_key, mock_get_user,
                                       mock_watch_users, mock_render):
     """Test the add users get handler fails gracefully."""
@@ -231,19 +268,20 @@ class UserTest(unittest.TestCase):
     fake_content = b'some error content'
     fake_error = errors.HttpError(fake_response, fake_content)
     mock_ds.side_effect = fake_error
-    mock_get_users.return_value = FAKE_USER_ARRAY
+    mock_list_users.return_value = FAKE_USER_ARRAY
     self.testapp.get(PATHS['user_add_path'] + '?get_all=true')
 
     mock_ds.assert_called_once_with(MOCK_ADMIN.OAUTH_DECORATOR)
     mock_get_by_key.assert_not_called()
     mock_get_user.assert_not_called()
-    mock_get_users.assert_not_called()
+    mock_list_users.assert_not_called()
     mock_watch_users.assert_not_called()
     mock_render.assert_called_once_with([], fake_error)
 
-  @patch('user.User.InsertUsers')
-  def testAddUsersPostHandler(self, mock_insert):
-    """Test the add users post handler calls to insert the specified users."""
+  @patch('user.AddUsersJob.Start')
+  def testAddUsersPostHandler(self, mock_start):
+    """Test the add users post handler starts a job for the selected users."""
+    mock_start.return_value = FAKE_ADD_USERS_JOB
     user_1 = {}
     user_1['primaryEmail'] = FAKE_EMAIL_1
     user_1['name'] = {}
@@ -258,9 +296,135 @@ class UserTest(unittest.TestCase):
     data = '?selected_user={0}&selected_user={1}'.format(user_1, user_2)
     response = self.testapp.post(PATHS['user_add_path'] + data)
 
-    mock_insert.assert_called_once_with(user_array)
+    mock_start.assert_called_once_with(user_array)
     self.assertEqual(response.status_int, 302)
-    self.assertTrue(PATHS['user_page_path'] in response.location)
+    self.assertTrue('{0}?id={1}'.format(PATHS['user_add_job_path'],
+                                        FAKE_JOB_ID) in response.location)
+
+  @patch('user._RenderAddUsersJobTemplate')
+  @patch('user.AddUsersJob.Get')
+  def testAddUsersJobHandler(self, mock_get, mock_render):
+    """Test the job handler renders the progress of the requested job."""
+    mock_get.return_value = FAKE_ADD_USERS_JOB
+    mock_render.return_value = ''
+
+    self.testapp.get(PATHS['user_add_job_path'] + '?id=' + str(FAKE_JOB_ID))
+
+    mock_get.assert_called_once_with(FAKE_JOB_ID)
+    mock_render.assert_called_once_with(FAKE_ADD_USERS_JOB)
+
+  @patch('user.AddUsersJob.Get')
+  def testAddUsersJobHandlerMissingJob(self, mock_get):
+    """Test the job handler returns not found for an unknown job."""
+    mock_get.return_value = None
+
+    response = self.testapp.get(
+        PATHS['user_add_job_path'] + '?id=' + str(FAKE_JOB_ID),
+        expect_errors=True)
+
+    self.assertEqual(response.status_int, 404)
+
+  @patch('user.AddUsersJob.Get')
+  def testAddUsersJobStatusHandler(self, mock_get):
+    """Test the job status handler outputs the job's progress as json."""
+    mock_get.return_value = FAKE_ADD_USERS_JOB
+
+    response = self.testapp.get(
+        PATHS['user_add_job_status_path'] + '?id=' + str(FAKE_JOB_ID))
+
+    mock_get.assert_called_once_with(FAKE_JOB_ID)
+    self.assertEqual(response.content_type, 'application/json')
+    self.assertEqual(json.loads(response.body),
+                     FAKE_ADD_USERS_JOB.ToDict())
+
+  @patch('user.AddUsersJob.ProcessChunk')
+  def testAddUsersChunkHandler(self, mock_process):
+    """Test the chunk handler adds the requested chunk of a job."""
+    mock_process.return_value = 2
+
+    response = self.testapp.get(
+        '{0}?job={1}&chunk=3'.format(PATHS['cron_user_add_users_chunk'],
+                                     FAKE_JOB_ID))
+
+    mock_process.assert_called_once_with(FAKE_JOB_ID, 3)
+    self.assertTrue('added 2 users' in response.body)
+
+  @patch('user.get_current_user')
+  @patch('user.ReconcileJob.Start')
+  def testReconcileUsersHandler(self, mock_start, mock_get_current_user):
+    """Test a reconciliation is started for the current admin."""
+    mock_start.return_value = FAKE_RECONCILE_JOB
+    mock_get_current_user.return_value.user_id.return_value = FAKE_USER_ID
+
+    response = self.testapp.post(PATHS['user_reconcile_path'],
+                                 {'add_new': 'true'})
+
+    mock_start.assert_called_once_with(FAKE_USER_ID, True)
+    self.assertEqual(response.status_int, 302)
+    self.assertTrue('{0}?id={1}'.format(PATHS['user_reconcile_job_path'],
+                                        FAKE_JOB_ID) in response.location)
+
+  @patch('user._RenderReconcileJobTemplate')
+  @patch('user.ReconcileJob.Get')
+  def testReconcileJobHandler(self, mock_get, mock_render):
+    """Test the job handler renders the summary of the requested job."""
+    mock_get.return_value = FAKE_RECONCILE_JOB
+    mock_render.return_value = ''
+
+    self.testapp.get(PATHS['user_reconcile_job_path'] + '?id=' +
+                     str(FAKE_JOB_ID))
+
+    mock_get.assert_called_once_with(FAKE_JOB_ID)
+    mock_render.assert_called_once_with(FAKE_RECONCILE_JOB)
+
+  @patch('user.ReconcileJob.Get')
+  def testReconcileJobStatusHandler(self, mock_get):
+    """Test the job status handler outputs the job's summary as json."""
+    mock_get.return_value = FAKE_RECONCILE_JOB
+
+    response = self.testapp.get(
+        PATHS['user_reconcile_job_status_path'] + '?id=' + str(FAKE_JOB_ID))
+
+    self.assertEqual(response.content_type, 'application/json')
+    self.assertEqual(json.loads(response.body), FAKE_RECONCILE_JOB.ToDict())
+
+  @patch('user.GoogleDirectoryService')
+  @patch('user.ReconcileJob.Get')
+  def testReconcileUsersTaskHandler(self, mock_get, mock_directory_service):
+    """Test the task lists the directory with the admin's credentials."""
+    fake_job = MagicMock(user_id=FAKE_USER_ID)
+    fake_job.ToDict.return_value = {}
+    mock_get.return_value = fake_job
+    list_users = mock_directory_service.return_value.ListUsers
+    list_users.return_value = iter([FAKE_ADD_USER])
+
+    self.testapp.get('{0}?job={1}'.format(PATHS['cron_user_reconcile_users'],
+                                          FAKE_JOB_ID))
+
+    MOCK_ADMIN.StoredCredentials.assert_called_with(FAKE_USER_ID)
+    mock_directory_service.assert_called_once_with(
+        MOCK_ADMIN.StoredCredentials.return_value)
+    list_users.assert_called_once_with(projection='basic',
+                                       fields=user.RECONCILE_USER_FIELDS)
+    fake_job.Run.assert_called_once_with(list_users.return_value)
+    fake_job.Fail.assert_not_called()
+
+  @patch('user.GoogleDirectoryService')
+  @patch('user.ReconcileJob.Get')
+  def testReconcileUsersTaskHandlerError(self, mock_get,
+                                         mock_directory_service):
+    """Test the job is marked failed if the directory cannot be listed."""
+    fake_job = MagicMock(user_id=FAKE_USER_ID)
+    fake_job.ToDict.return_value = {}
+    mock_get.return_value = fake_job
+    fake_error = errors.HttpError(MagicMock(status='403'), b'forbidden')
+    fake_job.Run.side_effect = fake_error
+
+    response = self.testapp.get('{0}?job={1}'.format(
+        PATHS['cron_user_reconcile_users'], FAKE_JOB_ID))
+
+    fake_job.Fail.assert_called_once_with(fake_error)
+    self.assertEqual(response.status_int, 200)
 
   @patch('user.User.InsertUsers')
   def testAddUsersPostManualHandler(self, mock_insert):
@@ -275,7 +439,7 @@ class UserTest(unittest.TestCase):
                                                               FAKE_EMAIL)
     response = self.testapp.post(PATHS['user_add_path'] + data)
 
-    mock_insert.assert_called_once_with(user_array)
+    mock_insert.assert_called_once_with(user_array, from_directory=False)
     self.assertEqual(response.status_int, 302)
     self.assertTrue(PATHS['user_page_path'] in response.location)
 
@@ -374,6 +538,23 @@ class UserTest(unittest.TestCase):
     self.assertTrue('An error occurred while' in add_users_template)
     self.assertTrue(fake_error in add_users_template)
 
+  def testRenderReconcileJobTemplate(self):
+    """Test the job summary page shows the counts and timings."""
+    # pylint: disable=protected-access
+    job_template = user._RenderReconcileJobTemplate(FAKE_RECONCILE_JOB)
+    for count in ['1', '2', '3', '4']:
+      self.assertTrue('users">%s</td>' % count in job_template)
+    self.assertTrue('12.3' in job_template)
+    self.assertTrue(PATHS['user_reconcile_job_status_path'] in job_template)
+
+  def testRenderAddUsersJobTemplate(self):
+    """Test the job progress page is rendered with the job's progress."""
+    # pylint: disable=protected-access
+    job_template = user._RenderAddUsersJobTemplate(FAKE_ADD_USERS_JOB)
+    self.assertTrue(FAKE_ADD_USERS_JOB.status in job_template)
+    self.assertTrue(PATHS['user_add_job_status_path'] in job_template)
+    self.assertTrue('id=' + str(FAKE_JOB_ID) in job_template)
+
   @patch.object(user.User, 'key')
   def testRenderUserDetailTemplate(self, mock_url_key):
     """Test the user detail page is rendered with a user's properties."""
@@ -391,6 +572,7 @@ class UserTest(unittest.TestCase):
     self.assertEqual(FAKE_DS_KEY in user_details_template, True)
     self.assertEqual('Enabled' in user_details_template, True)
     self.assertEquals('Invite Code Below' in user_details_template, False)
+    self.assertEquals('Invite Code Out of Date' in user_details_template, True)
 
   @patch.object(user.User, 'key')
   def testRenderUserDetailInviteCode(self, mock_url_key):
@@ -412,6 +594,8 @@ class UserTest(unittest.TestCase):
     self.assertEqual('Enabled' in user_details_template, True)
     self.assertEquals('Invite Code Below' in user_details_template, True)
     self.assertEquals(fake_invite_code in user_details_template, True)
+    self.assertEquals('Invite Code Out of Date' in user_details_template,
+                      False)
 
   @patch.object(user.User, 'key')
   def testGenerateUserPayload(self, mock_url_key):
@@ -431,20 +615,17 @@ class UserTest(unittest.TestCase):
     self.assertTrue(FAKE_USER.private_key not in user_payloads)
     self.assertTrue(FAKE_USER.private_key not in user_payloads[FAKE_DS_KEY])
 
-  @patch('user._GetInviteCodeIp')
-  def testMakeInviteCode(self, mock_get_ip):
+  def testMakeInviteCode(self):
     """Test that making an invite code follows the proper format."""
     # Disabling the protected access check here intentionally so we can test a
     # private method.
     # pylint: disable=protected-access
     fake_ip = '0.0.0.0'
-    mock_get_ip.return_value = fake_ip
 
-    invite_code = user._MakeInviteCode(FAKE_USER)
+    invite_code = user._MakeInviteCode(FAKE_USER, fake_ip)
     json_string = base64.urlsafe_b64decode(invite_code)
     invite_code_data = json.loads(json_string)
 
-    mock_get_ip.assert_called_once_with()
     self.assertEqual('Cloud',
                      invite_code_data['networkName'])
     self.assertEqual(FAKE_USER.email,
@@ -453,23 +634,47 @@ class UserTest(unittest.TestCase):
                      invite_code_data['networkData']['pass'])
     self.assertEqual(fake_ip,
                      invite_code_data['networkData']['host'])
+    self.assertEqual(User.KEY_TYPE_RSA,
+                     invite_code_data['networkData']['keyType'])
 
   @patch('user.ProxyServer.GetAll')
   def testGetInviteCodeIp(self, mock_get_all_proxies):
-    """Test that an invite code IP belongs to some proxy server."""
+    """Test that an invite code IP belongs to a proxy assigned the user."""
     # Disabling the protected access check here intentionally so we can test a
     # private method.
     # pylint: disable=protected-access
-    fake_ip_1 = '0.0.0.0'
-    fake_proxy_1 = MagicMock(ip_address=fake_ip_1)
-    fake_ip_2 = '1.2.3.4'
-    fake_proxy_2 = MagicMock(ip_address=fake_ip_2)
-    mock_get_all_proxies.return_value = [fake_proxy_1, fake_proxy_2]
-    fake_ip_list = [fake_ip_1, fake_ip_2]
+    fake_proxies = [ProxyServer(id=index, ip_address='1.2.3.%d' % index)
+                    for index in range(1, 6)]
+    mock_get_all_proxies.return_value = fake_proxies
+    assignment = user.ProxyAssignment(fake_proxies)
+    fake_ip_list = [proxy.ip_address
+                    for proxy in assignment.GetProxyServers(FAKE_USER.email)]
 
-    invite_code_ip = user._GetInviteCodeIp()
+    invite_code_ip = user._GetInviteCodeIp(FAKE_USER)
 
     self.assertTrue(invite_code_ip in fake_ip_list)
 
+  @patch('user.ProxyServer.GetAll')
+  def testIsInviteCodeStale(self, mock_get_all_proxies):
+    """Test an invite code is stale once its proxy is no longer assigned."""
+    # Disabling the protected access check here intentionally so we can test a
+    # private method.
+    # pylint: disable=protected-access
+    fake_proxies = [ProxyServer(id=index, ip_address='1.2.3.%d' % index)
+                    for index in range(1, 6)]
+    mock_get_all_proxies.return_value = fake_proxies
+    assignment = user.ProxyAssignment(fake_proxies)
+    assigned_ips = [proxy.ip_address
+                    for proxy in assignment.GetProxyServers(FAKE_EMAIL)]
+    unassigned_ip = [proxy.ip_address for proxy in fake_proxies
+                     if proxy.ip_address not in assigned_ips][0]
+    fake_user = User(email=FAKE_EMAIL)
+
+    self.assertTrue(user._IsInviteCodeStale(fake_user))
+    fake_user.invite_code_host = assigned_ips[0]
+    self.assertFalse(user._IsInviteCodeStale(fake_user))
+    fake_user.invite_code_host = unassigned_ip
+    self.assertTrue(user._IsInviteCodeStale(fake_user))
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,78 @@
+"""The warmup module for preparing new instances before they serve users."""
+
+import admin
+from appengine_config import JINJA_ENVIRONMENT
+from appengine_config import ROOT
+from config import PATHS
+from datastore import DomainVerification
+from datastore import OAuth
+import google_directory_service
+import logging
+import os
+import time
+import webapp2
+import xsrf
+
+
+# The modules of the WSGI applications routed to in app.yaml.
+WSGI_MODULES = ['logout', 'proxy_server', 'setup', 'sync', 'user']
+
+TEMPLATES_DIR = 'templates'
+
+
+def _ImportWsgiModules():
+  """Import every WSGI application so no request pays for it."""
+  for module_name in WSGI_MODULES:
+    __import__(module_name)
+
+
+def _CompileTemplates():
+  """Load every template, which compiles it into the Jinja cache."""
+  for file_name in sorted(os.listdir(os.path.join(ROOT, TEMPLATES_DIR))):
+    if file_name.endswith('.html'):
+      JINJA_ENVIRONMENT.get_template(TEMPLATES_DIR + '/' + file_name)
+
+
+def _LoadConfig():
+  """Load the singleton config entities into the caches."""
+  OAuth.GetOrInsertDefault()
+  DomainVerification.GetOrInsertDefault()
+  xsrf.XsrfSecret.get()
+  admin.OAUTH_DECORATOR.Load()
+
+
+def _GetWarmupSteps():
+  """Get the name and function of each warmup step, in order."""
+  return [
+      ('import wsgi modules', _ImportWsgiModules),
+      ('compile templates', _CompileTemplates),
+      ('load config', _LoadConfig),
+      ('build directory service', google_directory_service.LoadService),
+  ]
+
+
+class WarmupHandler(webapp2.RequestHandler):
+
+  """Prepare a new instance before it is sent user requests."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler requires admin login, and is controlled in the app.yaml.
+  def get(self):
+    """Run each warmup step and report how long it took."""
+    self.response.headers['Content-Type'] = 'text/plain'
+    total_start_time = time.time()
+    for step_name, step in _GetWarmupSteps():
+      start_time = time.time()
+      step()
+      elapsed_ms = (time.time() - start_time) * 1000
+      logging.info('Warmup step %s took %.1f ms', step_name, elapsed_ms)
+      self.response.write('%s: %.1f ms\n' % (step_name, elapsed_ms))
+    total_ms = (time.time() - total_start_time) * 1000
+    logging.info('Warmup took %.1f ms', total_ms)
+    self.response.write('total: %.1f ms\n' % total_ms)
+
+
+APP = webapp2.WSGIApplication([
+    (PATHS['warmup'], WarmupHandler),
+], debug=True)
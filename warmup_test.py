@@ -0,0 +1,68 @@
+"""Test warmup module functionality."""
+from mock import MagicMock
+from mock import patch
+import sys
+
+from config import PATHS
+import unittest
+import webtest
+
+MOCK_ADMIN = MagicMock()
+sys.modules['admin'] = MOCK_ADMIN
+
+MOCK_XSRF = MagicMock()
+sys.modules['xsrf'] = MOCK_XSRF
+
+import warmup
+
+
+class WarmupTest(unittest.TestCase):
+
+  """Test warmup class functionality."""
+
+  def setUp(self):
+    """Setup test app on which to call handlers."""
+    self.testapp = webtest.TestApp(warmup.APP)
+
+  @patch('warmup.google_directory_service.LoadService')
+  @patch('warmup._LoadConfig')
+  @patch('warmup._CompileTemplates')
+  @patch('warmup._ImportWsgiModules')
+  def testWarmupHandler(self, mock_import, mock_compile, mock_load_config,
+                        mock_load_service):
+    """Test warmup runs every step and reports how long each took."""
+    response = self.testapp.get(PATHS['warmup'])
+
+    for mock_step in [mock_import, mock_compile, mock_load_config,
+                      mock_load_service]:
+      mock_step.assert_called_once_with()
+    for step_name in ['import wsgi modules', 'compile templates',
+                      'load config', 'build directory service', 'total']:
+      self.assertTrue(step_name + ': ' in response.body)
+
+  @patch('warmup.JINJA_ENVIRONMENT.get_template')
+  def testCompileTemplates(self, mock_get_template):
+    """Test every template is loaded."""
+    # pylint: disable=protected-access
+    warmup._CompileTemplates()
+
+    mock_get_template.assert_any_call('templates/base.html')
+    mock_get_template.assert_any_call('templates/user.html')
+
+  @patch('warmup.xsrf.XsrfSecret.get')
+  @patch('warmup.DomainVerification.GetOrInsertDefault')
+  @patch('warmup.OAuth.GetOrInsertDefault')
+  def testLoadConfig(self, mock_oauth, mock_domain_verification,
+                     mock_xsrf_secret):
+    """Test the config entities and the OAuth decorator are loaded."""
+    # pylint: disable=protected-access
+    warmup._LoadConfig()
+
+    mock_oauth.assert_called_once_with()
+    mock_domain_verification.assert_called_once_with()
+    mock_xsrf_secret.assert_called_once_with()
+    MOCK_ADMIN.OAUTH_DECORATOR.Load.assert_called_once_with()
+
+
+if __name__ == '__main__':
+  unittest.main()
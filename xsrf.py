@@ -16,8 +16,22 @@ from google.appengine.api import users
 from google.appengine.ext import ndb
 
 
+XSRF_SECRET_MEMCACHE_KEY = 'xsrf_secret'
+
+# The secret never changes, so once an instance has it, it keeps it.
+_SECRET = None
+
+
 def XSRFToken():
-  """Generate a new xsrf secret and output it in urlsafe base64 encoding."""
+  """Generate the xsrf token of the current user in urlsafe base64 encoding.
+
+  The token is made for whoever is signed in to the current request, so it is
+  exposed to templates as a function to be called while rendering, i.e.
+  {{ xsrf_token() }}.
+
+  Returns:
+    A str of the token.
+  """
   digester = hmac.new(str(XsrfSecret.get()))
   digester.update(str(users.get_current_user().user_id()))
   return base64.urlsafe_b64encode(digester.digest())
@@ -44,8 +58,8 @@ def XSRFProtect(func):
   return decorate
 
 
-def ConstTimeCompare(string_a, string_b):
-  """Compare the the given strings in constant time."""
+def _PythonConstTimeCompare(string_a, string_b):
+  """Compare the given byte strings in constant time, for older runtimes."""
   if len(string_a) != len(string_b):
     return False
 
@@ -56,6 +70,19 @@ def ConstTimeCompare(string_a, string_b):
   return equals == 0
 
 
+# hmac.compare_digest is only in python 2.7.7 and later.
+_COMPARE_DIGEST = getattr(hmac, 'compare_digest', _PythonConstTimeCompare)
+
+
+def ConstTimeCompare(string_a, string_b):
+  """Compare the the given strings in constant time."""
+  if isinstance(string_a, unicode):
+    string_a = string_a.encode('utf-8')
+  if isinstance(string_b, unicode):
+    string_b = string_b.encode('utf-8')
+  return _COMPARE_DIGEST(string_a, string_b)
+
+
 class XsrfSecret(ndb.Model):
 
   """Model for datastore to store the XSRF secret."""
@@ -67,14 +94,19 @@ class XsrfSecret(ndb.Model):
   def get():
     """Retrieve the XSRF secret.
 
-    Tries to retrieve the XSRF secret from memcache, and if that fails, falls
-    back to getting it out of datastore. Note that the secret should not be
-    changed, as that would result in all issued tokens becoming invalid.
+    Tries to retrieve the XSRF secret from the instance, then from memcache,
+    and if both fail, falls back to getting it out of datastore. Note that the
+    secret should not be changed, as that would result in all issued tokens
+    becoming invalid.
 
     Returns:
       A unicode object of the secret.
     """
-    secret = memcache.get('xsrf_secret')
+    global _SECRET  # pylint: disable=global-statement
+    if _SECRET:
+      return _SECRET
+
+    secret = memcache.get(XSRF_SECRET_MEMCACHE_KEY)
     if not secret:
       xsrf_secret = XsrfSecret.query().get()
       if not xsrf_secret:
@@ -84,6 +116,7 @@ class XsrfSecret(ndb.Model):
         xsrf_secret.put()
 
       secret = xsrf_secret.secret
-      memcache.set('xsrf_secret', secret)
+      memcache.set(XSRF_SECRET_MEMCACHE_KEY, secret)
 
+    _SECRET = secret
     return secret